@@ -1,4 +1,8 @@
 import dsmil as mil
+from inference import InferenceEngine, add_inference_args
+import tile_decode
+import dataset_manifest
+import export_embedder
 
 import torch
 import torch.nn as nn
@@ -15,48 +19,13 @@ from collections import OrderedDict
 from skimage import exposure, io, img_as_ubyte, transform
 import warnings
 
-class BagDataset():
-    def __init__(self, csv_file, transform=None):
-        self.files_list = csv_file
-        self.transform = transform
-    def __len__(self):
-        return len(self.files_list)
-    def __getitem__(self, idx):
-        path = self.files_list[idx]
-        img = Image.open(path)
-        img_name = path.split(os.sep)[-1]
-        img_pos = np.asarray([int(img_name.split('.')[0].split('_')[0]), int(img_name.split('.')[0].split('_')[1])]) # row, col
-        sample = {'input': img, 'position': img_pos}
-        
-        if self.transform:
-            sample = self.transform(sample)
-        return sample 
-
-class ToTensor(object):
-    def __call__(self, sample):
-        img = sample['input']
-        img = VF.to_tensor(img)
-        sample['input'] = img
-        return sample
-    
-class Compose(object):
-    def __init__(self, transforms):
-        self.transforms = transforms
-
-    def __call__(self, img):
-        for t in self.transforms:
-            img = t(img)
-        return img
-
-def bag_dataset(args, csv_file_path):
-    transformed_dataset = BagDataset(csv_file=csv_file_path,
-                                    transform=Compose([
-                                        ToTensor()
-                                    ]))
-    dataloader = DataLoader(transformed_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, drop_last=False)
+def bag_dataset(args, csv_file_path, engine=None):
+    transformed_dataset = tile_decode.TileBatchDataset(csv_file_path, positions=tile_decode.file_positions(csv_file_path))
+    loader_kwargs = engine.loader_kwargs(args.num_workers) if engine is not None else {}
+    dataloader = tile_decode.batch_loader(transformed_dataset, args.batch_size, args.num_workers, shuffle=False, **loader_kwargs)
     return dataloader, len(transformed_dataset)
 
-def test(args, bags_list, milnet):
+def test(args, bags_list, milnet, engine, manifest):
     milnet.eval()
     num_bags = len(bags_list)
     Tensor = torch.FloatTensor
@@ -65,32 +34,32 @@ def test(args, bags_list, milnet):
         feats_list = []
         pos_list = []
         classes_list = []
-        csv_file_path = glob.glob(os.path.join(bags_list[i], '*.'+args.patch_ext))
-        dataloader, bag_size = bag_dataset(args, csv_file_path)
-        with torch.no_grad():
+        csv_file_path = manifest.tiles(bags_list[i], exts=('.'+args.patch_ext,))
+        dataloader, bag_size = bag_dataset(args, csv_file_path, engine)
+        with engine.context():
             for iteration, batch in enumerate(dataloader):
-                patches = batch['input'].float().cuda()
+                patches = engine.tensor(batch['input'])
                 patch_pos = batch['position']
-                feats, classes = milnet.i_classifier(patches)
-                feats = feats.cpu().numpy()
-                classes = classes.cpu().numpy()
+                feats, classes = engine.run(milnet.i_classifier, patches)
+                feats = feats.float().cpu().numpy()
+                classes = classes.float().cpu().numpy()
                 feats_list.extend(feats)
                 pos_list.extend(patch_pos)
                 classes_list.extend(classes)
             pos_arr = np.vstack(pos_list)
             feats_arr = np.vstack(feats_list)
             classes_arr = np.vstack(classes_list)
-            bag_feats = torch.from_numpy(feats_arr).cuda()
-            ins_classes = torch.from_numpy(classes_arr).cuda()
+            bag_feats = engine.tensor(torch.from_numpy(feats_arr))
+            ins_classes = engine.tensor(torch.from_numpy(classes_arr))
             bag_prediction, A, _ = milnet.b_classifier(bag_feats, ins_classes)
-            bag_prediction = torch.sigmoid(bag_prediction).squeeze().cpu().numpy()
+            bag_prediction = torch.sigmoid(bag_prediction).squeeze().float().cpu().numpy()
             if len(bag_prediction.shape)==0 or len(bag_prediction.shape)==1:
                 bag_prediction = np.atleast_1d(bag_prediction)
             benign = True
             num_pos_classes = 0
             for c in range(args.num_classes):          
                 if bag_prediction[c] >= args.thres[c]:
-                    attentions = A[:, c].cpu().numpy()
+                    attentions = A[:, c].float().cpu().numpy()
                     num_pos_classes += 1
                     if benign: # first class detected
                         print(bags_list[i] + ' is detected as: ' + args.class_name[c])
@@ -101,7 +70,7 @@ def test(args, bags_list, milnet):
                     benign = False # set flag
             if benign:
                 print(bags_list[i] + ' is detected as: benign')
-                attentions = torch.sum(A, 1).cpu().numpy()
+                attentions = torch.sum(A, 1).float().cpu().numpy()
                 colored_tiles = np.matmul(attentions[:, None], colors[0][None, :]) * 0
             colored_tiles = (colored_tiles / num_pos_classes)
             colored_tiles = exposure.rescale_intensity(colored_tiles, out_range=(0, 1))
@@ -112,7 +81,7 @@ def test(args, bags_list, milnet):
             color_map = transform.resize(color_map, (color_map.shape[0]*32, color_map.shape[1]*32), order=0)
             io.imsave(os.path.join(args.map_path, slide_name+'.png'), img_as_ubyte(color_map))
             if args.export_scores:
-                df_scores = pd.DataFrame(A.cpu().numpy())
+                df_scores = pd.DataFrame(A.float().cpu().numpy())
                 pos_arr_str = [str(s) for s in pos_arr]
                 df_scores['pos'] = pos_arr_str
                 df_scores.to_csv(os.path.join(args.score_path, slide_name+'.csv'), index=False)
@@ -122,19 +91,22 @@ if __name__ == '__main__':
     warnings.filterwarnings('ignore')
     parser = argparse.ArgumentParser(description='Testing workflow includes attention computing and color map production')
     parser.add_argument('--num_classes', type=int, default=2, help='Number of output classes')
-    parser.add_argument('--batch_size', type=int, default=64, help='Batch size of feeding patches')
+    parser.add_argument('--batch_size', type=int, default=0, help='Batch size of feeding patches, 0 probes the largest batch fitting in --memory_budget')
     parser.add_argument('--num_workers', type=int, default=0)
     parser.add_argument('--feats_size', type=int, default=512)
     parser.add_argument('--thres', nargs='+', type=float, default=[0.7371, 0.2752])
     parser.add_argument('--class_name', nargs='+', type=str, default=None)
     parser.add_argument('--embedder_weights', type=str, default='test/weights/embedder.pth')
+    parser.add_argument('--embedder_artifact', type=str, default='', help='TorchScript / ONNX embedder written by export_embedder.py, replaces --embedder_weights [disabled]')
     parser.add_argument('--aggregator_weights', type=str, default='test/weights/aggregator.pth')
     parser.add_argument('--bag_path', type=str, default='test/patches')
     parser.add_argument('--patch_ext', type=str, default='jpg')
     parser.add_argument('--map_path', type=str, default='test/output')
     parser.add_argument('--export_scores', type=int, default=0)
     parser.add_argument('--score_path', type=str, default='test/score')
+    add_inference_args(parser)
     args = parser.parse_args()
+    engine = InferenceEngine.from_args(args)
     
     if args.embedder_weights == 'ImageNet':
         print('Use ImageNet features')
@@ -144,12 +116,12 @@ if __name__ == '__main__':
     for param in resnet.parameters():
         param.requires_grad = False
     resnet.fc = nn.Identity()
-    i_classifier = mil.IClassifier(resnet, args.feats_size, output_class=args.num_classes).cuda()
-    b_classifier = mil.BClassifier(input_size=args.feats_size, output_class=args.num_classes).cuda()
-    milnet = mil.MILNet(i_classifier, b_classifier).cuda()
+    i_classifier = mil.IClassifier(resnet, args.feats_size, output_class=args.num_classes)
+    b_classifier = mil.BClassifier(input_size=args.feats_size, output_class=args.num_classes)
+    milnet = mil.MILNet(i_classifier, b_classifier)
 
-    if args.embedder_weights !=  'ImageNet':
-        state_dict_weights = torch.load(args.embedder_weights)
+    if args.embedder_weights !=  'ImageNet' and not args.embedder_artifact:
+        state_dict_weights = engine.load(args.embedder_weights)
         new_state_dict = OrderedDict()
         for i in range(4):
             state_dict_weights.popitem()
@@ -159,12 +131,16 @@ if __name__ == '__main__':
             new_state_dict[name] = v
         i_classifier.load_state_dict(new_state_dict, strict=False)
 
-    state_dict_weights = torch.load(args.aggregator_weights) 
+    state_dict_weights = engine.load(args.aggregator_weights) 
     state_dict_weights["i_classifier.fc.weight"] = state_dict_weights["i_classifier.fc.0.weight"]
     state_dict_weights["i_classifier.fc.bias"] = state_dict_weights["i_classifier.fc.0.bias"]
     milnet.load_state_dict(state_dict_weights, strict=False)
+    if args.embedder_artifact:
+        # instance classes still come from the fc loaded with the aggregator
+        milnet.i_classifier = export_embedder.ArtifactClassifier(export_embedder.load_embedder(args.embedder_artifact, engine), i_classifier.fc)
 
-    bags_list = glob.glob(os.path.join(args.bag_path, '*'))
+    manifest = dataset_manifest.load_manifest(args.bag_path, class_level=False)
+    bags_list = manifest.bag_paths(kinds=(dataset_manifest.DIR,))
     os.makedirs(args.map_path, exist_ok=True)
     if args.export_scores:
         os.makedirs(args.score_path, exist_ok=True)
@@ -172,4 +148,8 @@ if __name__ == '__main__':
         args.class_name = ['class {}'.format(c) for c in range(args.num_classes)]
     if len(args.thres) != args.num_classes:
         raise ValueError('Number of thresholds does not match classes.')
-    test(args, bags_list, milnet)
\ No newline at end of file
+    # probed on the size of the first tile
+    first_tile = next((tiles[0] for tiles in (manifest.tiles(bag, exts=('.'+args.patch_ext,)) for bag in bags_list) if tiles), None)
+    args.batch_size = engine.batch_size(milnet.i_classifier, args.batch_size,
+                                        tile_decode.tile_size(first_tile) if first_tile else 224)
+    test(args, bags_list, engine.model(milnet), engine, manifest)
\ No newline at end of file
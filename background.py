@@ -0,0 +1,79 @@
+import numpy as np
+from skimage.util import img_as_float, img_as_ubyte
+
+# Vectorized background scores for stacks of RGB tiles (N x H x W x 3 uint8).
+# The scores reproduce the per-tile PIL / skimage code the tilers used before:
+#   edge        mean over bands of ImageStat.Stat(tile.filter(FIND_EDGES)).sum / tile_size**2
+#   saturation  mean of img_as_ubyte(rgb2hsv(tile)[..., 1])
+
+
+def edge_scores(tiles, tile_size=None):
+    """FIND_EDGES score of every tile of an N x H x W x C stack."""
+    tiles = np.asarray(tiles)
+    n, h, w, c = tiles.shape
+    if tile_size is None:
+        tile_size = h
+    x = tiles.astype(np.int16)
+    total = x.reshape(n, -1).sum(1, dtype=np.int64)
+    if h >= 3 and w >= 3:
+        # 3x3 kernel [-1 -1 -1; -1 8 -1; -1 -1 -1] clipped to uint8, PIL copies the border
+        box = x[:, :, :-2] + x[:, :, 1:-1] + x[:, :, 2:]
+        box = box[:, :-2] + box[:, 1:-1] + box[:, 2:]
+        center = x[:, 1:-1, 1:-1]
+        edge = np.clip(9*center - box, 0, 255)
+        total = total - center.reshape(n, -1).sum(1, dtype=np.int64) + edge.reshape(n, -1).sum(1, dtype=np.int64)
+    return total / c / (tile_size**2)
+
+
+_float_levels = img_as_float(np.arange(256, dtype=np.uint8))
+_max, _min = np.meshgrid(_float_levels, _float_levels, indexing='ij')
+with np.errstate(invalid='ignore', divide='ignore'):
+    _sat = (_max - _min) / _max
+_sat[_max == _min] = 0
+_sat[np.isnan(_sat)] = 0
+# saturation in uint8 for every (max, min) channel pair, same arithmetic as rgb2hsv
+SATURATION_LUT = img_as_ubyte(np.clip(_sat, 0, 1))
+del _max, _min, _sat
+
+
+def saturation_scores(tiles):
+    """Average HSV saturation (0-255) of every tile of an N x H x W x 3 stack."""
+    tiles = np.asarray(tiles)
+    n, h, w = tiles.shape[:3]
+    sat = SATURATION_LUT[tiles.max(-1), tiles.min(-1)]
+    return sat.reshape(n, -1).sum(1, dtype=np.int64) / (h * w)
+
+
+def background_scores(tiles, tile_size=None):
+    """(edge, saturation) scores of a stack of tiles."""
+    return edge_scores(tiles, tile_size), saturation_scores(tiles)
+
+
+# method -> (score function, passes threshold)
+SCORERS = {
+    'edge': (edge_scores, lambda score, t: score > t),
+    'saturation': (lambda tiles, tile_size=None: saturation_scores(tiles), lambda score, t: score >= t),
+}
+
+
+def register_scorer(name, score, accept):
+    """Add a background scorer, `score(tiles, tile_size)` returns one value per tile."""
+    SCORERS[name] = (score, accept)
+
+
+def is_foreground(tiles, method='edge', threshold=15, tile_size=None):
+    """Boolean mask of the tiles passing the background threshold.
+
+    `tiles` is a stack or a list of H x W x 3 arrays; tiles of different sizes
+    (e.g. at the slide border) are scored in one pass per size.
+    """
+    score, accept = SCORERS[method]
+    if isinstance(tiles, np.ndarray):
+        return accept(score(tiles, tile_size), threshold)
+    keep = np.zeros(len(tiles), dtype=bool)
+    groups = {}
+    for i, tile in enumerate(tiles):
+        groups.setdefault(tile.shape, []).append(i)
+    for idx in groups.values():
+        keep[idx] = accept(score(np.stack([tiles[i] for i in idx]), tile_size), threshold)
+    return keep
@@ -0,0 +1,50 @@
+import argparse
+import time
+import torch
+import torch.nn as nn
+
+from inference import InferenceEngine, BACKBONES, embedder
+
+# name -> (channels_last, bf16)
+MODES = {'fp32': (False, False), 'channels_last': (True, False), 'bf16': (False, True), 'channels_last+bf16': (True, True)}
+
+
+def run(model, engine, batch_size, batches, tile_size=224, warmup=1):
+    model = engine.model(model)
+    x = torch.rand(batch_size, 3, tile_size, tile_size)
+    with engine.context():
+        for _i in range(warmup):
+            model(engine.tensor(x))
+        start = time.time()
+        for _i in range(batches):
+            feats, _ = model(engine.tensor(x))
+            engine.numpy(feats)
+        if engine.device.type == 'cuda':
+            torch.cuda.synchronize()
+    return batch_size * batches / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Embedder patches/sec of compute_feats.py per backbone and inference mode')
+    parser.add_argument('--backbones', type=str, nargs='+', default=list(BACKBONES), help='Backbones to time [resnet18 resnet34 resnet50 resnet101]')
+    parser.add_argument('--modes', type=str, nargs='+', default=list(MODES), help='Inference modes to time [fp32 channels_last bf16 channels_last+bf16]')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to benchmark [cpu]')
+    parser.add_argument('--num_threads', type=int, default=0, help='CPU threads, 0 keeps the torch default [0]')
+    parser.add_argument('--norm_layer', type=str, default='instance', help='Normalization layer [instance|batch]')
+    parser.add_argument('--batch_size', type=int, default=32, help='Patches per batch [32]')
+    parser.add_argument('--batches', type=int, default=4, help='Timed batches per run [4]')
+    args = parser.parse_args()
+
+    norm = nn.InstanceNorm2d if args.norm_layer == 'instance' else nn.BatchNorm2d
+    print('threads %d, device %s' % (torch.get_num_threads() if args.num_threads == 0 else args.num_threads, args.device))
+    print('%-10s  %-18s  %11s' % ('backbone', 'mode', 'patches/sec'))
+    for backbone in args.backbones:
+        for mode in args.modes:
+            channels_last, bf16 = MODES[mode]
+            engine = InferenceEngine(args.device, args.num_threads, channels_last, bf16)
+            speed = run(embedder(backbone, norm), engine, args.batch_size, args.batches)
+            print('%-10s  %-18s  %11.1f' % (backbone, mode, speed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+
+from deepzoom_tiler import DeepZoomStaticTiler
+
+
+def synthetic_slide(path, size=8192, levels=4, tile=256, seed=0):
+    """Pyramidal tiled TIFF with a few noisy tissue blobs on a white background."""
+    try:
+        import tifffile
+    except ImportError:
+        raise ImportError('The synthetic slide is written with tifffile, `pip install tifffile` or pass --slide')
+    rng = np.random.default_rng(seed)
+    img = np.full((size, size, 3), 240, dtype=np.uint8)
+    yy, xx = np.ogrid[0:size, 0:size]
+    for _ in range(6):
+        cy, cx = rng.integers(0, size, 2)
+        r = rng.integers(size//10, size//4)
+        m = (yy-cy)**2 + (xx-cx)**2 < r*r
+        img[m] = (rng.integers(120, 220, (m.sum(), 3)) * np.array([1.0, 0.5, 0.9])).astype(np.uint8)
+    with tifffile.TiffWriter(path) as tif:
+        for i in range(levels):
+            tif.write(img, tile=(tile, tile), photometric='rgb', compression='deflate', subfiletype=0 if i == 0 else 1)
+            img = img[::2, ::2]
+
+
+def run(slide, levels, block_size, workers, tile_size, output, single_read=False):
+    basename = os.path.join(output, 'bench_%d_%d' % (block_size, single_read))
+    start = time.time()
+    n_tasks = DeepZoomStaticTiler(slide, basename, levels, 20, 20, 'jpeg', tile_size, 0, True, 70,
+                workers, 15, block_size=block_size, single_read=single_read).run()
+    elapsed = time.time() - start
+    n_written = sum(len(files) for _, _, files in os.walk(basename + '_files'))
+    return n_tasks, n_written, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tiles/sec of deepzoom_tiler.py, tile by tile vs. banded block reads')
+    parser.add_argument('--slide', type=str, default=None, help='Slide to tile, a synthetic pyramidal TIFF is generated (needs tifffile) if not given')
+    parser.add_argument('--size', type=int, default=8192, help='Level 0 size of the synthetic slide [8192]')
+    parser.add_argument('--workers', type=int, default=4, help='Number of TileWorkers [4]')
+    parser.add_argument('--tile_size', type=int, default=224, help='Tile size [224]')
+    parser.add_argument('--magnifications', type=int, nargs='+', default=(0,), help='Levels for patch extraction [0]')
+    parser.add_argument('--block_sizes', type=int, nargs='+', default=(1, 4, 8, 16), help='Block sizes to compare, 1 is the per-tile path [1 4 8 16]')
+    parser.add_argument('--single_read', type=int, default=0, help='Also time the single read pyramid mode, needs two magnifications (0/1) [0]')
+    args = parser.parse_args()
+
+    output = tempfile.mkdtemp(prefix='bench_tiler_')
+    try:
+        slide = args.slide
+        if slide is None:
+            slide = os.path.join(output, 'synthetic.tiff')
+            synthetic_slide(slide, args.size)
+        levels = tuple(sorted(args.magnifications))
+        print('block  single  tasks  written  seconds  tiles/sec')
+        for block_size in args.block_sizes:
+            for single_read in sorted(set([0, args.single_read])):
+                n_tasks, n_written, elapsed = run(slide, levels, block_size, args.workers, args.tile_size, output, single_read)
+                print('%5d  %6d  %5d  %7d  %7.2f  %9.1f' % (block_size, single_read, n_tasks, n_written, elapsed, n_written / elapsed))
+    finally:
+        shutil.rmtree(output, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -14,121 +14,217 @@ from PIL import Image
 from collections import OrderedDict
 from sklearn.utils import shuffle
 
+import tile_shard
+import tile_coords
+import feature_store
+import feature_cache
+import work_queue
+import tile_decode
+import export_embedder
+import dataset_manifest
+from inference import InferenceEngine, add_inference_args
 
 
-class BagDataset():
-    def __init__(self, csv_file, transform=None):
-        self.files_list = csv_file
-        self.transform = transform
-    def __len__(self):
-        return len(self.files_list)
-    def __getitem__(self, idx):
-        temp_path = self.files_list[idx]
-        img = os.path.join(temp_path)
-        img = Image.open(img)
-        sample = {'input': img}
-        
-        if self.transform:
-            sample = self.transform(sample)
-        return sample 
 
-class ToTensor(object):
-    def __call__(self, sample):
-        img = sample['input']
-        img = VF.to_tensor(img)
-        return {'input': img} 
-    
-class Compose(object):
-    def __init__(self, transforms):
-        self.transforms = transforms
+TILE_EXTS = ('.jpg', '.jpeg')
+
+def source_entries(source):
+    """(mag, col, row, ...) records of the tiles of a TileShard / TileCoords."""
+    return source.index if isinstance(source, tile_shard.TileShard) else source.coords
 
-    def __call__(self, img):
-        for t in self.transforms:
-            img = t(img)
-        return img
+def open_source(bag_path):
+    """(TileShard / TileCoords, bag name) of a shard or coordinate bag, (None, folder name) for a patch folder."""
+    if bag_path.endswith(tile_shard.SHARD_EXT):
+        return tile_shard.TileShard(bag_path), tile_shard.shard_name(bag_path)
+    if bag_path.endswith(tile_coords.COORDS_EXT):
+        return tile_coords.TileCoords(bag_path), tile_coords.coords_name(bag_path)
+    return None, bag_path.split(os.path.sep)[-1]
+
+def probe_tile_size(bags_list, manifest, magnification='single'):
+    """Size of the first tile of the dataset, the input the batch size is probed with (224 if there is none)."""
+    level = 'high' if magnification == 'tree' else magnification
+    for bag_path in bags_list:
+        source, _ = open_source(bag_path)
+        if source is not None:
+            tiles = source.select(source.magnification(level))
+        else:
+            tiles = manifest.tiles(bag_path, level, exts=TILE_EXTS)
+        if len(tiles):
+            return tile_decode.tile_size(tiles[0], source)
+    return 224
 
-def bag_dataset(args, csv_file_path):
-    transformed_dataset = BagDataset(csv_file=csv_file_path,
-                                    transform=Compose([
-                                        ToTensor()
-                                    ]))
-    dataloader = DataLoader(transformed_dataset, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers, drop_last=False)
+def tile_table(bag_path, tiles, source=None, crc32=None):
+    """Provenance columns of the feature rows, see feature_store.TILE_COLUMNS."""
+    if source is not None:
+        entries = source_entries(source)[np.asarray(tiles)]
+        cols, rows, mags = entries['col'], entries['row'], entries['mag']
+        paths = ['%d/%d_%d' % (m, c, r) for m, c, r in zip(mags, cols, rows)]
+    else:
+        positions = tile_decode.file_positions(tiles)
+        cols, rows = positions[:, 0], positions[:, 1]
+        mags = np.full(len(tiles), -1)
+        paths = [os.path.relpath(p, bag_path) for p in tiles]
+    table = {'col': np.asarray(cols, dtype=np.int32), 'row': np.asarray(rows, dtype=np.int32),
+             'mag': np.asarray(mags, dtype=np.int16), 'path': np.array(paths)}
+    if crc32 is not None:
+        table['crc32'] = np.asarray(crc32, dtype=np.uint32)
+    return table
+
+def bag_dataset(args, csv_file_path, source=None, engine=None):
+    # tiles larger than --input_size are decoded at a reduced JPEG scale
+    transformed_dataset = tile_decode.TileBatchDataset(csv_file_path, source, size=getattr(args, 'input_size', 0) or None)
+    loader_kwargs = engine.loader_kwargs(args.num_workers) if engine is not None else {}
+    dataloader = tile_decode.batch_loader(transformed_dataset, args.batch_size, args.num_workers, **loader_kwargs)
     return dataloader, len(transformed_dataset)
 
-def compute_feats(args, bags_list, i_classifier, save_path=None, magnification='single'):
-    i_classifier.eval()
-    num_bags = len(bags_list)
-    Tensor = torch.FloatTensor
-    for i in range(0, num_bags):
-        feats_list = []
-        if magnification=='single' or magnification=='low':
-            csv_file_path = glob.glob(os.path.join(bags_list[i], '*.jpg')) + glob.glob(os.path.join(bags_list[i], '*.jpeg'))
+def save_bag_feats(args, save_path, bag_path, bag_name, feats, tiles=None):
+    class_name = bag_path.split(os.path.sep)[-2]
+    ext = feature_store.CSV_EXT if args.feats_format == 'csv' else feature_store.FEATS_EXT
+    feats_path = os.path.join(save_path, class_name, bag_name+ext)
+    tiles = {'tile_'+k: v for k, v in (tiles or {}).items()}
+    return feature_store.save_bag(feats_path, np.asarray(feats), args.feats_dtype, slide=bag_path, class_name=class_name,
+                                  magnification=args.magnification, **tiles)
+
+def compute_feats(args, bags_list, i_classifier, save_path=None, magnification='single', engine=None, cache=None, queue=None, manifest=None):
+    engine = engine or InferenceEngine()
+    i_classifier = engine.model(i_classifier)
+    def bag_feats(bag_path, progress):
+        source, bag_name = open_source(bag_path)
+        if source is not None:
+            csv_file_path = source.select(source.magnification(magnification))
+        elif manifest is not None:
+            csv_file_path = manifest.tiles(bag_path, magnification, exts=TILE_EXTS)
+        elif magnification=='single' or magnification=='low':
+            csv_file_path = glob.glob(os.path.join(bag_path, '*.jpg')) + glob.glob(os.path.join(bag_path, '*.jpeg'))
         elif magnification=='high':
-            csv_file_path = glob.glob(os.path.join(bags_list[i], '*'+os.sep+'*.jpg')) + glob.glob(os.path.join(bags_list[i], '*'+os.sep+'*.jpeg'))
+            csv_file_path = glob.glob(os.path.join(bag_path, '*'+os.sep+'*.jpg')) + glob.glob(os.path.join(bag_path, '*'+os.sep+'*.jpeg'))
             print()
-        dataloader, bag_size = bag_dataset(args, csv_file_path)
-        with torch.no_grad():
-            for iteration, batch in enumerate(dataloader):
-                patches = batch['input'].float().cuda() 
-                feats, classes = i_classifier(patches)
-                feats = feats.cpu().numpy()
-                feats_list.extend(feats)
-                sys.stdout.write('\r Computed: {}/{} -- {}/{}'.format(i+1, num_bags, iteration+1, len(dataloader)))
-        if len(feats_list) == 0:
-            print('No valid patch extracted from: ' + bags_list[i])
-        else:
-            df = pd.DataFrame(feats_list)
-            os.makedirs(os.path.join(save_path, bags_list[i].split(os.path.sep)[-2]), exist_ok=True)
-            df.to_csv(os.path.join(save_path, bags_list[i].split(os.path.sep)[-2], bags_list[i].split(os.path.sep)[-1]+'.csv'), index=False, float_format='%.4f')
+        with engine.context():
+            feats, crc32 = embed_patches(args, csv_file_path, i_classifier, engine, source, cache, progress)
+        if feats is None:
+            print('No valid patch extracted from: ' + bag_path)
+            return 0
+        save_bag_feats(args, save_path, bag_path, bag_name, feats,
+                       tile_table(bag_path, csv_file_path, source, crc32))
+        return len(feats)
+    work_queue.run(bags_list, bag_feats, queue)
         
-def compute_tree_feats(args, bags_list, embedder_low, embedder_high, save_path=None):
-    embedder_low.eval()
-    embedder_high.eval()
-    num_bags = len(bags_list)
-    Tensor = torch.FloatTensor
-    with torch.no_grad():
-        for i in range(0, num_bags): 
-            low_patches = glob.glob(os.path.join(bags_list[i], '*.jpg')) + glob.glob(os.path.join(bags_list[i], '*.jpeg'))
-            feats_list = []
-            feats_tree_list = []
-            dataloader, bag_size = bag_dataset(args, low_patches)
-            for iteration, batch in enumerate(dataloader):
-                patches = batch['input'].float().cuda()
-                feats, classes = embedder_low(patches)
-                feats = feats.cpu().numpy()
-                feats_list.extend(feats)
-            for idx, low_patch in enumerate(low_patches):
-                high_folder = os.path.dirname(low_patch) + os.sep + os.path.splitext(os.path.basename(low_patch))[0]
-                high_patches = glob.glob(high_folder+os.sep+'*.jpg') + glob.glob(high_folder+os.sep+'*.jpeg')
-                if len(high_patches) == 0:
-                    pass
-                else:
-                    for high_patch in high_patches:
-                        img = Image.open(high_patch)
-                        img = VF.to_tensor(img).float().cuda()
-                        feats, classes = embedder_high(img[None, :])
-                        
-                        if args.tree_fusion == 'fusion':
-                            feats = feats.cpu().numpy()+0.25*feats_list[idx]
-                        elif args.tree_fusion == 'cat':
-                            feats = np.concatenate((feats.cpu().numpy(), feats_list[idx][None, :]), axis=-1)
-                        else:
-                            raise NotImplementedError(f"{args.tree_fusion} is not an excepted option for --tree_fusion. This argument accepts 2 options: 'fusion' and 'cat'.")
-                        
-                        feats_tree_list.extend(feats)
-                sys.stdout.write('\r Computed: {}/{} -- {}/{}'.format(i+1, num_bags, idx+1, len(low_patches)))
-            if len(feats_tree_list) == 0:
-                print('No valid patch extracted from: ' + bags_list[i])
-            else:
-                df = pd.DataFrame(feats_tree_list)
-                os.makedirs(os.path.join(save_path, bags_list[i].split(os.path.sep)[-2]), exist_ok=True)
-                df.to_csv(os.path.join(save_path, bags_list[i].split(os.path.sep)[-2], bags_list[i].split(os.path.sep)[-1]+'.csv'), index=False, float_format='%.4f')
-            print('\n')            
+def source_tree_patches(source):
+    """tree_patches of a TileShard / TileCoords, as tile indices.
+    The children of low tile (c, r) are the high tiles (c*f .. c*f+f-1, r*f .. r*f+f-1), f = high / low magnification."""
+    low_mag, high_mag = source.magnification('low'), source.magnification('high')
+    low_patches, high_patches = source.select(low_mag), source.select(high_mag)
+    if low_mag == high_mag:
+        return low_patches, np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    entries = source_entries(source)
+    factor = high_mag // low_mag
+    low_ids = {(c, r): idx for idx, (c, r) in enumerate(zip(entries['col'][low_patches].tolist(), entries['row'][low_patches].tolist()))}
+    parents = np.array([low_ids.get((c//factor, r//factor), -1) for c, r in
+                        zip(entries['col'][high_patches].tolist(), entries['row'][high_patches].tolist())], dtype=np.int64)
+    # children grouped under their parent, in the order of the low tiles
+    order = np.argsort(parents, kind='stable')
+    order = order[parents[order] >= 0]
+    return low_patches, high_patches[order], parents[order]
+
+def tree_patches(bag_path, manifest=None, source=None):
+    """Low magnification patches of a pyramid bag, their high magnification children and the parent index of every child."""
+    if source is not None:
+        return source_tree_patches(source)
+    if manifest is not None:
+        low_patches, high_patches = manifest.tiles(bag_path, 'low', TILE_EXTS), manifest.tiles(bag_path, 'high', TILE_EXTS)
+    else:
+        low_patches = [p for ext in TILE_EXTS for p in glob.glob(os.path.join(bag_path, '*'+ext))]
+        high_patches = [p for ext in TILE_EXTS for p in glob.glob(os.path.join(bag_path, '*', '*'+ext))]
+    # children: `<bag>/<low tile>/<col>_<row>.jpg`
+    children = {}
+    for p in high_patches:
+        children.setdefault(os.path.dirname(p), []).append(p)
+    high_patches = []
+    parents = []
+    for idx, low_patch in enumerate(low_patches):
+        kids = children.get(os.path.splitext(low_patch)[0], [])
+        high_patches.extend(kids)
+        parents.extend([idx]*len(kids))
+    return low_patches, high_patches, np.asarray(parents, dtype=np.int64)
+
+def load_simclr_weights(i_classifier, state_dict_weights):
+    """Load the backbone of a SimCLR checkpoint into an IClassifier, returns the state dict loaded.
+    The last 4 entries (projection head) are dropped; the `fc` of the IClassifier keeps its initial weights."""
+    state_dict_weights = OrderedDict(state_dict_weights)
+    for i in range(4):
+        state_dict_weights.popitem()
+    state_dict_init = i_classifier.state_dict()
+    new_state_dict = OrderedDict()
+    for (k, v), (k_0, v_0) in zip(state_dict_weights.items(), state_dict_init.items()):
+        name = k_0
+        new_state_dict[name] = v
+    i_classifier.load_state_dict(new_state_dict, strict=False)
+    return new_state_dict
+
+def embed_patches(args, patches, embedder, engine, source=None, cache=None, progress=''):
+    """(N x D features, CRC32) of the patches, only the ones missing from the feature cache are embedded."""
+    n = len(patches)
+    if n == 0:
+        return None, np.zeros(0, dtype=np.uint32)
+    todo = np.arange(n)
+    if cache is not None:
+        keys = feature_cache.tile_keys(patches, source)
+        cached, crc32, hit = cache.get(keys)
+        todo = np.flatnonzero(~hit)
+    feats_list = []
+    crc_list = []
+    if len(todo) > 0:
+        todo_patches = np.asarray(patches)[todo] if source is not None else [patches[j] for j in todo]
+        dataloader, bag_size = bag_dataset(args, todo_patches, source, engine)
+        for iteration, batch in enumerate(dataloader):
+            feats, classes = engine.run(embedder, engine.tensor(batch['input']))
+            feats_list.append(engine.numpy(feats))
+            crc_list.extend(batch['crc32'].tolist())
+            sys.stdout.write('\r Computed: {} -- {}/{}'.format(progress, iteration+1, len(dataloader)))
+    if cache is None:
+        return np.concatenate(feats_list), np.asarray(crc_list, dtype=np.uint32)
+    if len(todo) > 0:
+        computed = np.concatenate(feats_list)
+        cache.put([keys[j] for j in todo], computed, crc_list)
+        for j, f, c in zip(todo, computed, crc_list):
+            cached[j], crc32[j] = f, c
+    sys.stdout.write('\r Computed: {} -- {} cached, {} embedded'.format(progress, n-len(todo), len(todo)))
+    return np.stack(cached), crc32
+
+def compute_tree_feats(args, bags_list, embedder_low, embedder_high, save_path=None, engine=None, cache_low=None, cache_high=None, queue=None, manifest=None):
+    if args.tree_fusion not in ('fusion', 'cat'):
+        raise NotImplementedError(f"{args.tree_fusion} is not an excepted option for --tree_fusion. This argument accepts 2 options: 'fusion' and 'cat'.")
+    engine = engine or InferenceEngine()
+    embedder_low = engine.model(embedder_low)
+    embedder_high = engine.model(embedder_high)
+    def bag_feats(bag_path, progress):
+        source, bag_name = open_source(bag_path)
+        low_patches, high_patches, parents = tree_patches(bag_path, manifest, source)
+        if len(high_patches) == 0:
+            print('No valid patch extracted from: ' + bag_path)
+            return 0
+        # only the low patches with children are embedded
+        has_children = np.unique(parents)
+        with engine.context():
+            feats_low, _ = embed_patches(args, [low_patches[j] for j in has_children], embedder_low, engine,
+                                         source, cache_low, progress+' low')
+            feats_high, tree_crc = embed_patches(args, high_patches, embedder_high, engine,
+                                                 source, cache_high, progress+' high')
+        feats_parent = feats_low[np.searchsorted(has_children, parents)]
+        if args.tree_fusion == 'fusion':
+            feats_tree = feats_high + 0.25*feats_parent
+        else:
+            feats_tree = np.concatenate((feats_high, feats_parent), axis=-1)
+        save_bag_feats(args, save_path, bag_path, bag_name, feats_tree,
+                       tile_table(bag_path, high_patches, source, tree_crc))
+        print('\n')            
+        return len(high_patches) + len(has_children)
+    work_queue.run(bags_list, bag_feats, queue)
 
 def main():
     parser = argparse.ArgumentParser(description='Compute TCGA features from SimCLR embedder')
     parser.add_argument('--num_classes', default=2, type=int, help='Number of output classes [2]')
-    parser.add_argument('--batch_size', default=128, type=int, help='Batch size of dataloader [128]')
+    parser.add_argument('--batch_size', default=0, type=int, help='Batch size of dataloader, 0 probes the largest batch fitting in --memory_budget [0]')
     parser.add_argument('--num_workers', default=4, type=int, help='Number of threads for datalodaer')
     parser.add_argument('--gpu_index', type=int, nargs='+', default=(0,), help='GPU ID(s) [0]')
     parser.add_argument('--backbone', default='resnet18', type=str, help='Embedder backbone [resnet18]')
@@ -139,9 +235,29 @@ def main():
     parser.add_argument('--weights_low', default=None, type=str, help='Folder of the pretrained weights of low magnification, FOLDER <`simclr/runs/[FOLDER]`')
     parser.add_argument('--tree_fusion', default='cat', type=str, help='Fusion method for high and low mag features in a tree method [cat|fusion]')
     parser.add_argument('--dataset', default='TCGA-lung-single', type=str, help='Dataset folder name [TCGA-lung-single]')
+    parser.add_argument('--feats_format', default='npy', type=str, help='Bag feature files, binary feature store or legacy text [npy|csv]')
+    parser.add_argument('--feats_dtype', default='float32', type=str, help='Precision of the stored features with --feats_format=npy, float16 halves the size with a relative error up to 5e-4 [float32|float16]')
+    parser.add_argument('--embedder_artifact', default='', type=str, help='TorchScript / ONNX embedder written by export_embedder.py, used instead of --weights [disabled]')
+    parser.add_argument('--embedder_artifact_high', default='', type=str, help='Exported embedder of high magnification, used instead of --weights_high with `tree` [disabled]')
+    parser.add_argument('--embedder_artifact_low', default='', type=str, help='Exported embedder of low magnification, used instead of --weights_low with `tree` [disabled]')
+    parser.add_argument('--input_size', default=0, type=int, help='Embedder input size, larger tiles are decoded at a reduced JPEG scale and resized, 0 keeps the tile size [0]')
+    parser.add_argument('--feature_cache', default='', type=str, help='SQLite tile feature cache, re-runs only embed the tiles missing from it, e.g. embedder/feature_cache.sqlite [disabled]')
+    parser.add_argument('--cache_size', default=20, type=float, help='Size limit of the feature cache in GB, least recently used tiles are evicted [20]')
+    parser.add_argument('--scan_workers', default=16, type=int, help='Parallel folder scans when refreshing the dataset manifest [16]')
+    parser.add_argument('--queue', default='', type=str, help='Shared SQLite bag queue; start one compute_feats.py per worker, on any host, with the same --queue to split the bags, e.g. datasets/<dataset>/work_queue.sqlite [disabled]')
+    parser.add_argument('--claim_timeout', default=6, type=float, help='Hours after which a bag claimed by a worker that did not finish it is claimed again [6]')
+    add_inference_args(parser)
     args = parser.parse_args()
+    if args.magnification == 'tree':
+        if args.embedder_artifact:
+            parser.error('use --embedder_artifact_high and --embedder_artifact_low with --magnification=tree')
+        if bool(args.embedder_artifact_high) != bool(args.embedder_artifact_low):
+            parser.error('--magnification=tree needs both --embedder_artifact_high and --embedder_artifact_low')
+    elif args.embedder_artifact_high or args.embedder_artifact_low:
+        parser.error('--embedder_artifact_high/--embedder_artifact_low are only used with --magnification=tree, use --embedder_artifact')
     gpu_ids = tuple(args.gpu_index)
     os.environ['CUDA_VISIBLE_DEVICES']=','.join(str(x) for x in gpu_ids)
+    engine = InferenceEngine.from_args(args)
 
     if args.norm_layer == 'instance':
         norm=nn.InstanceNorm2d
@@ -169,9 +285,16 @@ def main():
         param.requires_grad = False
     resnet.fc = nn.Identity()
     
-    if args.magnification == 'tree' and args.weights_high != None and args.weights_low != None:
-        i_classifier_h = mil.IClassifier(resnet, num_feats, output_class=args.num_classes).cuda()
-        i_classifier_l = mil.IClassifier(copy.deepcopy(resnet), num_feats, output_class=args.num_classes).cuda()
+    if args.embedder_artifact:
+        i_classifier = export_embedder.load_embedder(args.embedder_artifact, engine)
+        print('Use exported embedder ' + args.embedder_artifact)
+    elif args.embedder_artifact_high:
+        i_classifier_h = export_embedder.load_embedder(args.embedder_artifact_high, engine)
+        i_classifier_l = export_embedder.load_embedder(args.embedder_artifact_low, engine)
+        print('Use exported embedders ' + args.embedder_artifact_high + ', ' + args.embedder_artifact_low)
+    elif args.magnification == 'tree' and args.weights_high != None and args.weights_low != None:
+        i_classifier_h = mil.IClassifier(resnet, num_feats, output_class=args.num_classes)
+        i_classifier_l = mil.IClassifier(copy.deepcopy(resnet), num_feats, output_class=args.num_classes)
         
         if args.weights_high == 'ImageNet' or args.weights_low == 'ImageNet' or args.weights== 'ImageNet':
             if args.norm_layer == 'batch':
@@ -180,35 +303,21 @@ def main():
                 raise ValueError('Please use batch normalization for ImageNet feature')
         else:
             weight_path = os.path.join('simclr', 'runs', args.weights_high, 'checkpoints', 'model.pth')
-            state_dict_weights = torch.load(weight_path)
-            for i in range(4):
-                state_dict_weights.popitem()
-            state_dict_init = i_classifier_h.state_dict()
-            new_state_dict = OrderedDict()
-            for (k, v), (k_0, v_0) in zip(state_dict_weights.items(), state_dict_init.items()):
-                name = k_0
-                new_state_dict[name] = v
-            i_classifier_h.load_state_dict(new_state_dict, strict=False)
+            state_dict_weights = engine.load(weight_path)
+            new_state_dict = load_simclr_weights(i_classifier_h, state_dict_weights)
             os.makedirs(os.path.join('embedder', args.dataset), exist_ok=True)
             torch.save(new_state_dict, os.path.join('embedder', args.dataset, 'embedder-high.pth'))
 
             weight_path = os.path.join('simclr', 'runs', args.weights_low, 'checkpoints', 'model.pth')
-            state_dict_weights = torch.load(weight_path)
-            for i in range(4):
-                state_dict_weights.popitem()
-            state_dict_init = i_classifier_l.state_dict()
-            new_state_dict = OrderedDict()
-            for (k, v), (k_0, v_0) in zip(state_dict_weights.items(), state_dict_init.items()):
-                name = k_0
-                new_state_dict[name] = v
-            i_classifier_l.load_state_dict(new_state_dict, strict=False)
+            state_dict_weights = engine.load(weight_path)
+            new_state_dict = load_simclr_weights(i_classifier_l, state_dict_weights)
             os.makedirs(os.path.join('embedder', args.dataset), exist_ok=True)
             torch.save(new_state_dict, os.path.join('embedder', args.dataset, 'embedder-low.pth'))
             print('Use pretrained features.')
 
 
     elif args.magnification == 'single' or args.magnification == 'high' or args.magnification == 'low':  
-        i_classifier = mil.IClassifier(resnet, num_feats, output_class=args.num_classes).cuda()
+        i_classifier = mil.IClassifier(resnet, num_feats, output_class=args.num_classes)
 
         if args.weights == 'ImageNet':
             if args.norm_layer == 'batch':
@@ -220,37 +329,61 @@ def main():
                 weight_path = os.path.join('simclr', 'runs', args.weights, 'checkpoints', 'model.pth')
             else:
                 weight_path = glob.glob('simclr/runs/*/checkpoints/*.pth')[-1]
-            state_dict_weights = torch.load(weight_path)
-            for i in range(4):
-                state_dict_weights.popitem()
-            state_dict_init = i_classifier.state_dict()
-            new_state_dict = OrderedDict()
-            for (k, v), (k_0, v_0) in zip(state_dict_weights.items(), state_dict_init.items()):
-                name = k_0
-                new_state_dict[name] = v
-            i_classifier.load_state_dict(new_state_dict, strict=False)
+            state_dict_weights = engine.load(weight_path)
+            new_state_dict = load_simclr_weights(i_classifier, state_dict_weights)
             os.makedirs(os.path.join('embedder', args.dataset), exist_ok=True)
             torch.save(new_state_dict, os.path.join('embedder', args.dataset, 'embedder.pth'))
             print('Use pretrained features.')
     
     if args.magnification == 'tree' or args.magnification == 'low' or args.magnification == 'high' :
-        bags_path = os.path.join('WSI', args.dataset, 'pyramid', '*', '*')
+        bags_root = os.path.join('WSI', args.dataset, 'pyramid')
     else:
-        bags_path = os.path.join('WSI', args.dataset, 'single', '*', '*')
+        bags_root = os.path.join('WSI', args.dataset, 'single')
     feats_path = os.path.join('datasets', args.dataset)
         
     os.makedirs(feats_path, exist_ok=True)
-    bags_list = glob.glob(bags_path)
+    manifest = dataset_manifest.load_manifest(bags_root, workers=args.scan_workers)
+    bags_list = manifest.bag_paths()
+    
+    args.batch_size = engine.batch_size(i_classifier_h if args.magnification == 'tree' else i_classifier,
+                                        args.batch_size, args.input_size or probe_tile_size(bags_list, manifest, args.magnification))
+    queue = None
+    if args.queue:
+        queue = work_queue.WorkQueue(args.queue, claim_timeout=args.claim_timeout*3600)
+    cache = None
+    if args.feature_cache:
+        cache = feature_cache.FeatureCache(args.feature_cache, int(args.cache_size * 2**30))
+        def embedder_cache(model, weights, artifact=''):
+            precision = ('bf16' if engine.bf16 else 'fp32') + ('/{}'.format(args.input_size) if args.input_size else '')
+            if artifact:
+                # exported embedders are identified by the artifact file
+                with open(artifact, 'rb') as f:
+                    key = feature_cache.bytes_key(f.read() + precision.encode()).hex()
+                return cache.embedder(key, args.backbone, args.norm_layer, artifact)
+            key = feature_cache.embedder_key(model, args.backbone, args.norm_layer, precision)
+            return cache.embedder(key, args.backbone, args.norm_layer, weights)
     
     if args.magnification == 'tree':
-        compute_tree_feats(args, bags_list, i_classifier_l, i_classifier_h, feats_path)
+        cache_low = embedder_cache(i_classifier_l, args.weights_low, args.embedder_artifact_low) if cache else None
+        cache_high = embedder_cache(i_classifier_h, args.weights_high, args.embedder_artifact_high) if cache else None
+        compute_tree_feats(args, bags_list, i_classifier_l, i_classifier_h, feats_path, engine, cache_low, cache_high, queue, manifest)
     else:
-        compute_feats(args, bags_list, i_classifier, feats_path, args.magnification)
-    n_classes = glob.glob(os.path.join('datasets', args.dataset, '*'+os.path.sep))
-    n_classes = sorted(n_classes)
+        compute_feats(args, bags_list, i_classifier, feats_path, args.magnification, engine,
+                      embedder_cache(i_classifier, args.weights, args.embedder_artifact) if cache else None, queue, manifest)
+    if cache is not None:
+        cache.close()
+    if queue is not None:
+        complete = queue.complete()
+        queue.close()
+        if not complete:
+            # the bag lists are written by the worker finishing the last bag
+            return
+    # bag lists of the classes with features, restricted to the bags of the manifest
+    n_classes = [os.path.join('datasets', args.dataset, c) for c in manifest.classes if os.path.isdir(os.path.join('datasets', args.dataset, c))]
     all_df = []
     for i, item in enumerate(n_classes):
-        bag_csvs = glob.glob(os.path.join(item, '*.csv'))
+        bag_names = set(dataset_manifest.bag_name(b) for b in manifest.bag_paths(os.path.basename(item)))
+        bag_csvs = [b for b in feature_store.list_bags(item) if feature_store.bag_name(b) in bag_names]
         bag_df = pd.DataFrame(bag_csvs)
         bag_df['label'] = i
         bag_df.to_csv(os.path.join('datasets', args.dataset, item.split(os.path.sep)[2]+'.csv'), index=False)
@@ -0,0 +1,243 @@
+import os
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+import tile_shard
+import tile_coords
+import feature_store
+
+# Bags and tiles of a tiled dataset folder (e.g. WSI/<dataset>/single), so
+# the scripts do not glob millions of tiles on every run. Layout:
+#   <root>/<class>/<bag>/<tile>.jpeg              single / low magnification
+#   <root>/<class>/<bag>/<low tile>/<tile>.jpeg   high magnification (pyramid)
+#   <root>/<class>/<bag>.tar, <bag>.coords.npz    shards / coordinate files
+# or <root>/<bag>/... without the class level (test folders).
+# The manifest is one `dataset_manifest.npz` in the root with the bags
+# (class, kind, tile range, directory mtimes) and every tile path relative
+# to its bag, and is refreshed by re-listing only the directories whose
+# mtime changed since the last scan.
+MANIFEST_NAME = 'dataset_manifest.npz'
+TILE_EXTS = ('.jpg', '.jpeg', '.png')
+# kind of a bag
+DIR, SHARD, COORDS = 'dir', 'shard', 'coords'
+
+
+def manifest_path(root):
+    return os.path.join(root, MANIFEST_NAME)
+
+
+def bag_kind(path, is_dir):
+    if is_dir:
+        return DIR
+    if path.endswith(tile_shard.SHARD_EXT):
+        return SHARD
+    if path.endswith(tile_coords.COORDS_EXT):
+        return COORDS
+    return None
+
+
+def bag_name(bag_path):
+    name = os.path.basename(bag_path)
+    for ext in (tile_shard.SHARD_EXT, tile_coords.COORDS_EXT):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def _is_tile(name):
+    return name.lower().endswith(TILE_EXTS)
+
+
+def scan_bag(path):
+    """(relative tile paths, mtime of the bag folder, max mtime of its child folders) of a bag folder."""
+    tiles, children = [], []
+    with os.scandir(path) as entries:
+        for e in entries:
+            if e.is_dir():
+                children.append(e.name)
+            elif _is_tile(e.name):
+                tiles.append(e.name)
+    child_mtime = 0.0
+    for child in children:
+        child_path = os.path.join(path, child)
+        child_mtime = max(child_mtime, os.stat(child_path).st_mtime)
+        with os.scandir(child_path) as entries:
+            tiles.extend(child + '/' + e.name for e in entries if _is_tile(e.name))
+    return sorted(tiles), os.stat(path).st_mtime, child_mtime
+
+
+def _child_mtime(path, tiles):
+    children = set(t.split('/')[0] for t in tiles if '/' in t)
+    return max([os.stat(os.path.join(path, c)).st_mtime for c in children] or [0.0])
+
+
+def _list_bags(folder):
+    bags = []
+    with os.scandir(folder) as entries:
+        for e in entries:
+            kind = bag_kind(e.name, e.is_dir())
+            if kind is not None:
+                bags.append((e.name, kind))
+    return sorted(bags)
+
+
+class DatasetManifest(object):
+    """Bag and tile lists of a dataset folder."""
+
+    def __init__(self, root, bags=None, folders=None):
+        self.root = root
+        # bag -> {'class', 'kind', 'mtime', 'child_mtime', 'tiles'}
+        self.bags = bags or {}
+        # listed folder (root or class, relative to root) -> mtime
+        self.folders = folders or {}
+
+    @classmethod
+    def load(cls, root):
+        path = manifest_path(root)
+        if not os.path.exists(path):
+            return cls(root)
+        with np.load(path) as data:
+            bags, offsets, tiles = data['bags'], data['offsets'], data['tiles']
+            folders = dict(zip(data['folders'].tolist(), data['folder_mtimes'].tolist()))
+        tiles = np.char.decode(tiles, 'utf-8').tolist() if len(tiles) else []
+        entries = {}
+        for i, b in enumerate(bags):
+            entries[str(b['bag'])] = {'class': str(b['class']), 'kind': str(b['kind']), 'mtime': float(b['mtime']),
+                                      'child_mtime': float(b['child_mtime']), 'tiles': tiles[offsets[i]:offsets[i+1]]}
+        return cls(root, entries, folders=folders)
+
+    def save(self):
+        names = sorted(self.bags)
+        tiles = [t for n in names for t in self.bags[n]['tiles']]
+        offsets = np.cumsum([0] + [len(self.bags[n]['tiles']) for n in names]).astype(np.int64)
+        bags = np.array([(n, self.bags[n]['class'], self.bags[n]['kind'], self.bags[n]['mtime'], self.bags[n]['child_mtime'])
+                         for n in names],
+                        dtype=[('bag', 'U{}'.format(max([len(n) for n in names] or [1]))),
+                               ('class', 'U{}'.format(max([len(self.bags[n]['class']) for n in names] or [1]))),
+                               ('kind', 'U6'), ('mtime', 'f8'), ('child_mtime', 'f8')])
+        folders = sorted(self.folders)
+        # several workers refresh the manifest at start up
+        feature_store._replace(manifest_path(self.root), lambda f: np.savez(
+            f, bags=bags, offsets=offsets, tiles=np.array([t.encode() for t in tiles], dtype=bytes),
+            folders=np.array(folders, dtype=str), folder_mtimes=np.array([self.folders[k] for k in folders], dtype='f8')))
+
+    def _unchanged(self, bag, kind):
+        entry = self.bags.get(bag)
+        if entry is None or entry['kind'] != kind:
+            return False
+        path = os.path.join(self.root, bag)
+        try:
+            if os.stat(path).st_mtime != entry['mtime']:
+                return False
+            return kind != DIR or _child_mtime(path, entry['tiles']) == entry['child_mtime']
+        except OSError:
+            return False
+
+    def refresh(self, class_level=True, workers=16):
+        """Rescan the folders and bags modified since the last scan, returns the number of bags rescanned."""
+        folders = {}
+        listed = {}
+        class_dirs = ['']
+        if class_level:
+            with os.scandir(self.root) as entries:
+                class_dirs = sorted(e.name for e in entries if e.is_dir())
+        for folder in class_dirs:
+            if not folder:
+                # the root holds the manifest itself, its mtime changes on every save
+                listed[folder] = _list_bags(self.root)
+                continue
+            mtime = os.stat(os.path.join(self.root, folder)).st_mtime
+            folders[folder] = mtime
+            if self.folders.get(folder) == mtime:
+                listed[folder] = sorted((b.split('/')[-1], e['kind']) for b, e in self.bags.items() if e['class'] == folder)
+            else:
+                listed[folder] = _list_bags(os.path.join(self.root, folder))
+        bags = {}
+        todo = []
+        for folder, entries in listed.items():
+            for name, kind in entries:
+                bag = folder + '/' + name if folder else name
+                if self._unchanged(bag, kind):
+                    bags[bag] = self.bags[bag]
+                else:
+                    todo.append((bag, folder, kind))
+
+        def scan(item):
+            bag, folder, kind = item
+            path = os.path.join(self.root, bag)
+            if kind == DIR:
+                tiles, mtime, child_mtime = scan_bag(path)
+            else:
+                tiles, mtime, child_mtime = [], os.stat(path).st_mtime, 0.0
+            return bag, {'class': folder, 'kind': kind, 'mtime': mtime, 'child_mtime': child_mtime, 'tiles': tiles}
+
+        with ThreadPoolExecutor(max(1, workers)) as executor:
+            bags.update(executor.map(scan, todo))
+        changed = len(todo) > 0 or set(bags) != set(self.bags) or folders != self.folders
+        self.bags, self.folders = bags, folders
+        if changed:
+            try:
+                self.save()
+            except OSError:
+                # read-only dataset, the manifest is rebuilt in memory next time
+                pass
+        return len(todo)
+
+    @property
+    def classes(self):
+        return sorted(set(e['class'] for e in self.bags.values()))
+
+    def bag_paths(self, class_name=None, kinds=None):
+        """Full paths of the bags, of one class and / or of the given kinds."""
+        return [os.path.join(self.root, *bag.split('/')) for bag, e in sorted(self.bags.items())
+                if (class_name is None or e['class'] == class_name) and (kinds is None or e['kind'] in kinds)]
+
+    def _entry(self, bag_path):
+        return self.bags[os.path.relpath(bag_path, self.root).replace(os.sep, '/')]
+
+    def tiles(self, bag_path, level='single', exts=None):
+        """Full tile paths of a bag folder: `single` / `low` top level tiles, `high` nested tiles, or `all`."""
+        tiles = self._entry(bag_path)['tiles']
+        if level in ('single', 'low'):
+            tiles = [t for t in tiles if '/' not in t]
+        elif level == 'high':
+            tiles = [t for t in tiles if '/' in t]
+        if exts is not None:
+            tiles = [t for t in tiles if t.lower().endswith(tuple(exts))]
+        return [os.path.join(bag_path, *t.split('/')) for t in tiles]
+
+    def counts(self):
+        """{class: (bags, tiles)}"""
+        counts = {}
+        for e in self.bags.values():
+            n_bags, n_tiles = counts.get(e['class'], (0, 0))
+            counts[e['class']] = (n_bags + 1, n_tiles + len(e['tiles']))
+        return counts
+
+
+def load_manifest(root, class_level=True, workers=16):
+    """Manifest of a dataset folder, refreshed from the directory mtimes."""
+    manifest = DatasetManifest.load(root)
+    manifest.refresh(class_level, workers)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or refresh the bag / tile manifest of a tiled dataset folder')
+    parser.add_argument('--root', default=None, type=str, help='Dataset folder [WSI/<dataset>/<single|pyramid>]')
+    parser.add_argument('--dataset', default='TCGA-lung-single', type=str, help='Dataset folder name [TCGA-lung-single]')
+    parser.add_argument('--layout', default='single', type=str, help='Tiling layout when --root is not given [single|pyramid]')
+    parser.add_argument('--class_level', default=1, type=int, help='Bags are grouped in class folders (0/1) [1]')
+    parser.add_argument('--workers', default=16, type=int, help='Parallel folder scans [16]')
+    args = parser.parse_args()
+    root = args.root or os.path.join('WSI', args.dataset, args.layout)
+    manifest = DatasetManifest.load(root)
+    n_scanned = manifest.refresh(args.class_level, args.workers)
+    print('{}: {} bags rescanned'.format(manifest_path(root), n_scanned))
+    for class_name, (n_bags, n_tiles) in sorted(manifest.counts().items()):
+        print('  {:<24} {:>6} bags {:>10} tiles'.format(class_name or '.', n_bags, n_tiles))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,8 @@
 import json
-from multiprocessing import Process, JoinableQueue
+from multiprocessing import Process, JoinableQueue, Queue
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import tempfile
 import argparse
 import os
 import re
@@ -13,7 +16,7 @@ from skimage import io
 from skimage.color import rgb2hsv
 from skimage.util import img_as_ubyte
 from skimage import filters
-from PIL import Image, ImageFilter, ImageStat
+from PIL import Image
 
 Image.MAX_IMAGE_PIXELS = None
 
@@ -21,102 +24,284 @@ import openslide
 from openslide import open_slide, ImageSlide
 from openslide.deepzoom import DeepZoomGenerator
 
+import background
+import tissue_mask
+import tile_shard
+import tile_coords
+import tile_manifest
+
 VIEWER_SLIDE_NAME = 'slide'
 
 class TileWorker(Process):
-    """A child process that generates and writes tiles."""
+    """A child process that generates and writes tiles.
+
+    A task is a rectangular block of tiles of one DeepZoom level: the block is
+    read with a single read_region and cut into tiles with NumPy slicing, and
+    only the tiles marked in the block's `todo` mask are scored and written.
+    Every task names its slide, so one pool of workers can serve several
+    slides. With a `results` queue each task is acknowledged with
+    `('block', slidepath, records)`, where `records` holds the tile_coords
+    records of the accepted tiles in coordinate-only mode (tiledir None).
+    A pyramid task carries (low, high) pairs of levels, todo masks, mags and
+    tiledirs, and makes both magnifications from one read (see
+    DeepZoomImageTiler single_read).
+    """
 
-    def __init__(self, queue, slidepath, tile_size, overlap, limit_bounds,
-                quality, threshold):
+    def __init__(self, queue, tile_size, overlap, limit_bounds,
+                quality, threshold, results=None, max_open_slides=4):
         Process.__init__(self, name='TileWorker')
         self.daemon = True
         self._queue = queue
-        self._slidepath = slidepath
+        self._results = results
         self._tile_size = tile_size
         self._overlap = overlap
         self._limit_bounds = limit_bounds
         self._quality = quality
         self._threshold = threshold
-        self._slide = None
+        self._max_open_slides = max_open_slides
+        self._slides = {}
+        self._dzs = {}
 
     def run(self):
-        self._slide = open_slide(self._slidepath)
-        last_associated = None
-        dz = self._get_dz()
         while True:
             data = self._queue.get()
             if data is None:
                 self._queue.task_done()
                 break
-            associated, level, address, outfile = data
-            if last_associated != associated:
-                dz = self._get_dz(associated)
-                last_associated = associated
+            slidepath, associated, level, origin, todo, mag, tiledir, ext = data
+            records = []
             try:
-                tile = dz.get_tile(level, address)
-                edge = tile.filter(ImageFilter.FIND_EDGES)
-                edge = ImageStat.Stat(edge).sum
-                edge = np.mean(edge)/(self._tile_size**2)
-                w, h = tile.size
-                if edge > self._threshold:
-                    if not (w==self._tile_size and h==self._tile_size):
-                        tile = tile.resize((self._tile_size, self._tile_size))
-                    tile.save(outfile, quality=self._quality)
+                image, dz = self._get_dz(slidepath, associated)
+                if isinstance(level, tuple):
+                    accepted = self._pyramid_tiles(image, dz, level, origin, todo, mag, tiledir)
+                else:
+                    tiles = self._foreground(list(self._tiles(image, dz, level, origin, todo)))
+                    accepted = [(level, mag, tiledir, address, tile) for address, tile in tiles]
+                for level, mag, tiledir, address, tile in accepted:
+                    try:
+                        if tiledir is None:
+                            records.append(tile_coords.tile_record(dz, mag, level, address))
+                        else:
+                            tile = Image.fromarray(tile)
+                            if tile.size != (self._tile_size, self._tile_size):
+                                tile = tile.resize((self._tile_size, self._tile_size))
+                            tile.save(os.path.join(tiledir, '%d_%d.%s' % (address[0], address[1], ext)), quality=self._quality)
+                    except:
+                        pass
             except:
                 pass
+            if self._results is not None:
+                self._results.put(('block', slidepath, records))
             self._queue.task_done()
-            
 
-    def _get_dz(self, associated=None):
+    def _foreground(self, tiles):
+        """Keep the (address, tile) pairs passing the background threshold."""
+        keep = background.is_foreground([tile for _, tile in tiles], 'edge', self._threshold, self._tile_size)
+        return [t for t, accepted in zip(tiles, keep) if accepted]
+
+    def _tiles(self, image, dz, level, origin, todo):
+        """Yield ((col, row), RGB array) for the tiles of a block marked in `todo`."""
+        col0, row0 = origin
+        rows, cols = todo.shape
+        if self._overlap or todo.size == 1:
+            for r, c in np.argwhere(todo):
+                address = (col0+int(c), row0+int(r))
+                yield address, np.asarray(dz.get_tile(level, address))
+            return
+        block = self._read_block(image, dz, level, col0, row0, cols, rows)
+        for r, c in np.argwhere(todo):
+            yield self._crop_tile(block, image, dz, level, (col0+int(c), row0+int(r)))
+
+    def _crop_tile(self, block, image, dz, level, address):
+        """Tile `address` cut from a block of _read_block, same pixels as get_tile.
+
+        The tile is cropped at the read_region arguments of get_tile relative
+        to the block origin. read_region resamples when its level 0 location
+        is not a whole pixel of the slide level, so tiles (or blocks) off the
+        slide level grid, e.g. on a level downsampled 3.996x, come from
+        get_tile instead.
+        """
+        pixels, (x0, y0), slide_level = block
+        (x, y), tile_level, (lw, lh) = dz.get_tile_coordinates(level, address)
+        ds = image.level_downsamples[slide_level]
+        if tile_level != slide_level or not float(ds).is_integer() or not all(float(v / ds).is_integer() for v in (x, y, x0, y0)):
+            return address, np.asarray(dz.get_tile(level, address))
+        lx, ly = int((x - x0) / ds), int((y - y0) / ds)
+        tile = Image.fromarray(pixels[ly:ly+lh, lx:lx+lw])
+        z_size = dz.get_tile_dimensions(level, address)
+        if tile.size != z_size:
+            tile.thumbnail(z_size, getattr(Image, 'Resampling', Image).LANCZOS)
+        return address, np.asarray(tile)
+
+    def _pyramid_tiles(self, image, dz, levels, origin, todo, mags, tiledirs):
+        """Low and high magnification tiles of a block from a single read.
+
+        The block is read once at the high magnification level; the low
+        magnification (parent) tiles are cut from its downsampled copy and
+        only the children of accepted parents are cropped and scored. Children
+        come first in the result so a written parent implies its children.
+        """
+        low_level, high_level = levels
+        low_todo, high_todo = todo
+        # a bag folder (str) for the nested pyramid layout, else one tile directory per magnification
+        nested = isinstance(tiledirs, str)
+        low_dir, high_dir = (tiledirs, None) if nested else (tiledirs or (None, None))
+        ts = self._tile_size
+        f = 2**(high_level-low_level)
+        col0, row0 = origin
+        rows, cols = low_todo.shape
+        high_origin = (col0*f, row0*f)
+        high_rows, high_cols = high_todo.shape
+        block = self._read_block(image, dz, high_level, high_origin[0], high_origin[1], high_cols, high_rows)
+        z_w, z_h = dz.level_dimensions[low_level]
+        low_size = (min((col0+cols)*ts, z_w) - col0*ts, min((row0+rows)*ts, z_h) - row0*ts)
+        low_block = np.asarray(Image.fromarray(block[0]).resize(low_size, getattr(Image, 'Resampling', Image).LANCZOS))
+        parents = self._foreground([((col0+int(c), row0+int(r)), low_block[r*ts:(r+1)*ts, c*ts:(c+1)*ts])
+                                    for r, c in np.argwhere(low_todo)])
+        children = []
+        for (col, row), _tile in parents:
+            r0, c0 = (row-row0)*f, (col-col0)*f
+            for r, c in np.argwhere(high_todo[r0:r0+f, c0:c0+f]):
+                children.append(self._crop_tile(block, image, dz, high_level, (high_origin[0]+c0+int(c), high_origin[1]+r0+int(r))))
+        children = self._foreground(children)
+        child_dirs = [os.path.join(low_dir, '%d_%d' % (col//f, row//f)) if nested else high_dir for (col, row), _tile in children]
+        if nested:
+            # only parents with children get a folder, as in nested_patches
+            for child_dir in set(child_dirs):
+                os.makedirs(child_dir, exist_ok=True)
+        return ([(high_level, mags[1], child_dir, address, tile) for child_dir, (address, tile) in zip(child_dirs, children)]
+                + [(low_level, mags[0], low_dir, address, tile) for address, tile in parents])
+
+    def _read_block(self, image, dz, level, col0, row0, cols, rows):
+        """(RGB array, level 0 origin, slide level) of a block of tiles, read at the slide level get_tile reads from."""
+        (x, y), slide_level, _ = dz.get_tile_coordinates(level, (col0, row0))
+        (x1, y1), _, (w1, h1) = dz.get_tile_coordinates(level, (col0+cols-1, row0+rows-1))
+        ds = image.level_downsamples[slide_level]
+        # up to the far corner of the last tile
+        l_size = (int(math.ceil((x1 - x) / ds)) + w1, int(math.ceil((y1 - y) / ds)) + h1)
+        region = image.read_region((x, y), slide_level, l_size)
+        bg_color = '#' + image.properties.get(openslide.PROPERTY_NAME_BACKGROUND_COLOR, 'ffffff')
+        bg = Image.new('RGB', region.size, bg_color)
+        region = Image.composite(region, bg, region)
+        return np.asarray(region), (x, y), slide_level
+
+    def _get_dz(self, slidepath, associated=None):
+        cached = self._dzs.get((slidepath, associated))
+        if cached is not None:
+            return cached
+        if slidepath not in self._slides:
+            if len(self._slides) >= self._max_open_slides:
+                oldest = next(iter(self._slides))
+                self._slides.pop(oldest).close()
+                self._dzs = {k: v for k, v in self._dzs.items() if k[0] != oldest}
+            self._slides[slidepath] = open_slide(slidepath)
+        slide = self._slides[slidepath]
         if associated is not None:
-            image = ImageSlide(self._slide.associated_images[associated])
+            image = ImageSlide(slide.associated_images[associated])
         else:
-            image = self._slide
-        return DeepZoomGenerator(image, self._tile_size, self._overlap,
+            image = slide
+        dz = DeepZoomGenerator(image, self._tile_size, self._overlap,
                     limit_bounds=self._limit_bounds)
+        self._dzs[(slidepath, associated)] = (image, dz)
+        return image, dz
 
 
 class DeepZoomImageTiler(object):
     """Handles generation of tiles and metadata for a single image."""
 
-    def __init__(self, dz, basename, target_levels, mag_base, format, associated, queue):
+    def __init__(self, dz, basename, target_levels, mag_base, format, associated, queue, tile_masks=None,
+                coords_only=False, slidepath=None, block_size=8, single_read=False, pyramid_path=None):
         self._dz = dz
+        self._pyramid_path = pyramid_path
+        self._single_read = single_read
+        self._block_size = block_size
+        self._slidepath = slidepath
         self._basename = basename
         self._format = format
         self._associated = associated
         self._queue = queue
         self._processed = 0
+        self._queued = 0
         self._target_levels = target_levels
         self._mag_base = int(mag_base)
+        self._tile_masks = tile_masks or {}
+        self._coords_only = coords_only
 
     def run(self):
         self._write_tiles()
+        return self._queued
 
     def _write_tiles(self):
         target_levels = [self._dz.level_count-i-1 for i in self._target_levels]
         mag_list = [int(self._mag_base/2**i) for i in self._target_levels]
-        mag_idx = 0
-        for level in range(self._dz.level_count):
-            if not (level in target_levels):
-                continue
-            tiledir = os.path.join("%s_files" % self._basename, str(mag_list[mag_idx]))
-            if not os.path.exists(tiledir):
-                os.makedirs(tiledir)
-            cols, rows = self._dz.level_tiles[level]
-            for row in range(rows):
-                for col in range(cols):
-                    tilename = os.path.join(tiledir, '%d_%d.%s' % (
-                                    col, row, self._format))
-                    if not os.path.exists(tilename):
-                        self._queue.put((self._associated, level, (col, row),
-                                    tilename))
-                    self._tile_done()
-            mag_idx += 1
-
-    def _tile_done(self):
-        self._processed += 1
+        tiledirs = [os.path.join("%s_files" % self._basename, str(mag)) for mag in mag_list]
+        if self._single_read and len(target_levels) == 2 and self._pyramid_path is not None:
+            # written straight to <bag>/<low tile> and <bag>/<low tile>/<high tile>; a parent is
+            # written after its children, so only parents found on disk are done
+            os.makedirs(self._pyramid_path, exist_ok=True)
+            todos = [self._todo(target_levels[0], self._pyramid_path), self._todo(target_levels[1], None)]
+            self._write_pyramid(target_levels, mag_list, self._pyramid_path, todos)
+            return
+        if not self._coords_only:
+            for tiledir in tiledirs:
+                os.makedirs(tiledir, exist_ok=True)
+        todos = [self._todo(level, tiledir) for level, tiledir in zip(target_levels, tiledirs)]
+        if self._single_read and len(target_levels) == 2:
+            self._write_pyramid(target_levels, mag_list, tiledirs, todos)
+            return
+        b = self._block_size
+        for level, mag, tiledir, todo in zip(target_levels, mag_list, tiledirs, todos):
+            rows, cols = todo.shape
+            for row0 in range(0, rows, b):
+                for col0 in range(0, cols, b):
+                    block = todo[row0:row0+b, col0:col0+b]
+                    self._tile_done(block.size)
+                    if not block.any():
+                        continue
+                    # shrink the block to the bounding box of the tiles left to do
+                    block_rows = np.flatnonzero(block.any(1))
+                    block_cols = np.flatnonzero(block.any(0))
+                    block = block[block_rows[0]:block_rows[-1]+1, block_cols[0]:block_cols[-1]+1]
+                    self._queue.put((self._slidepath, self._associated, level,
+                                (col0+int(block_cols[0]), row0+int(block_rows[0])), block,
+                                mag, None if self._coords_only else tiledir, self._format))
+                    self._queued += 1
+
+    def _write_pyramid(self, target_levels, mag_list, tiledirs, todos):
+        """Queue blocks of low magnification tiles together with their children.
+        `tiledirs` is the bag folder of the nested pyramid layout, or the two tile directories."""
+        (low_level, high_level), (low_todo, high_todo) = target_levels, todos
+        f = 2**(high_level-low_level)
+        # about block_size high magnification tiles per side and read
+        b = max(1, self._block_size // f)
+        rows, cols = low_todo.shape
+        for row0 in range(0, rows, b):
+            for col0 in range(0, cols, b):
+                block = low_todo[row0:row0+b, col0:col0+b]
+                children = high_todo[row0*f:(row0+b)*f, col0*f:(col0+b)*f]
+                self._tile_done(block.size + children.size)
+                if not block.any():
+                    continue
+                self._queue.put((self._slidepath, self._associated, (low_level, high_level),
+                            (col0, row0), (block, children), (mag_list[0], mag_list[1]),
+                            None if self._coords_only else tiledirs if isinstance(tiledirs, str) else tuple(tiledirs), self._format))
+                self._queued += 1
+
+    def _todo(self, level, tiledir):
+        """Tiles of a level left to do: in the tissue mask and not written yet."""
+        cols, rows = self._dz.level_tiles[level]
+        todo = self._tile_masks.get(level)
+        todo = np.ones((rows, cols), dtype=bool) if todo is None else todo.copy()
+        if not self._coords_only and tiledir is not None:
+            for col, row in _scan_tiles(tiledir, self._format):
+                if row < rows and col < cols:
+                    todo[row, col] = False
+        return todo
+
+    def _tile_done(self, n=1):
+        self._processed += n
         count, total = self._processed, self._dz.tile_count
-        if count % 100 == 0 or count == total:
+        if count // 100 != (count-n) // 100 or count == total:
             print("Tiling %s: wrote %d/%d tiles" % (
                     self._associated or 'slide', count, total),
                     end='\r', file=sys.stderr)
@@ -125,10 +310,18 @@ class DeepZoomImageTiler(object):
 
 
 class DeepZoomStaticTiler(object):
-    """Handles generation of tiles and metadata for all images in a slide."""
+    """Handles generation of tiles and metadata for all images in a slide.
+
+    By default the tiler starts its own TileWorkers. When `queue` (and
+    `results`) of a shared worker pool are given, run() only enqueues the
+    tiles of the slide and returns their number; see MultiSlideTiler.
+    """
 
     def __init__(self, slidepath, basename, mag_levels, base_mag, objective, format, tile_size, overlap,
-                limit_bounds, quality, workers, threshold):
+                limit_bounds, quality, workers, threshold, mask_path=None, coords_path=None,
+                queue=None, results=None, block_size=8, single_read=False, pyramid_path=None):
+        self._slidepath = slidepath
+        self._pyramid_path = pyramid_path
         self._slide = open_slide(slidepath)
         self._basename = basename
         self._format = format
@@ -138,16 +331,39 @@ class DeepZoomStaticTiler(object):
         self._base_mag = base_mag
         self._objective = objective
         self._limit_bounds = limit_bounds
-        self._queue = JoinableQueue(2 * workers)
+        self._mask_path = mask_path
+        self._coords_path = coords_path
+        self._block_size = block_size
+        self._single_read = single_read
+        self._shared = queue is not None
         self._workers = workers
         self._dzi_data = {}
-        for _i in range(workers):
-            TileWorker(self._queue, slidepath, tile_size, overlap,
-                        limit_bounds, quality, threshold).start()
+        if self._shared:
+            self._queue = queue
+            self._results = results
+        else:
+            self._queue = JoinableQueue(2 * workers)
+            self._results = Queue() if coords_path is not None else None
+            for _i in range(workers):
+                TileWorker(self._queue, tile_size, overlap,
+                            limit_bounds, quality, threshold, self._results).start()
 
     def run(self):
-        self._run_image()
+        n_queued = self._run_image()
+        if self._shared:
+            self._slide.close()
+            return n_queued
         self._shutdown()
+        if self._coords_path is not None:
+            records = [r for _i in range(n_queued) for r in self._results.get()[2]]
+            self.write_coords(records)
+        return n_queued
+
+    def write_coords(self, records):
+        levels = sorted(self._mag_levels)
+        level_factor = 2**int(levels[1]-levels[0]) if len(levels) == 2 else None
+        n_tiles = tile_coords.save_coords(self._coords_path, records, self._slidepath, self._tile_size, level_factor)
+        print('\n Recorded {} patch coordinates in {}'.format(n_tiles, self._coords_path))
 
     def _run_image(self, associated=None):
         """Run a single image from self._slide."""
@@ -166,10 +382,21 @@ class DeepZoomStaticTiler(object):
         first_level = int(math.log2(float(MAG_BASE)/self._base_mag)) # raw / input, 40/20=2, 40/40=0
         target_levels = [i+first_level for i in self._mag_levels] # levels start from 0
         target_levels.reverse()
+
+        tile_masks = None
+        if associated is None and self._mask_path is not None:
+            mask = tissue_mask.load_or_create_mask(self._slide, self._mask_path)
+            tile_masks = {}
+            for i in target_levels:
+                level = dz.level_count-i-1
+                tile_masks[level] = tissue_mask.deepzoom_tile_mask(mask, self._slide, dz, level,
+                            self._tile_size, self._overlap, self._limit_bounds)
         
         tiler = DeepZoomImageTiler(dz, basename, target_levels, MAG_BASE, self._format, associated,
-                    self._queue)
-        tiler.run()
+                    self._queue, tile_masks, self._coords_path is not None, self._slidepath, self._block_size,
+                    self._single_read and associated is None and not self._overlap,
+                    self._pyramid_path if associated is None else None)
+        return tiler.run()
 
     def _url_for(self, associated):
         if associated is None:
@@ -196,48 +423,156 @@ class DeepZoomStaticTiler(object):
             self._queue.put(None)
         self._queue.join()
 
-def nested_patches(img_slide, out_base, level=(0,), ext='jpeg'):
+class MultiSlideTiler(object):
+    """Tiles many slides with one shared pool of TileWorkers.
+
+    Slides are fed largest first into a single task queue, each into its own
+    scratch directory under `scratch`, so the `workers` stay busy across
+    slide boundaries. When all tiles of a slide are acknowledged, its
+    coordinates are saved (coordinate-only mode) and `finalize(slidepath,
+    tile_dir)` runs on a thread pool while the next slides are being tiled.
+    In single read pyramid mode, slides with a folder in `pyramid_paths` are
+    written straight to it in the nested layout of nested_patches.
+    """
+
+    def __init__(self, slides, scratch, mag_levels, base_mag, objective, format, tile_size, overlap,
+                limit_bounds, quality, workers, threshold, mask_paths=None, coords_paths=None,
+                finalize=None, finalize_threads=2, block_size=8, single_read=False, pyramid_paths=None):
+        self._slides = slides
+        self._scratch = scratch
+        self._tiler_args = (mag_levels, base_mag, objective, format, tile_size, overlap,
+                            limit_bounds, quality, workers, threshold)
+        self._mask_paths = mask_paths or {}
+        self._coords_paths = coords_paths or {}
+        self._pyramid_paths = pyramid_paths or {}
+        self._finalize = finalize
+        self._finalize_threads = finalize_threads
+        self._block_size = block_size
+        self._single_read = single_read
+        self._workers = workers
+        self._queue = JoinableQueue(2 * workers)
+        self._results = Queue()
+        self._tilers = {}
+        self._tile_dirs = {}
+        for _i in range(workers):
+            TileWorker(self._queue, tile_size, overlap,
+                        limit_bounds, quality, threshold, self._results).start()
+
+    def run(self):
+        executor = ThreadPoolExecutor(max_workers=self._finalize_threads)
+        futures = []
+        collector = threading.Thread(target=self._collect, args=(executor, futures))
+        collector.start()
+        slides = sorted(self._slides, key=self._slide_area, reverse=True)
+        for idx, slidepath in enumerate(slides):
+            print('Process slide {}/{}'.format(idx+1, len(slides)))
+            name = os.path.splitext(os.path.basename(slidepath))[0]
+            basename = os.path.join(self._scratch, '%d_%s' % (idx, name))
+            self._tile_dirs[slidepath] = '%s_files' % basename
+            try:
+                tiler = DeepZoomStaticTiler(slidepath, basename, *self._tiler_args,
+                            mask_path=self._mask_paths.get(slidepath),
+                            coords_path=self._coords_paths.get(slidepath),
+                            queue=self._queue, results=self._results, block_size=self._block_size,
+                            single_read=self._single_read, pyramid_path=self._pyramid_paths.get(slidepath))
+                self._tilers[slidepath] = tiler
+                n_queued = tiler.run()
+            except Exception as e:
+                print('\n Skipping {}: {}'.format(slidepath, e))
+                self._results.put(('failed', slidepath, None))
+                continue
+            self._results.put(('queued', slidepath, n_queued))
+        for _i in range(self._workers):
+            self._queue.put(None)
+        self._queue.join()
+        collector.join()
+        executor.shutdown(wait=True)
+        for future in futures:
+            future.result()
+
+    def _collect(self, executor, futures):
+        queued = {}
+        acked = {}
+        records = {}
+        done = 0
+        while done < len(self._slides):
+            kind, slidepath, value = self._results.get()
+            if kind == 'failed':
+                done += 1
+                continue
+            if kind == 'queued':
+                queued[slidepath] = value
+            else:
+                acked[slidepath] = acked.get(slidepath, 0) + 1
+                records.setdefault(slidepath, []).extend(value)
+            if queued.get(slidepath) == acked.get(slidepath, 0):
+                del queued[slidepath]
+                acked.pop(slidepath, None)
+                futures.append(executor.submit(self._finish, slidepath, records.pop(slidepath, [])))
+                done += 1
+
+    def _finish(self, slidepath, records):
+        tiler = self._tilers.pop(slidepath)
+        if slidepath in self._coords_paths:
+            tiler.write_coords(records)
+        if self._finalize is not None:
+            self._finalize(slidepath, self._tile_dirs[slidepath])
+        shutil.rmtree(self._tile_dirs.pop(slidepath), ignore_errors=True)
+
+    @staticmethod
+    def _slide_area(slidepath):
+        try:
+            slide = open_slide(slidepath)
+        except Exception:
+            return 0
+        w, h = slide.dimensions
+        slide.close()
+        return w * h
+
+
+def _scan_tiles(mag_dir, ext):
+    """{(col, row): file name} of the tiles in one magnification directory."""
+    with os.scandir(mag_dir) as entries:
+        names = [e.name for e in entries if e.name.endswith('.'+ext)]
+    return {tuple(map(int, name[:-len(ext)-1].split('_'))): name for name in names}
+
+
+def nested_patches(img_slide, out_base, level=(0,), ext='jpeg', tile_dir='WSI_temp_files'):
     print('\n Organizing patches')
     img_name = img_slide.split(os.sep)[-1].split('.')[0]
     img_class = img_slide.split(os.sep)[2]
-    n_levels = len(glob.glob('WSI_temp_files/*'))
     bag_path = os.path.join(out_base, img_class, img_name)
     os.makedirs(bag_path, exist_ok=True)
+    levels = sorted(int(os.path.basename(i)) for i in glob.glob(os.path.join(tile_dir, '*')))
     if len(level)==1:
-        patches = glob.glob(os.path.join('WSI_temp_files', '*', '*.'+ext))
-        for i, patch in enumerate(patches):
-            patch_name = patch.split(os.sep)[-1]
-            shutil.move(patch, os.path.join(bag_path, patch_name))
+        patches = [(str(l), name) for l in levels for name in _scan_tiles(os.path.join(tile_dir, str(l)), ext).values()]
+        for i, (l, patch_name) in enumerate(patches):
+            shutil.move(os.path.join(tile_dir, l, patch_name), os.path.join(bag_path, patch_name))
             sys.stdout.write('\r Patch [%d/%d]' % (i+1, len(patches)))
         print('Done.')
+        return len(patches)
     else:
+        # one directory scan per magnification, high tiles grouped under their low parent
         level_factor = 2**int(level[1]-level[0])
-        levels = [int(os.path.basename(i)) for i in glob.glob(os.path.join('WSI_temp_files', '*'))]
-        levels.sort()
-        low_patches = glob.glob(os.path.join('WSI_temp_files', str(levels[0]), '*.'+ext))
-        for i, low_patch in enumerate(low_patches):
-            low_patch_name = low_patch.split(os.sep)[-1]
-            shutil.move(low_patch, os.path.join(bag_path, low_patch_name))
-            low_patch_folder = low_patch_name.split('.')[0]
-            high_patch_path = os.path.join(bag_path, low_patch_folder)
-            os.makedirs(high_patch_path, exist_ok=True)
-            low_x = int(low_patch_folder.split('_')[0])
-            low_y = int(low_patch_folder.split('_')[1])
-            high_x_list = list( range(low_x*level_factor, (low_x+1)*level_factor) )
-            high_y_list = list( range(low_y*level_factor, (low_y+1)*level_factor) )
-            for x_pos in high_x_list:
-                for y_pos in high_y_list:
-                    high_patch = glob.glob(os.path.join('WSI_temp_files', str(levels[1]), '{}_{}.'.format(x_pos, y_pos)+ext))
-                    if len(high_patch)!=0:
-                        high_patch = high_patch[0]
-                        shutil.move(high_patch, os.path.join(bag_path, low_patch_folder, high_patch.split(os.sep)[-1]))
-            try:
-                os.rmdir(os.path.join(bag_path, low_patch_folder))
-                os.remove(low_patch)
-            except:
-                pass
+        low_dir, high_dir = (os.path.join(tile_dir, str(l)) for l in levels[:2])
+        low_patches = _scan_tiles(low_dir, ext)
+        n_moved = len(low_patches)
+        children = {}
+        for (x, y), name in _scan_tiles(high_dir, ext).items():
+            children.setdefault((x//level_factor, y//level_factor), []).append(name)
+        for i, ((low_x, low_y), low_patch_name) in enumerate(sorted(low_patches.items())):
+            shutil.move(os.path.join(low_dir, low_patch_name), os.path.join(bag_path, low_patch_name))
+            high_patches = children.get((low_x, low_y))
+            if high_patches:
+                # low tiles without high magnification children get no folder
+                high_patch_path = os.path.join(bag_path, low_patch_name.split('.')[0])
+                os.makedirs(high_patch_path, exist_ok=True)
+                for high_patch_name in high_patches:
+                    shutil.move(os.path.join(high_dir, high_patch_name), os.path.join(high_patch_path, high_patch_name))
+                n_moved += len(high_patches)
             sys.stdout.write('\r Patch [%d/%d]' % (i+1, len(low_patches)))
         print('Done.')
+        return n_moved
 
 if __name__ == '__main__':
     Image.MAX_IMAGE_PIXELS = None
@@ -246,13 +581,18 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--overlap', type=int, default=0, help='Overlap of adjacent tiles [0]')
     parser.add_argument('-f', '--format', type=str, default='jpeg', help='Image format for tiles [jpeg]')
     parser.add_argument('-v', '--slide_format', type=str, default='svs', help='Image format for tiles [svs]')
-    parser.add_argument('-j', '--workers', type=int, default=4, help='Number of worker processes to start [4]')
+    parser.add_argument('-j', '--workers', type=int, default=4, help='Number of worker processes to start, shared by all slides [4]')
     parser.add_argument('-q', '--quality', type=int, default=70, help='JPEG compression quality [70]')
     parser.add_argument('-s', '--tile_size', type=int, default=224, help='Tile size [224]')
     parser.add_argument('-b', '--base_mag', type=float, default=20, help='Maximum magnification for patch extraction [20]')
     parser.add_argument('-m', '--magnifications', type=int, nargs='+', default=(0,), help='Levels for patch extraction [0]')
     parser.add_argument('-o', '--objective', type=float, default=20, help='The default objective power if metadata does not present [20]')
     parser.add_argument('-t', '--background_t', type=int, default=15, help='Threshold for filtering background [15]')  
+    parser.add_argument('-p', '--output', type=str, default='files', help='Write tiles as loose files, as one indexed tar shard per slide, or only record tile coordinates per slide [files|shard|coords]')
+    parser.add_argument('-B', '--block_size', type=int, default=8, help='Tiles per side of the blocks read with one read_region, 1 reads tile by tile [8]')
+    parser.add_argument('-r', '--single_read', type=int, default=0, help='With two magnifications, read each high magnification block once and downsample it for the low magnification tiles, written straight into the pyramid folders with --output files (0/1) [0]')
+    parser.add_argument('-w', '--scratch', type=str, default='.', help='Directory for the per-job temporary tile folders [.]')
+    parser.add_argument('-k', '--tissue_mask', type=int, default=1, help='Skip background tiles using a thumbnail tissue mask saved in WSI/<dataset>/masks (0/1) [1]')
     args = parser.parse_args()
     levels = tuple(sorted(args.magnifications))
     assert len(levels)<=2, 'Only 1 or 2 magnifications are supported!'
@@ -264,9 +604,56 @@ if __name__ == '__main__':
     all_slides = glob.glob(os.path.join(path_base, '*/*.'+args.slide_format)) +  glob.glob(os.path.join(path_base, '*/*/*.'+args.slide_format))
     
     # pos-i_pos-j -> x, y
-    for idx, c_slide in enumerate(all_slides):
-        print('Process slide {}/{}'.format(idx+1, len(all_slides)))
-        DeepZoomStaticTiler(c_slide, 'WSI_temp', levels, args.base_mag, args.objective, args.format, args.tile_size, args.overlap, True, args.quality, args.workers, args.background_t).run()
-        nested_patches(c_slide, out_base, levels, ext=args.format)
-        shutil.rmtree('WSI_temp_files') 
-    print('Patch extraction done for {} slides.'.format(len(all_slides)))
\ No newline at end of file
+    def out_path(c_slide, ext=''):
+        return os.path.join(out_base, c_slide.split(os.sep)[2], c_slide.split(os.sep)[-1].split('.')[0]+ext)
+
+    mask_paths = {}
+    if args.tissue_mask:
+        mask_paths = {c_slide: os.path.join('WSI', args.dataset, 'masks', c_slide.split(os.sep)[2], c_slide.split(os.sep)[-1].split('.')[0]+'.png') for c_slide in all_slides}
+    coords_paths = {}
+    if args.output == 'coords':
+        coords_paths = {c_slide: out_path(c_slide, tile_coords.COORDS_EXT) for c_slide in all_slides}
+
+    def output_of(c_slide):
+        return out_path(c_slide, {'shard': tile_shard.SHARD_EXT, 'coords': tile_coords.COORDS_EXT}.get(args.output, ''))
+
+    # slides whose output is recorded in the manifest with the same parameters are skipped
+    manifest = tile_manifest.TileManifest(os.path.join(path_base, tile_manifest.MANIFEST_NAME))
+    params = {'magnifications': levels, 'base_mag': args.base_mag, 'objective': args.objective, 'format': args.format,
+              'tile_size': args.tile_size, 'overlap': args.overlap, 'quality': args.quality, 'background_t': args.background_t,
+              'output': args.output, 'tissue_mask': args.tissue_mask, 'single_read': args.single_read}
+    slides = [c_slide for c_slide in all_slides if not manifest.is_done(output_of(c_slide), params)]
+    for c_slide in slides:
+        if manifest.is_stale(output_of(c_slide), params):
+            print('Parameters changed, redoing {}'.format(c_slide))
+            extra = (tile_shard.index_path(output_of(c_slide)),) if args.output == 'shard' else ()
+            tile_manifest.remove_output(output_of(c_slide), extra)
+            manifest.forget(output_of(c_slide))
+    print('{} of {} slides already done.'.format(len(all_slides)-len(slides), len(all_slides)))
+
+    # single read pyramid tiles go straight to pyramid/<class>/<slide>; shards are still packed from
+    # the scratch tiles, the workers cannot append to one tar
+    pyramid_paths = {}
+    if args.output == 'files' and args.single_read and len(levels) == 2 and not args.overlap:
+        pyramid_paths = {c_slide: out_path(c_slide) for c_slide in all_slides}
+
+    def finalize(c_slide, tile_dir):
+        if c_slide in pyramid_paths:
+            n_tiles = sum(len(files) for _, _, files in os.walk(pyramid_paths[c_slide]))
+        elif args.output == 'shard':
+            level_factor = 2**int(levels[1]-levels[0]) if len(levels) == 2 else None
+            n_tiles = tile_shard.pack_patches(tile_dir, out_path(c_slide, tile_shard.SHARD_EXT), args.format, level_factor)
+            print('\n Packed {} patches into {}'.format(n_tiles, out_path(c_slide, tile_shard.SHARD_EXT)))
+        elif args.output == 'files':
+            n_tiles = nested_patches(c_slide, out_base, levels, ext=args.format, tile_dir=tile_dir)
+        else:
+            n_tiles = len(tile_coords.TileCoords(out_path(c_slide, tile_coords.COORDS_EXT)))
+        manifest.mark_done(output_of(c_slide), c_slide, params, n_tiles)
+
+    os.makedirs(args.scratch, exist_ok=True)
+    scratch = tempfile.mkdtemp(prefix='WSI_temp_', dir=args.scratch)
+    try:
+        MultiSlideTiler(slides, scratch, levels, args.base_mag, args.objective, args.format, args.tile_size, args.overlap, True, args.quality, args.workers, args.background_t, mask_paths, coords_paths, finalize, block_size=args.block_size, single_read=args.single_read, pyramid_paths=pyramid_paths).run()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    print('Patch extraction done for {} slides.'.format(len(all_slides)))
@@ -0,0 +1,110 @@
+import os
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+
+import feature_store
+
+# Edges of a bag as one `edges_<bag>.npz` in CSR layout instead of one
+# Src/Dst/Weight CSV per number of neighbours. Node ids are the row indices
+# of the bag's feature file (feature_store), in every edge file:
+#   indptr   N + 1 int64, the edges of node i are [indptr[i], indptr[i+1])
+#   indices  int32 destination nodes, every row nearest first
+#   weights  float16 edge weights
+#   k        neighbours per node the file was written with (0 if not a kNN graph)
+# The graph with fewer edges per node keeps the first edges of every row, so
+# `edges_knn/edges_<bag>.npz` with k = 32 also serves k = 2, 4, 8 and 16.
+# Legacy CSV edge files are still read, and convert_dataset() migrates them.
+EDGES_EXT = '.npz'
+KNN_EDGES = 'knn'
+
+
+def knn_path(feats_path):
+    """kNN edge file of a bag, `edges_knn/edges_<bag>.npz` next to the class folders."""
+    return feature_store.edges_path(feats_path, KNN_EDGES, EDGES_EXT)
+
+
+def save_edges(path, indptr, indices, weights, k=0):
+    """Write CSR edges atomically."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    feature_store._replace(path, lambda f: np.savez(f, indptr=np.asarray(indptr, dtype=np.int64),
+                                                    indices=np.asarray(indices, dtype=np.int32),
+                                                    weights=np.asarray(weights, dtype=np.float32).astype(np.float16),
+                                                    k=np.int64(k)))
+    return path
+
+
+def save_knn(path, indices, weights, k=None):
+    """Write the N x k neighbours (and weights) of every node, nearest first.
+    `k` is the number of neighbours searched, more than the columns when the bag has less than k nodes."""
+    n, n_cols = indices.shape
+    return save_edges(path, np.arange(n + 1, dtype=np.int64) * n_cols, indices.ravel(), weights.ravel(), k or n_cols)
+
+
+def csr_from_edges(src, dst, weights, n_nodes=None):
+    """(indptr, indices, weights) of an edge list, keeping the order of the edges of every node."""
+    src = np.asarray(src, dtype=np.int64)
+    n_nodes = n_nodes if n_nodes is not None else int(src.max()) + 1 if len(src) else 0
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n_nodes), out=indptr[1:])
+    return indptr, np.asarray(dst)[order], np.asarray(weights)[order]
+
+
+def read_csv_edges(path):
+    df = pd.read_csv(path, index_col=0)
+    return df['Src'].to_numpy(), df['Dst'].to_numpy(), df['Weight'].to_numpy()
+
+
+def load_edges(path, edges_per_node=None):
+    """(src, dst, weights) of a CSR edge file, the first `edges_per_node` edges of every node if given."""
+    with np.load(path) as data:
+        indptr, indices, weights, k = data['indptr'], data['indices'], data['weights'], int(data['k'])
+    if edges_per_node is not None and k and edges_per_node > k:
+        raise ValueError('{} holds {} edges per node, {} requested'.format(path, k, edges_per_node))
+    degrees = np.diff(indptr)
+    src = np.repeat(np.arange(len(degrees), dtype=np.int64), degrees)
+    if edges_per_node is not None:
+        rank = np.arange(len(indices)) - indptr[src]
+        keep = rank < edges_per_node
+        src, indices, weights = src[keep], indices[keep], weights[keep]
+    return src, indices.astype(np.int64), weights.astype(np.float32)
+
+
+def read_edges(path, edges_per_node=None, csv_path=None):
+    """Edges of a bag from its CSR file, or from the legacy CSV `csv_path` when there is none."""
+    if csv_path is not None and not os.path.exists(path) and os.path.exists(csv_path):
+        return read_csv_edges(csv_path)
+    return load_edges(path, edges_per_node)
+
+
+def convert_dataset(dataset, remove_csv=False):
+    """Convert the legacy kNN edge CSVs of datasets/<dataset> (edges_<k>/ folders) to edges_knn/, from the largest k."""
+    dataset_dir = os.path.join('datasets', dataset)
+    ks = sorted(int(d.split('_')[-1]) for d in glob.glob(os.path.join(dataset_dir, 'edges_*')) if d.split('_')[-1].isdigit())
+    if not ks:
+        return 0
+    csv_paths = sorted(glob.glob(os.path.join(dataset_dir, 'edges_{}'.format(ks[-1]), 'edges_*' + feature_store.CSV_EXT)))
+    for csv_path in csv_paths:
+        bag = os.path.basename(csv_path)[:-len(feature_store.CSV_EXT)]
+        src, dst, weights = read_csv_edges(csv_path)
+        save_edges(os.path.join(dataset_dir, 'edges_' + KNN_EDGES, bag + EDGES_EXT), *csr_from_edges(src, dst, weights), k=ks[-1])
+    if remove_csv:
+        for k in ks:
+            for path in glob.glob(os.path.join(dataset_dir, 'edges_{}'.format(k), 'edges_*' + feature_store.CSV_EXT)):
+                os.remove(path)
+    return len(csv_paths)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert the kNN edge CSVs of a dataset to one CSR edge file per bag')
+    parser.add_argument('--dataset', default='TCGA-lung-single', type=str, help='Dataset folder name under datasets/ [TCGA-lung-single]')
+    parser.add_argument('--remove_csv', default=0, type=int, help='Delete the edges_<k>/ CSVs after conversion (0/1) [0]')
+    args = parser.parse_args()
+    n_bags = convert_dataset(args.dataset, args.remove_csv)
+    print('Converted the edges of {} bags of {}'.format(n_bags, args.dataset))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+import os
+import glob
+import json
+import time
+import copy
+import argparse
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+import tile_shard
+import tile_coords
+import tile_decode
+from inference import BACKBONES, embedder
+
+# Exports a trained embedder (the IClassifier state dict compute_feats.py
+# saves under embedder/<dataset>/) for CPU feature extraction:
+#   torchscript  frozen TorchScript, fp32 or int8
+#   onnx         ONNX graph for onnxruntime (optional dependency), fp32 or
+#                dynamic int8
+# Quantization
+#   dynamic  int8 weights of the linear layers only (the fc head of a ResNet)
+#   static   int8 convolutions, activation ranges calibrated on a bag;
+#            instance norm layers stay in float
+# A `<artifact>.json` next to the artifact records the export settings and the
+# feature drift against the fp32 embedder, measured on a validation bag.
+# compute_feats.py and attention_map.py load the artifact with --embedder_artifact
+# (--embedder_artifact_high / --embedder_artifact_low for --magnification=tree).
+FORMATS = {'torchscript': '.pt', 'onnx': '.onnx'}
+QUANTIZE = ('none', 'dynamic', 'static')
+
+
+def meta_path(artifact_path):
+    return artifact_path + '.json'
+
+
+def load_meta(artifact_path):
+    path = meta_path(artifact_path)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def build_embedder(backbone, norm_layer, num_classes, weights=None):
+    """IClassifier with the weights saved by compute_feats.py, or ImageNet weights."""
+    norm = nn.InstanceNorm2d if norm_layer == 'instance' else nn.BatchNorm2d
+    model = embedder(backbone, norm, num_classes)
+    if weights == 'ImageNet':
+        build, num_feats = BACKBONES[backbone]
+        pretrained = build(pretrained=True, norm_layer=norm)
+        pretrained.fc = nn.Identity()
+        model.feature_extractor.load_state_dict(pretrained.state_dict())
+    elif weights is not None:
+        model.load_state_dict(torch.load(weights, map_location='cpu'))
+    return model.eval()
+
+
+def bag_tiles(bag_path):
+    """(tiles, source) of a bag folder (all magnifications), tile shard or coordinate file."""
+    if bag_path.endswith(tile_shard.SHARD_EXT):
+        source = tile_shard.TileShard(bag_path)
+        return source.select(), source
+    if bag_path.endswith(tile_coords.COORDS_EXT):
+        source = tile_coords.TileCoords(bag_path)
+        return source.select(), source
+    tiles = []
+    for pattern in ('*.jpg', '*.jpeg', os.path.join('*', '*.jpg'), os.path.join('*', '*.jpeg')):
+        tiles.extend(glob.glob(os.path.join(bag_path, pattern)))
+    return sorted(tiles), None
+
+
+def bag_batches(bag_path, batch_size, n_batches, input_size=None):
+    """Up to `n_batches` float batches of the tiles of a bag."""
+    tiles, source = bag_tiles(bag_path)
+    if len(tiles) == 0:
+        raise ValueError('No tiles found in ' + bag_path)
+    dataset = tile_decode.TileBatchDataset(tiles, source, size=input_size)
+    batches = []
+    for batch in tile_decode.batch_loader(dataset, batch_size):
+        batches.append(batch['input'].float().div_(255))
+        if len(batches) == n_batches:
+            break
+    return batches
+
+
+def quantize(model, mode, calibration, backend='x86'):
+    if mode == 'none':
+        return model
+    # torch.ao.quantization deprecation notices
+    warnings.filterwarnings('ignore', module='torch.ao')
+    torch.backends.quantized.engine = backend
+    if mode == 'dynamic':
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model), {nn.Linear}, dtype=torch.qint8)
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    # quantized instance norm loses too much precision, keep it in float
+    qconfig = get_default_qconfig_mapping(backend).set_object_type(nn.InstanceNorm2d, None)
+    prepared = prepare_fx(copy.deepcopy(model), qconfig, (calibration[0][:1],))
+    with torch.inference_mode():
+        for x in calibration:
+            prepared(x)
+    return convert_fx(prepared)
+
+
+def export_torchscript(model, path, example):
+    with torch.inference_mode():
+        scripted = torch.jit.freeze(torch.jit.trace(model, (example,)))
+    torch.jit.save(scripted, path)
+
+
+def export_onnx(model, path, example, quantize_mode):
+    if quantize_mode == 'static':
+        raise ValueError('Static int8 is only exported to TorchScript, use --format torchscript')
+    fp32_path = path if quantize_mode == 'none' else path + '.fp32'
+    torch.onnx.export(model, (example,), fp32_path, input_names=['input'], output_names=['feats', 'classes'],
+                      dynamic_axes={'input': {0: 'batch'}, 'feats': {0: 'batch'}, 'classes': {0: 'batch'}}, dynamo=False)
+    if quantize_mode == 'dynamic':
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+        os.remove(fp32_path)
+
+
+class OnnxEmbedder(nn.Module):
+    """onnxruntime session with the (feats, classes) interface of IClassifier."""
+
+    def __init__(self, path, num_threads=0):
+        super(OnnxEmbedder, self).__init__()
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        if num_threads > 0:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def forward(self, x):
+        feats, classes = self.session.run(None, {'input': x.detach().float().cpu().numpy()})
+        return torch.from_numpy(feats), torch.from_numpy(classes)
+
+
+def load_embedder(path, engine=None):
+    """Embedder artifact written by export_embedder.py, called like an IClassifier."""
+    meta = load_meta(path)
+    if engine is not None and (path.endswith(FORMATS['onnx']) or meta.get('quantize', 'none') != 'none'):
+        if engine.accelerated:
+            raise ValueError('{} runs on the CPU only, use --device cpu'.format(path))
+        # int8 kernels and onnxruntime take float32 inputs
+        engine.bf16 = False
+    if path.endswith(FORMATS['onnx']):
+        return OnnxEmbedder(path, torch.get_num_threads())
+    if meta.get('quantize', 'none') != 'none':
+        torch.backends.quantized.engine = meta.get('backend', torch.backends.quantized.engine)
+    return torch.jit.load(path, map_location='cpu')
+
+
+class ArtifactClassifier(nn.Module):
+    """Features from an exported embedder, instance classes from a float `fc` (e.g. loaded with an aggregator)."""
+
+    def __init__(self, artifact, fc):
+        super(ArtifactClassifier, self).__init__()
+        self.artifact = artifact
+        self.fc = fc
+
+    def forward(self, x):
+        feats, _ = self.artifact(x)
+        feats = feats.view(feats.shape[0], -1)
+        return feats, self.fc(feats)
+
+
+def patches_per_sec(model, batches):
+    with torch.inference_mode():
+        model(batches[0])
+        start = time.time()
+        for x in batches:
+            model(x)
+    return sum(len(x) for x in batches) / (time.time() - start)
+
+
+def drift_report(reference, exported, batches):
+    """Feature drift of an exported embedder against the fp32 model, and the speed of both."""
+    rel, cos, max_abs = [], [], 0.0
+    with torch.inference_mode():
+        for x in batches:
+            a, b = reference(x)[0].float(), exported(x)[0].float()
+            rel.append(((a - b).norm(dim=1) / a.norm(dim=1).clamp_min(1e-12)).numpy())
+            cos.append(F.cosine_similarity(a, b, dim=1).numpy())
+            max_abs = max(max_abs, (a - b).abs().max().item())
+    rel, cos = np.concatenate(rel), np.concatenate(cos)
+    fp32_speed, exported_speed = patches_per_sec(reference, batches), patches_per_sec(exported, batches)
+    return {'tiles': int(len(cos)), 'max_abs_diff': max_abs, 'mean_rel_error': float(rel.mean()), 'max_rel_error': float(rel.max()),
+            'mean_cosine': float(cos.mean()), 'min_cosine': float(cos.min()),
+            'fp32_patches_per_sec': fp32_speed, 'patches_per_sec': exported_speed, 'speedup': exported_speed / fp32_speed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export an embedder to TorchScript / ONNX, optionally int8, and report its feature drift')
+    parser.add_argument('--weights', default=None, type=str, help='Embedder state dict saved by compute_feats.py, or `ImageNet` [embedder/<dataset>/embedder.pth]')
+    parser.add_argument('--dataset', default='TCGA-lung-single', type=str, help='Dataset folder name, used for the default --weights [TCGA-lung-single]')
+    parser.add_argument('--backbone', default='resnet18', type=str, help='Embedder backbone [resnet18]')
+    parser.add_argument('--norm_layer', default='instance', type=str, help='Normalization layer [instance|batch]')
+    parser.add_argument('--num_classes', default=2, type=int, help='Number of output classes [2]')
+    parser.add_argument('--format', default='torchscript', type=str, help='Artifact format [torchscript|onnx]')
+    parser.add_argument('--quantize', default='static', type=str, help='int8 quantization [none|dynamic|static]')
+    parser.add_argument('--backend', default='x86', type=str, help='Quantized kernels, `qnnpack` on ARM [x86|fbgemm|qnnpack|onednn]')
+    parser.add_argument('--bag', required=True, type=str, help='Bag (tile folder, shard or coordinate file) used to calibrate and validate')
+    parser.add_argument('--batch_size', default=32, type=int, help='Tiles per batch [32]')
+    parser.add_argument('--calib_batches', default=8, type=int, help='Calibration batches for static quantization [8]')
+    parser.add_argument('--val_batches', default=4, type=int, help='Batches used for the drift report, after the calibration batches [4]')
+    parser.add_argument('--input_size', default=0, type=int, help='Embedder input size as in compute_feats.py, 0 keeps the tile size [0]')
+    parser.add_argument('--output', default=None, type=str, help='Artifact path [<weights>-<quantize>.pt|.onnx]')
+    args = parser.parse_args()
+
+    if args.format not in FORMATS or args.quantize not in QUANTIZE:
+        raise ValueError('--format accepts {} and --quantize accepts {}'.format('|'.join(FORMATS), '|'.join(QUANTIZE)))
+    weights = args.weights or os.path.join('embedder', args.dataset, 'embedder.pth')
+    output = args.output or os.path.splitext(weights if weights != 'ImageNet' else os.path.join('embedder', args.dataset, 'imagenet'))[0] \
+        + '-{}{}'.format(args.quantize if args.quantize != 'none' else 'fp32', FORMATS[args.format])
+    model = build_embedder(args.backbone, args.norm_layer, args.num_classes, weights)
+
+    batches = bag_batches(args.bag, args.batch_size, args.calib_batches + args.val_batches, args.input_size or None)
+    calibration = batches[:args.calib_batches] or batches
+    validation = batches[args.calib_batches:] or batches
+    quantized = quantize(model, args.quantize, calibration, args.backend)
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    if args.format == 'torchscript':
+        export_torchscript(quantized, output, validation[0][:1])
+    else:
+        export_onnx(quantized, output, validation[0][:1], args.quantize)
+
+    report = drift_report(model, load_embedder(output), validation)
+    meta = {'weights': weights, 'backbone': args.backbone, 'norm_layer': args.norm_layer, 'num_classes': args.num_classes,
+            'format': args.format, 'quantize': args.quantize, 'backend': args.backend, 'input_size': args.input_size,
+            'validation_bag': args.bag, 'drift': report}
+    with open(meta_path(output), 'w') as f:
+        json.dump(meta, f, indent=1)
+    print('Exported ' + output)
+    for k, v in report.items():
+        print('  {:<22} {}'.format(k, '%.4g' % v if isinstance(v, float) else v))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import os
+import time
+import sqlite3
+import hashlib
+import argparse
+import numpy as np
+
+import tile_shard
+import tile_coords
+
+# Tile features already computed by an embedder, kept in one SQLite file so
+# compute_feats.py only embeds the tiles it has not seen. Entries are keyed by
+#   embedder  hash of the feature extractor weights, backbone, norm layer and
+#             precision (the instance classifier `fc` does not change the features)
+#   tile      hash of the encoded tile bytes (files, shards), or of the slide
+#             and the region read from it (coordinate files)
+# and hold the feature vector and the CRC32 of the decoded pixels. The file
+# is bounded in size; the least recently used entries are evicted first.
+CACHE_DTYPE = np.float32
+DIGEST_SIZE = 16
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS embedders (key TEXT PRIMARY KEY, backbone TEXT, norm_layer TEXT, weights TEXT, created REAL);
+CREATE TABLE IF NOT EXISTS feats (embedder TEXT, tile BLOB, crc32 INTEGER, data BLOB, size INTEGER, atime REAL,
+                                  PRIMARY KEY (embedder, tile)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS feats_atime ON feats (atime);
+'''
+
+
+def embedder_key(model, backbone, norm_layer, precision='fp32'):
+    """Hex digest identifying the feature extractor weights and architecture of an embedder."""
+    h = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    h.update('{}/{}/{}'.format(backbone, norm_layer, precision).encode())
+    # the fc of an IClassifier is not in the SimCLR checkpoints and starts random on every run
+    for name, tensor in getattr(model, 'feature_extractor', model).state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def bytes_key(data):
+    return hashlib.blake2b(data, digest_size=DIGEST_SIZE).digest()
+
+
+def tile_keys(tiles, source=None):
+    """Cache key of every tile, `tiles` are file paths or indices into a shard / coordinate source."""
+    if isinstance(source, tile_shard.TileShard):
+        return [bytes_key(source.read(idx)) for idx in tiles]
+    if isinstance(source, tile_coords.TileCoords):
+        slide = '{}:{}'.format(os.path.abspath(source.slide_path), os.path.getsize(source.slide_path))
+        fields = ('x', 'y', 'slide_level', 'width', 'height', 'tile_width', 'tile_height')
+        keys = []
+        for entry in source.coords[np.asarray(tiles, dtype=np.int64)]:
+            region = ','.join(str(int(entry[f])) for f in fields)
+            keys.append(bytes_key('{}:{}:{}'.format(slide, region, source.tile_size).encode()))
+        return keys
+    keys = []
+    for path in tiles:
+        with open(path, 'rb') as f:
+            keys.append(bytes_key(f.read()))
+    return keys
+
+
+class FeatureCache(object):
+    """LRU bounded store of tile features, shared by all the embedders of a project."""
+
+    def __init__(self, cache_path, max_bytes=None):
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        self.path = cache_path
+        self.max_bytes = max_bytes
+        self.db = sqlite3.connect(cache_path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(_SCHEMA)
+
+    def embedder(self, key, backbone=None, norm_layer=None, weights=None):
+        """Register an embedder and return the view of the cache for its features."""
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO embedders VALUES (?, ?, ?, ?, ?)',
+                            (key, backbone, norm_layer, weights, time.time()))
+        return EmbedderCache(self, key)
+
+    def get(self, embedder, keys):
+        """(feats, crc32, hit) of the tiles, rows of the missing tiles are left empty."""
+        feats, crc32 = [None]*len(keys), np.zeros(len(keys), dtype=np.uint32)
+        hit = np.zeros(len(keys), dtype=bool)
+        position = {k: i for i, k in enumerate(keys)}
+        unique = list(position)
+        for start in range(0, len(unique), 500):
+            chunk = unique[start:start+500]
+            rows = self.db.execute('SELECT tile, crc32, data FROM feats WHERE embedder = ? AND tile IN ({})'.format(
+                ','.join('?'*len(chunk))), [embedder] + chunk).fetchall()
+            for tile, crc, data in rows:
+                feats[position[tile]] = np.frombuffer(data, dtype=CACHE_DTYPE)
+                crc32[position[tile]] = crc
+                hit[position[tile]] = True
+        # duplicated tiles share the entry of their last occurrence
+        for i, k in enumerate(keys):
+            j = position[k]
+            feats[i], crc32[i], hit[i] = feats[j], crc32[j], hit[j]
+        if hit.any():
+            now = time.time()
+            with self.db:
+                self.db.executemany('UPDATE feats SET atime = ? WHERE embedder = ? AND tile = ?',
+                                    [(now, embedder, k) for k in set(k for k, h in zip(keys, hit) if h)])
+        return feats, crc32, hit
+
+    def put(self, embedder, keys, feats, crc32):
+        now = time.time()
+        rows = []
+        for k, f, c in zip(keys, feats, crc32):
+            data = np.ascontiguousarray(f, dtype=CACHE_DTYPE).tobytes()
+            rows.append((embedder, k, int(c), data, len(data), now))
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO feats VALUES (?, ?, ?, ?, ?, ?)', rows)
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def size(self):
+        return self.db.execute('SELECT COALESCE(SUM(size), 0) FROM feats').fetchone()[0]
+
+    def evict(self, max_bytes):
+        """Drop the least recently used entries until the features fit in `max_bytes`, returns the number dropped."""
+        excess = self.size() - max_bytes
+        dropped = 0
+        while excess > 0:
+            rows = self.db.execute('SELECT embedder, tile, size FROM feats ORDER BY atime LIMIT 10000').fetchall()
+            if not rows:
+                break
+            n = 0
+            while n < len(rows) and excess > 0:
+                excess -= rows[n][2]
+                n += 1
+            with self.db:
+                self.db.executemany('DELETE FROM feats WHERE embedder = ? AND tile = ?', [r[:2] for r in rows[:n]])
+            dropped += n
+        return dropped
+
+    def embedders(self):
+        """One dict per embedder: key, backbone, norm_layer, weights, created, entries, bytes, last_used."""
+        rows = self.db.execute('''SELECT e.key, e.backbone, e.norm_layer, e.weights, e.created,
+                                         COUNT(f.tile), COALESCE(SUM(f.size), 0), MAX(f.atime)
+                                  FROM embedders e LEFT JOIN feats f ON f.embedder = e.key
+                                  GROUP BY e.key ORDER BY e.created''').fetchall()
+        names = ('key', 'backbone', 'norm_layer', 'weights', 'created', 'entries', 'bytes', 'last_used')
+        return [dict(zip(names, row)) for row in rows]
+
+    def prune(self, keys=(), unused_days=None, keep_last=None):
+        """Remove embedders (and their features): the given keys, the ones unused for `unused_days`,
+        and all but the `keep_last` most recently used. Returns the removed keys."""
+        embedders = self.embedders()
+        remove = set(e['key'] for e in embedders if any(e['key'].startswith(k) for k in keys))
+        if unused_days is not None:
+            limit = time.time() - unused_days*86400
+            remove.update(e['key'] for e in embedders if (e['last_used'] or e['created']) < limit)
+        if keep_last is not None:
+            by_use = sorted(embedders, key=lambda e: e['last_used'] or e['created'], reverse=True)
+            remove.update(e['key'] for e in by_use[keep_last:])
+        with self.db:
+            for key in remove:
+                self.db.execute('DELETE FROM feats WHERE embedder = ?', (key,))
+                self.db.execute('DELETE FROM embedders WHERE key = ?', (key,))
+        self.db.execute('VACUUM')
+        return sorted(remove)
+
+    def close(self):
+        self.db.close()
+
+
+class EmbedderCache(object):
+    """Cached features of one embedder."""
+
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+
+    def get(self, keys):
+        return self.cache.get(self.key, keys)
+
+    def put(self, keys, feats, crc32):
+        self.cache.put(self.key, keys, feats, crc32)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='List or prune the tile feature cache of compute_feats.py')
+    parser.add_argument('command', type=str, help='Action [list|prune]')
+    parser.add_argument('--cache', default=os.path.join('embedder', 'feature_cache.sqlite'), type=str, help='Cache file [embedder/feature_cache.sqlite]')
+    parser.add_argument('--embedders', type=str, nargs='*', default=(), help='prune: embedder keys (or key prefixes) to remove []')
+    parser.add_argument('--unused_days', default=None, type=float, help='prune: remove embedders unused for this many days [None]')
+    parser.add_argument('--keep_last', default=None, type=int, help='prune: keep only the N most recently used embedders [None]')
+    parser.add_argument('--max_size', default=None, type=float, help='prune: then evict least recently used tiles down to this size in GB [None]')
+    args = parser.parse_args()
+
+    cache = FeatureCache(args.cache)
+    if args.command == 'prune':
+        for key in cache.prune(args.embedders, args.unused_days, args.keep_last):
+            print('Removed embedder ' + key)
+        if args.max_size is not None:
+            print('Evicted {} tiles'.format(cache.evict(int(args.max_size * 2**30))))
+    elif args.command != 'list':
+        raise ValueError('Unknown command {}, use `list` or `prune`'.format(args.command))
+    print('%-32s  %-10s  %-8s  %9s  %9s  %-19s  %s' % ('embedder', 'backbone', 'norm', 'tiles', 'MB', 'last used', 'weights'))
+    for e in cache.embedders():
+        last_used = e['last_used'] or e['created']
+        print('%-32s  %-10s  %-8s  %9d  %9.1f  %-19s  %s' % (e['key'], e['backbone'], e['norm_layer'], e['entries'], e['bytes'] / 2**20,
+                                                         time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(last_used)), e['weights']))
+    cache.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import os
+import glob
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+# Bag features on disk. A bag is a `<bag>.npy` (N x D float32 by default)
+# memory mapped on load, next to a `<bag>.meta.npz` with its metadata (source
+# slide, class folder) and one `tile_<column>` array per TILE_COLUMNS entry
+# describing the tile of every feature row. float16 storage is opt-in: half
+# the size, but a relative rounding error up to 5e-4, coarser than the `%.4f`
+# text of the CSV bags the training scripts were tuned on. Bags written as
+# `.csv` by older versions of compute_feats.py are still read, and
+# convert_dataset() migrates them.
+FEATS_EXT = '.npy'
+META_EXT = '.meta.npz'
+CSV_EXT = '.csv'
+# col, row  DeepZoom tile address
+# mag       magnification, -1 if the tiles are loose files
+# path      tile file relative to the bag folder, or `<mag>/<col>_<row>` in a shard / coordinate file
+# crc32     CRC32 of the decoded RGB pixels (at the --input_size of compute_feats.py when set)
+TILE_COLUMNS = ('col', 'row', 'mag', 'path', 'crc32')
+
+
+def bag_name(feats_path):
+    name = os.path.basename(feats_path)
+    for ext in (FEATS_EXT, CSV_EXT):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+
+def meta_path(feats_path):
+    return os.path.join(os.path.dirname(feats_path), bag_name(feats_path) + META_EXT)
+
+
+def edges_path(feats_path, edges_name, ext=CSV_EXT):
+    """Edge file of a bag written by get_edges_*.py, e.g. `edges_8/edges_<bag>.csv` next to the class folders."""
+    dataset_dir = os.path.dirname(os.path.dirname(feats_path))
+    return os.path.join(dataset_dir, 'edges_{}'.format(edges_name), 'edges_' + bag_name(feats_path) + ext)
+
+
+def is_bag(path):
+    return path.endswith(FEATS_EXT) or path.endswith(CSV_EXT)
+
+
+def list_bags(folder):
+    """Feature files of the bags in a class folder."""
+    return sorted(p for p in glob.glob(os.path.join(folder, '*')) if is_bag(p))
+
+
+def resolve(feats_path):
+    """Path of an existing bag, trying the other format if `feats_path` is missing."""
+    if os.path.exists(feats_path):
+        return feats_path
+    base = os.path.join(os.path.dirname(feats_path), bag_name(feats_path))
+    for ext in (FEATS_EXT, CSV_EXT):
+        if os.path.exists(base + ext):
+            return base + ext
+    return feats_path
+
+
+def read_csv_feats(csv_path):
+    df = pd.read_csv(csv_path)
+    # get_edges_*.py rewrite bags with the row index as first column
+    if 'Unnamed: 0' in df.columns:
+        df = df.set_index('Unnamed: 0', drop=True)
+    return df.to_numpy()
+
+
+def load_feats(feats_path, dtype=np.float32):
+    """N x D features of a bag, `.npy` or legacy `.csv`, as float32 (the precision torch trains on) by default.
+    Scripts whose output must stay as computed from pd.read_csv (the edge writers) load float64."""
+    feats_path = resolve(feats_path)
+    if feats_path.endswith(CSV_EXT):
+        return read_csv_feats(feats_path).astype(dtype)
+    return np.asarray(np.load(feats_path, mmap_mode='r'), dtype=dtype)
+
+
+def load_meta(feats_path):
+    path = meta_path(feats_path)
+    if not os.path.exists(path):
+        return {}
+    with np.load(path) as data:
+        return {k: data[k] for k in data.files}
+
+
+def load_tiles(feats_path):
+    """{column: array} of the tile provenance of a bag, empty if not recorded."""
+    meta = load_meta(feats_path)
+    return {k: meta['tile_'+k] for k in TILE_COLUMNS if 'tile_'+k in meta}
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+_UMASK = _umask()
+
+
+def _replace(path, write):
+    # a temporary file of its own: workers sharing a queue may write the same (reclaimed) bag
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.part', dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(tmp_path, 0o666 & ~_UMASK)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_bag(feats_path, feats, dtype='float32', **meta):
+    """Write the features of a bag (and its metadata) atomically."""
+    os.makedirs(os.path.dirname(feats_path) or '.', exist_ok=True)
+    feats = np.asarray(feats)
+    if feats_path.endswith(CSV_EXT):
+        _replace(feats_path, lambda f: pd.DataFrame(feats).to_csv(f, index=False, float_format='%.4f'))
+    else:
+        _replace(feats_path, lambda f: np.save(f, feats.astype(dtype)))
+    if meta:
+        _replace(meta_path(feats_path), lambda f: np.savez(f, **{k: np.asarray(v) for k, v in meta.items()}))
+    return feats_path
+
+
+def convert_dataset(dataset, dtype='float32', remove_csv=False):
+    """Convert the CSV bags listed in datasets/<dataset>/*.csv to `.npy` and update the lists."""
+    converted = {}
+    for list_path in glob.glob(os.path.join('datasets', dataset, '*.csv')):
+        bags = pd.read_csv(list_path)
+        paths = []
+        for path in bags.iloc[:, 0]:
+            if path.endswith(CSV_EXT) and os.path.exists(path):
+                if path not in converted:
+                    new_path = os.path.join(os.path.dirname(path), bag_name(path) + FEATS_EXT)
+                    save_bag(new_path, read_csv_feats(path), dtype,
+                             class_name=os.path.basename(os.path.dirname(path)))
+                    converted[path] = new_path
+                path = converted[path]
+            paths.append(path)
+        bags.iloc[:, 0] = paths
+        bags.to_csv(list_path, index=False)
+    if remove_csv:
+        for path in converted:
+            os.remove(path)
+    return len(converted)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert CSV bag features of a dataset to the binary feature store')
+    parser.add_argument('--dataset', default='TCGA-lung-single', type=str, help='Dataset folder name under datasets/ [TCGA-lung-single]')
+    parser.add_argument('--dtype', default='float32', type=str, help='Stored feature precision, float16 halves the size with a relative error up to 5e-4 [float32|float16]')
+    parser.add_argument('--remove_csv', default=0, type=int, help='Delete the CSV bags after conversion (0/1) [0]')
+    args = parser.parse_args()
+    n_bags = convert_dataset(args.dataset, args.dtype, args.remove_csv)
+    print('Converted {} bags of {}'.format(n_bags, args.dataset))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,73 +1,84 @@
-import argparse, os
-from collections import deque
+import argparse, os, time
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
-from scipy.spatial.distance import cosine
+import torch
 from sklearn.utils import shuffle
 from sklearn.neighbors import NearestNeighbors
 
+import feature_store
+import edge_store
+import knn_graph
+
+# --search -> knn_graph index, ball_tree is handled here
+SEARCH_INDEX = {'cosine': 'exact', 'lsh': 'lsh', 'hnsw': 'hnsw', 'ivf': 'ivf'}
+
+
+def cosine_weights(feats, indices):
+    """N x k cosine similarities between every node and its neighbours `indices`, as 1 - scipy cosine.
+
+    scipy takes np.dot of contiguous float64 vectors; the dot products go
+    through the same call on contiguous float64 rows so the weights are bit
+    identical, the rest of the formula is elementwise.
+    """
+    feats = np.ascontiguousarray(feats, dtype=np.float64)
+    sq_norms = np.array([np.dot(f, f) for f in feats])
+    uv = np.array([[np.dot(feats[i], feats[j]) for j in row] for i, row in enumerate(indices)]).reshape(indices.shape)
+    return 1 - np.clip(1.0 - uv / np.sqrt(sq_norms[:, None] * sq_norms[indices]), 0.0, 2.0)
+
 
 def get_ids_and_edges(csv_file_df, args):
     n_neigh_list = [2, 4, 8, 16, 32]
 
     if args.dataset == 'TCGA-lung-default':
         feats_csv_path = 'datasets/tcga-dataset/tcga_lung_data_feats/' + csv_file_df.iloc[0].split('/')[1] + '.csv'
+        edges_path = 'datasets/tcga-dataset/tcga_lung_data_edges_knn/edges_' + csv_file_df.iloc[0].split('/')[1] + edge_store.EDGES_EXT
         edges_csv_paths = [(f'datasets/tcga-dataset/tcga_lung_data_edges_{n}/edges_' + csv_file_df.iloc[0].split('/')[1] + '.csv') for n in n_neigh_list]
     else:
         feats_csv_path = csv_file_df.iloc[0]
-        splt = feats_csv_path.split('/')
-        edges_csv_paths = [('/'.join(splt[:-2]) + f'/edges_{n}/edges_' + splt[-1]) for n in n_neigh_list]
-
-    for dir in edges_csv_paths:
-        dir_tmp = '/'.join(dir.split('/')[:-1])
-        if not os.path.exists(dir_tmp):
-            os.mkdir(dir_tmp)
+        edges_path = edge_store.knn_path(feats_csv_path)
+        edges_csv_paths = [feature_store.edges_path(feats_csv_path, n) for n in n_neigh_list]
 
     print()
     print(feats_csv_path)
-    print(edges_csv_paths)
-
-    # Get bag in dataframe
-    df = pd.read_csv(feats_csv_path)
-    if len(df.columns) > 512:
-        df = df.set_index('Unnamed: 0', drop=True)
+    print(edges_path)
 
-    # Save so index is available
-    df.to_csv(feats_csv_path, index=True)
-
-    feats = df.to_numpy()  # [[patch embedding], [patch embedding], ...]
-    ids = list(df.index)
+    # float64 as pd.read_csv gave, the ball_tree edges are kept identical to the per-node version
+    feats = feature_store.load_feats(feats_csv_path, dtype=np.float64)  # [[patch embedding], [patch embedding], ...]
+    ids = list(range(len(feats)))
     print(len(ids))
 
     # Doing 2, 4, 8, 16, 32 neighbors
-    print('Fitting nearest neighbors')
     # Make sure n_neigh is not larger than num samples
     calc_neigh_n = min(len(ids), 32)
-    nbrs = NearestNeighbors(n_neighbors=calc_neigh_n, algorithm='ball_tree').fit(feats)
-
-    src = {n:deque() for n in n_neigh_list}
-    dst = {n:deque() for n in n_neigh_list}
-    weights = {n:deque() for n in n_neigh_list}
-    for id_a in tqdm(ids):
-        distances, indices = nbrs.kneighbors([feats[id_a]])
-        indices = indices[0]
-        distances = distances[0]
-
-        zipped_i_d = [(i, d) for i, d in zip(indices, distances)]
-        # Sort by distance
-        zipped_i_d = sorted(zipped_i_d, key=lambda x: x[1])
-        # Convert to cosine distance
-        zipped_i_d = [(i, 1 - cosine(feats[id_a], feats[i])) for i, _ in zipped_i_d]
-
-        for n in n_neigh_list:
-            neigh_list = zipped_i_d[:n]
-            for id_b, dist in neigh_list:
-                src[n].append(id_a)
-                dst[n].append(id_b)
-                weights[n].append(dist)
-
-    for nn, f_path in zip(n_neigh_list, edges_csv_paths):
-        edge_df = pd.DataFrame({'Src': src[nn], 'Dst': dst[nn], 'Weight': weights[nn]})
+    if args.search == 'ball_tree':
+        # Euclidean neighbours weighted by cosine similarity, as the first edge sets
+        print('Fitting nearest neighbors')
+        nbrs = NearestNeighbors(n_neighbors=calc_neigh_n, algorithm='ball_tree').fit(feats)
+
+        # One batched query for the whole bag, rows sorted by distance as returned
+        distances, indices = nbrs.kneighbors(feats)
+        order = np.argsort(distances, axis=1, kind='stable')
+        indices = np.take_along_axis(indices, order, axis=1)
+        weights = cosine_weights(feats, indices)
+    else:
+        print('Searching cosine nearest neighbors ({})'.format(args.search))
+        start = time.time()
+        index = knn_graph.build_index(SEARCH_INDEX[args.search], feats, calc_neigh_n, args.ann_effort, args.block_mb * 2**20)
+        indices, weights = knn_graph.knn(feats, calc_neigh_n, index)
+        print('{:.1f}s'.format(time.time() - start))
+        if args.search != 'cosine' and args.recall_sample > 0:
+            recall = knn_graph.recall_at_k(indices, feats, args.recall_sample, block_bytes=args.block_mb * 2**20)
+            print('recall@{} {:.3f} on {} nodes'.format(calc_neigh_n, recall, min(args.recall_sample, len(feats))))
+
+    # One file for all of n_neigh_list, the loaders keep the first n edges of every node
+    edge_store.save_knn(edges_path, indices, weights, max(n_neigh_list))
+    if not args.csv_edges:
+        return
+    for n, f_path in zip(n_neigh_list, edges_csv_paths):
+        os.makedirs(os.path.dirname(f_path), exist_ok=True)
+        k = min(n, indices.shape[1])
+        edge_df = pd.DataFrame({'Src': np.repeat(np.arange(len(feats), dtype=np.int64), k),
+                                'Dst': indices[:, :k].ravel(), 'Weight': weights[:, :k].ravel()})
 
         edge_df.to_csv(f_path, index=True)
 
@@ -80,7 +91,17 @@ def main():
     parser.add_argument('--dataset', default='TCGA-lung-default', type=str, help='Dataset folder name')
     parser.add_argument('--start', default=0, type=int, help='use to only run for partial dataset')
     parser.add_argument('--end', default=1048, type=int, help='use to only run for partial dataset')
+    parser.add_argument('--search', default='cosine', type=str, help='Neighbour search: exact cosine, approximate cosine for very large bags (hnsw and ivf need hnswlib / faiss), or `ball_tree` ranking by euclidean distance like the first edge sets [cosine|lsh|hnsw|ivf|ball_tree]')
+    parser.add_argument('--ann_effort', default=8, type=int, help='Recall / speed of the approximate search: lsh hash tables, hnsw ef = effort * k, ivf probed cells [8]')
+    parser.add_argument('--recall_sample', default=1000, type=int, help='Nodes checked against exact search to report the recall of an approximate search, 0 skips the check [1000]')
+    parser.add_argument('--csv_edges', default=0, type=int, help='Also write the legacy edges_<n>/ CSVs, one per number of neighbours (0/1) [0]')
+    parser.add_argument('--block_mb', default=256, type=int, help='Memory of one block of cosine similarities in MB [256]')
+    parser.add_argument('--num_threads', default=0, type=int, help='CPU threads used by torch for the cosine search, 0 keeps the torch default [0]')
     args = parser.parse_args()
+    if args.search not in SEARCH_INDEX and args.search != 'ball_tree':
+        raise ValueError('--search accepts {}|ball_tree'.format('|'.join(SEARCH_INDEX)))
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
     
     # DATASET
     if args.dataset == 'TCGA-lung-default':
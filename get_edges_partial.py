@@ -1,10 +1,13 @@
 import argparse, os, random
 from collections import deque
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from scipy.spatial.distance import cosine
 from sklearn.utils import shuffle
 
+import feature_store
+
 
 def get_ids_and_edges(csv_file_df, args):
     if args.dataset == 'TCGA-lung-default':
@@ -12,23 +15,18 @@ def get_ids_and_edges(csv_file_df, args):
         edges_csv_path = 'datasets/tcga-dataset/tcga_lung_data_edges_partial/edges_' + csv_file_df.iloc[0].split('/')[1] + '.csv'
     else:
         feats_csv_path = csv_file_df.iloc[0]
-        splt = feats_csv_path.split('/')
-        edges_csv_path = '/'.join(splt[:-2]) + '/edges_partial/edgess_' + splt[-1]
+        edges_csv_path = feature_store.edges_path(feats_csv_path, 'partial')
 
     print()
     print(feats_csv_path)
     print(edges_csv_path)
 
-    # Get bag in dataframe
-    df = pd.read_csv(feats_csv_path)
-    if len(df.columns) > 512:
-        df = df.set_index('Unnamed: 0', drop=True)
-
-    feats = df.to_numpy()  # [[patch embedding], [patch embedding], ...]
+    # float64 as pd.read_csv gave, for the same weights as before
+    feats = feature_store.load_feats(feats_csv_path, dtype=np.float64)  # [[patch embedding], [patch embedding], ...]
     src = deque()
     dst = deque()
     weights = deque()
-    ids = list(df.index)
+    ids = list(range(len(feats)))
     print(len(ids))
     for id_a in tqdm(ids):
         for id_b in set(random.choices(ids, k=100)):
@@ -41,7 +39,7 @@ def get_ids_and_edges(csv_file_df, args):
 
     edge_df = pd.DataFrame({'Src': src, 'Dst': dst, 'Weight': weights})
 
-    df.to_csv(feats_csv_path, index=True)
+    os.makedirs(os.path.dirname(edges_csv_path), exist_ok=True)
     edge_df.to_csv(edges_csv_path, index=True)
 
 
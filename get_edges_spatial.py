@@ -0,0 +1,152 @@
+import argparse, os
+import numpy as np
+import pandas as pd
+from sklearn.utils import shuffle
+
+import feature_store
+import edge_store
+import tile_decode
+
+# Edges between physically adjacent tiles of a bag, from the (col, row)
+# DeepZoom address of every feature row recorded by compute_feats.py (the
+# tile_col / tile_row / tile_mag metadata, or the `<col>_<row>` tile names).
+# Tiles of different magnifications are never connected. Neighbourhoods:
+#   4        left, right, up, down
+#   8        and the diagonals
+#   radius   every tile within `radius` tiles (euclidean)
+# Neighbours are looked up in a dense grid of the bag's bounding box (an
+# array of node ids), or in the sorted tile keys when the box is mostly
+# empty, so a bag takes O(N) lookups per offset. Edges go to
+# edges_spatial/edges_<bag>.npz (edge_store CSR), nearest first.
+MAX_GRID_CELLS_PER_TILE = 64
+
+
+def grid_offsets(connectivity=8, radius=0):
+    """(d_col, d_row) neighbour offsets and their length, nearest first."""
+    if radius > 0:
+        r = int(np.floor(radius))
+        d_col, d_row = np.meshgrid(np.arange(-r, r+1), np.arange(-r, r+1), indexing='ij')
+        d_col, d_row = d_col.ravel(), d_row.ravel()
+        keep = (d_col**2 + d_row**2 <= radius**2) & ((d_col != 0) | (d_row != 0))
+        d_col, d_row = d_col[keep], d_row[keep]
+    elif connectivity == 4:
+        d_col, d_row = np.array([-1, 1, 0, 0]), np.array([0, 0, -1, 1])
+    elif connectivity == 8:
+        d_col, d_row = np.array([-1, 1, 0, 0, -1, -1, 1, 1]), np.array([0, 0, -1, 1, -1, 1, -1, 1])
+    else:
+        raise ValueError('Connectivity is 4 or 8, or give a radius')
+    dist = np.sqrt(d_col**2 + d_row**2)
+    order = np.argsort(dist, kind='stable')
+    return np.stack([d_col[order], d_row[order]], axis=1), dist[order]
+
+
+def tile_positions(feats_path):
+    """(cols, rows, mags) of the feature rows of a bag."""
+    tiles = feature_store.load_tiles(feats_path)
+    if 'col' in tiles and 'row' in tiles:
+        cols, rows = tiles['col'], tiles['row']
+    elif 'path' in tiles:
+        positions = tile_decode.file_positions(tiles['path'].tolist())
+        cols, rows = positions[:, 0], positions[:, 1]
+    else:
+        raise ValueError('No tile positions recorded for {}, recompute its features with compute_feats.py'.format(feats_path))
+    mags = tiles['mag'] if 'mag' in tiles else np.zeros(len(cols))
+    return np.asarray(cols, dtype=np.int64), np.asarray(rows, dtype=np.int64), np.asarray(mags, dtype=np.int64)
+
+
+def grid_edges(cols, rows, mags, offsets):
+    """(src, dst, offset index) of every pair of tiles one of the offsets apart, grouped by source node."""
+    n = len(cols)
+    if n == 0 or len(offsets) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    # a margin of `span` cells keeps the neighbours inside the grid, and the
+    # magnifications sit side by side on the column axis
+    span = int(np.abs(offsets).max())
+    _, level = np.unique(mags, return_inverse=True)
+    width = int(cols.max() - cols.min()) + 2 * span + 1
+    cols = cols - cols.min() + span + level.astype(np.int64) * width
+    rows = rows - rows.min() + span
+    shape = (int(cols.max()) + span + 1, int(rows.max()) + span + 1)
+    if shape[0] * shape[1] <= MAX_GRID_CELLS_PER_TILE * n:
+        grid = np.full(shape, -1, dtype=np.int64)
+        grid[cols, rows] = np.arange(n)
+        lookup = lambda c, r: grid[c, r]
+    else:
+        keys = cols * shape[1] + rows
+        order = np.argsort(keys)
+        sorted_keys = keys[order]
+
+        def lookup(c, r):
+            key = c * shape[1] + r
+            pos = np.minimum(np.searchsorted(sorted_keys, key), n - 1)
+            return np.where(sorted_keys[pos] == key, order[pos], -1)
+    src, dst, kind = [], [], []
+    for j, (d_col, d_row) in enumerate(offsets):
+        neighbours = lookup(cols + d_col, rows + d_row)
+        found = np.flatnonzero(neighbours >= 0)
+        src.append(found)
+        dst.append(neighbours[found])
+        kind.append(np.full(len(found), j))
+    src, dst, kind = np.concatenate(src), np.concatenate(dst), np.concatenate(kind)
+    order = np.lexsort((kind, src))
+    return src[order], dst[order], kind[order]
+
+
+def edge_weights(dist, weighting='none', sigma=1.0):
+    if weighting == 'none':
+        return np.ones(len(dist), dtype=np.float32)
+    if weighting == 'inverse':
+        return (1 / dist).astype(np.float32)
+    if weighting == 'gaussian':
+        return np.exp(-dist**2 / (2 * sigma**2)).astype(np.float32)
+    raise ValueError('Unknown weighting {} [none|inverse|gaussian]'.format(weighting))
+
+
+def get_ids_and_edges(csv_file_df, args):
+    if args.dataset == 'TCGA-lung-default':
+        feats_csv_path = 'datasets/tcga-dataset/tcga_lung_data_feats/' + csv_file_df.iloc[0].split('/')[1] + '.csv'
+        edges_path = 'datasets/tcga-dataset/tcga_lung_data_edges_spatial/edges_' + csv_file_df.iloc[0].split('/')[1] + edge_store.EDGES_EXT
+    else:
+        feats_csv_path = csv_file_df.iloc[0]
+        edges_path = feature_store.edges_path(feats_csv_path, 'spatial', edge_store.EDGES_EXT)
+
+    print()
+    print(feats_csv_path)
+    print(edges_path)
+
+    cols, rows, mags = tile_positions(feats_csv_path)
+    offsets, dist = grid_offsets(args.connectivity, args.radius)
+    src, dst, kind = grid_edges(cols, rows, mags, offsets)
+    weights = edge_weights(dist[kind], args.weighting, args.sigma)
+    print('{} nodes, {} edges'.format(len(cols), len(src)))
+    edge_store.save_edges(edges_path, *edge_store.csr_from_edges(src, dst, weights, n_nodes=len(cols)))
+
+
+def main():
+    # ARGUMENTS
+    parser = argparse.ArgumentParser(description='Connect the tiles of every bag to their spatial neighbours')
+    parser.add_argument('--dataset', default='TCGA-lung-default', type=str, help='Dataset folder name')
+    parser.add_argument('--connectivity', default=8, type=int, help='Grid neighbourhood [4|8]')
+    parser.add_argument('--radius', default=0, type=float, help='Connect every tile within this many tiles instead, 0 uses --connectivity [0]')
+    parser.add_argument('--weighting', default='none', type=str, help='Edge weight from the distance in tiles: 1, 1 / d or exp(-d^2 / 2 sigma^2) [none|inverse|gaussian]')
+    parser.add_argument('--sigma', default=1.0, type=float, help='Width of the gaussian weighting in tiles [1.0]')
+    parser.add_argument('--start', default=0, type=int, help='use to only run for partial dataset')
+    parser.add_argument('--end', default=1048, type=int, help='use to only run for partial dataset')
+    args = parser.parse_args()
+
+    # DATASET
+    if args.dataset == 'TCGA-lung-default':
+        bags_csv = 'datasets/tcga-dataset/TCGA.csv'
+    else:
+        bags_csv = os.path.join('datasets', args.dataset, args.dataset+'.csv')
+
+    bags_path = pd.read_csv(bags_csv)
+    bags_path = bags_path.iloc[args.start:args.end, :]
+
+    paths = shuffle(bags_path).reset_index(drop=True)
+    for i in range(len(paths)):
+        get_ids_and_edges(paths.iloc[i], args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import os
+import time
+import threading
+import contextlib
+import torch
+import torch.nn as nn
+import torchvision.models as models
+
+import dsmil as mil
+
+# Device-agnostic inference for the embedder scripts (compute_feats.py,
+# attention_map.py, testing_*.py): the same code runs on CPU-only hosts and
+# on GPUs, with the CPU knobs (threads, channels_last, bfloat16) exposed as
+# command line arguments. embedder() builds the IClassifier of compute_feats.py
+# from a backbone name.
+BACKBONES = {'resnet18': (models.resnet18, 512), 'resnet34': (models.resnet34, 512),
+             'resnet50': (models.resnet50, 2048), 'resnet101': (models.resnet101, 2048)}
+
+
+def embedder(backbone, norm_layer=nn.InstanceNorm2d, num_classes=2):
+    """IClassifier as built by compute_feats.py, random weights."""
+    build, num_feats = BACKBONES[backbone]
+    resnet = build(norm_layer=norm_layer)
+    resnet.fc = nn.Identity()
+    return mil.IClassifier(resnet, num_feats, output_class=num_classes)
+
+
+def add_inference_args(parser):
+    parser.add_argument('--device', default='auto', type=str, help='Inference device, `auto` uses cuda when available [auto|cpu|cuda|cuda:N|mps]')
+    parser.add_argument('--num_threads', default=0, type=int, help='CPU threads used by torch, 0 keeps the torch default [0]')
+    parser.add_argument('--channels_last', default=0, type=int, help='Run the embedder in channels_last memory format, faster with batch norm, slower with instance norm on CPU (0/1) [0]')
+    parser.add_argument('--bf16', default=0, type=int, help='bfloat16 autocast, useful on CPUs with AVX512-BF16/AMX (0/1) [0]')
+    parser.add_argument('--memory_budget', default=0, type=float, help='Memory in GB the embedder may use when --batch_size is 0, 0 uses 80%% of the free GPU memory or 50%% of the available RAM [0]')
+    return parser
+
+
+def is_oom(error):
+    if isinstance(error, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(error)
+    return isinstance(error, RuntimeError) and ('out of memory' in message or "can't allocate memory" in message)
+
+
+def available_memory(device):
+    """Bytes free on a CUDA device, or available RAM for the other devices."""
+    if device.type == 'cuda':
+        return torch.cuda.mem_get_info(device)[0]
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def _rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+class _PeakRss(object):
+    """Peak resident memory while the context is open, sampled by a thread
+    (torch releases the GIL in its kernels)."""
+
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.peak = 0
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+
+    def __enter__(self):
+        self.peak = _rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+
+
+def get_device(name='auto'):
+    if name == 'auto':
+        if torch.cuda.is_available():
+            return torch.device('cuda')
+        if getattr(torch.backends, 'mps', None) is not None and torch.backends.mps.is_available():
+            return torch.device('mps')
+        return torch.device('cpu')
+    return torch.device(name)
+
+
+class InferenceEngine(object):
+    """Moves models and batches to one device and runs them without autograd."""
+
+    def __init__(self, device='auto', num_threads=0, channels_last=False, bf16=False, memory_budget=0):
+        self.device = get_device(device) if isinstance(device, str) else device
+        if num_threads > 0:
+            torch.set_num_threads(num_threads)
+        self.channels_last = bool(channels_last)
+        self.bf16 = bool(bf16) and self.device.type in ('cpu', 'cuda')
+        self.memory_budget = memory_budget
+        # largest batch run through a model at once, lowered on out of memory errors
+        self.max_batch = None
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.device, args.num_threads, args.channels_last, args.bf16, args.memory_budget)
+
+    @property
+    def accelerated(self):
+        return self.device.type != 'cpu'
+
+    def model(self, module):
+        module = module.to(self.device).eval()
+        if self.channels_last:
+            module = module.to(memory_format=torch.channels_last)
+        return module
+
+    def tensor(self, x):
+        """Batch on the device as float, uint8 images are sent as is and scaled to [0, 1] there."""
+        if x.dtype == torch.uint8:
+            x = x.to(self.device, non_blocking=True).float().div_(255)
+        else:
+            x = x.to(self.device, non_blocking=True).float()
+        if self.channels_last and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last)
+        return x
+
+    def context(self):
+        """inference_mode, plus bfloat16 autocast if enabled."""
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if self.bf16:
+            stack.enter_context(torch.autocast(self.device.type, dtype=torch.bfloat16))
+        return stack
+
+    def loader_kwargs(self, num_workers=0):
+        """DataLoader arguments: pinned memory and deeper prefetch when feeding an accelerator."""
+        kwargs = {'pin_memory': self.device.type == 'cuda'}
+        if num_workers > 0 and self.accelerated:
+            kwargs['prefetch_factor'] = 4
+        return kwargs
+
+    def run(self, model, x):
+        """model(x) in chunks of at most `max_batch`, halving it and retrying when the device runs out of memory."""
+        outputs = []
+        start = 0
+        while start < len(x):
+            chunk = x[start:start + (self.max_batch or len(x))]
+            try:
+                outputs.append(model(chunk))
+            except (RuntimeError, torch.cuda.OutOfMemoryError) as e:
+                if not is_oom(e) or len(chunk) == 1:
+                    raise
+                self.max_batch = max(1, len(chunk) // 2)
+                if self.device.type == 'cuda':
+                    torch.cuda.empty_cache()
+                print('\nOut of memory at batch size {}, backing off to {}'.format(len(chunk), self.max_batch))
+                continue
+            start += len(chunk)
+        if len(outputs) == 1:
+            return outputs[0]
+        return tuple(torch.cat(o) for o in zip(*outputs))
+
+    def budget(self):
+        if self.memory_budget > 0:
+            return int(self.memory_budget * 2**30)
+        return int(available_memory(self.device) * (0.8 if self.device.type == 'cuda' else 0.5))
+
+    def _footprint(self, model, x, base=None):
+        """(peak bytes above `base`, seconds) of one forward pass, `base` defaults to the current usage.
+        On CPU the peak is the resident memory sampled during this pass only."""
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            base = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            start = time.time()
+            model(self.tensor(x))
+            torch.cuda.synchronize(self.device)
+            return torch.cuda.max_memory_allocated(self.device) - base, time.time() - start
+        base = _rss() if base is None else base
+        with _PeakRss() as rss:
+            start = time.time()
+            model(self.tensor(x))
+            seconds = time.time() - start
+        return max(rss.peak - base, 0), seconds
+
+    def probe_batch_size(self, model, tile_size=224, max_batch=1024, min_gain=0.05):
+        """Largest power of two batch fitting in the memory budget, and its patches/sec.
+
+        Batches double until the next one (predicted to need twice the memory
+        of the current one) would exceed the budget, `max_batch` is reached,
+        or throughput stops improving by `min_gain` twice in a row. A batch
+        that runs out of memory ends the probe.
+        """
+        model = self.model(model)
+        budget = self.budget()
+        best, best_speed, used, stalled = 1, 0.0, 0, 0
+        batch = 1
+        # CPU batches are measured against the memory in use before the probe,
+        # memory the allocator keeps from a smaller batch still counts
+        base = None if self.device.type == 'cuda' else _rss()
+        with self.context():
+            while batch <= max_batch:
+                if 2 * used > budget:
+                    break
+                x = torch.rand(batch, 3, tile_size, tile_size)
+                try:
+                    # the first pass at a new size warms up the allocator, the second is timed
+                    used, _seconds = self._footprint(model, x, base)
+                    used_again, seconds = self._footprint(model, x, base)
+                    used = max(used, used_again)
+                except (RuntimeError, torch.cuda.OutOfMemoryError) as e:
+                    if not is_oom(e):
+                        raise
+                    if self.device.type == 'cuda':
+                        torch.cuda.empty_cache()
+                    break
+                if used > budget:
+                    break
+                speed = batch / seconds
+                stalled = stalled + 1 if speed < best_speed * (1 + min_gain) else 0
+                best, best_speed = batch, speed
+                if stalled == 2:
+                    break
+                batch *= 2
+        self.max_batch = best
+        return best, best_speed
+
+    def batch_size(self, model, batch_size=0, tile_size=224):
+        """`batch_size`, or the probed one if it is 0."""
+        if batch_size > 0:
+            return batch_size
+        batch_size, speed = self.probe_batch_size(model, tile_size)
+        print('Batch size {} ({:.1f} patches/sec, memory budget {:.1f} GB)'.format(batch_size, speed, self.budget() / 2**30))
+        return batch_size
+
+    def numpy(self, x):
+        return x.float().cpu().numpy()
+
+    def load(self, path):
+        """torch.load a checkpoint, tensors mapped to the CPU so GPU checkpoints load anywhere."""
+        return torch.load(path, map_location='cpu')
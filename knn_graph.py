@@ -0,0 +1,227 @@
+import numpy as np
+import torch
+
+# Cosine k nearest neighbour graphs of the patch embeddings of a bag, for the
+# edge writers (get_edges_knn.py) and graph builders.
+# Exact search: the features are L2 normalised once, the similarities of a
+# block of query rows against the whole bag come from one matrix product
+# (multithreaded by torch, see --num_threads) and only the top k of every row
+# is kept, so memory is bounded by the block (rows x N float32) instead of
+# N x N. Rows are sorted by decreasing similarity; with query ids a node is
+# always its own first neighbour, with similarity 1, as in the ball tree graphs.
+#
+# Approximate search for very large bags, `effort` trades recall for speed:
+#   lsh   random hyperplane LSH in NumPy / torch: candidates share a bucket
+#         with the query in at least one of `effort` hash tables and are
+#         ranked by exact cosine similarity
+#   hnsw  hnswlib graph (optional dependency), ef = effort * k
+#   ivf   faiss inverted lists (optional dependency), nprobe = effort
+# Rows left with less than k neighbours are searched exactly, and
+# recall_at_k measures the recall against exact search on a sample of nodes.
+BLOCK_BYTES = 256 * 2**20
+
+
+def l2_normalize(feats, eps=1e-12):
+    feats = np.asarray(feats, dtype=np.float32)
+    return feats / np.maximum(np.linalg.norm(feats, axis=1, keepdims=True), eps)
+
+
+def block_rows(n, block_bytes=BLOCK_BYTES):
+    """Query rows per block so that a rows x n float32 similarity block fits in `block_bytes`."""
+    return max(1, int(block_bytes // (4 * max(n, 1))))
+
+
+def _blocked_topk(feats, queries, k, query_ids=None, block_bytes=BLOCK_BYTES):
+    """Top k of the similarities of the torch `queries` against the torch `feats`, by blocks of query rows."""
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    sims = np.empty((len(queries), k), dtype=np.float32)
+    step = block_rows(len(feats), block_bytes)
+    with torch.inference_mode():
+        for start in range(0, len(queries), step):
+            block = torch.mm(queries[start:start+step], feats.T)
+            if query_ids is not None:
+                ids = torch.from_numpy(np.asarray(query_ids[start:start+step], dtype=np.int64))
+                # above any cosine similarity
+                block[torch.arange(len(ids)), ids] = 2.0
+            top_sims, top_idx = torch.topk(block, k, dim=1, sorted=True)
+            indices[start:start+step] = top_idx.numpy()
+            sims[start:start+step] = top_sims.clamp_(max=1.0).numpy()
+    return indices, sims
+
+
+class ExactIndex(object):
+    """Exact cosine search by blocked matrix products."""
+
+    def __init__(self, feats, block_bytes=BLOCK_BYTES):
+        self.feats = torch.from_numpy(l2_normalize(feats))
+        self.block_bytes = block_bytes
+
+    def __len__(self):
+        return len(self.feats)
+
+    def search(self, queries, k, query_ids=None):
+        """(indices int64, similarities float32), len(queries) x k, of L2 normalised queries.
+        `query_ids` are the node ids of the queries, returned as their first neighbour."""
+        queries = torch.from_numpy(np.asarray(queries, dtype=np.float32))
+        return _blocked_topk(self.feats, queries, min(k, len(self.feats)), query_ids, self.block_bytes)
+
+
+class LshIndex(object):
+    """Random hyperplane LSH over `n_tables` tables of about `bucket_size` nodes per bucket."""
+
+    def __init__(self, feats, n_tables=8, bucket_size=1024, block_bytes=BLOCK_BYTES, seed=0):
+        feats = l2_normalize(feats)
+        self.feats = torch.from_numpy(feats)
+        self.block_bytes = block_bytes
+        # hyperplanes through the mean, the embeddings sit in a narrow cone
+        self.center = feats.mean(axis=0)
+        n_bits = min(30, max(0, int(round(np.log2(len(feats) / bucket_size)))))
+        self.planes = np.random.default_rng(seed).standard_normal((n_tables, feats.shape[1], n_bits)).astype(np.float32)
+        self.tables = []
+        for t in range(n_tables):
+            codes = self._hash(feats, t)
+            order = np.argsort(codes, kind='stable')
+            self.tables.append((codes[order], order))
+
+    def __len__(self):
+        return len(self.feats)
+
+    def _hash(self, x, t):
+        bits = (x - self.center) @ self.planes[t] > 0
+        return bits.astype(np.int64) @ (1 << np.arange(bits.shape[1], dtype=np.int64))
+
+    def search(self, queries, k, query_ids=None):
+        """(indices, similarities) as ExactIndex.search, -1 / -inf where a query has less than k candidates."""
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self.feats))
+        n_tables = len(self.tables)
+        cand_idx = np.full((len(queries), n_tables * k), -1, dtype=np.int64)
+        cand_sims = np.full((len(queries), n_tables * k), -np.inf, dtype=np.float32)
+        with torch.inference_mode():
+            for t, (codes, order) in enumerate(self.tables):
+                q_codes = self._hash(queries, t)
+                q_order = np.argsort(q_codes, kind='stable')
+                buckets, q_starts = np.unique(q_codes[q_order], return_index=True)
+                q_ends = np.append(q_starts[1:], len(queries))
+                starts, ends = np.searchsorted(codes, buckets, 'left'), np.searchsorted(codes, buckets, 'right')
+                for q_start, q_end, start, end in zip(q_starts, q_ends, starts, ends):
+                    if end == start:
+                        continue
+                    members = order[start:end]
+                    rows = q_order[q_start:q_end]
+                    kk = min(k, len(members))
+                    idx, sims = _blocked_topk(self.feats[members], torch.from_numpy(queries[rows]), kk,
+                                              block_bytes=self.block_bytes)
+                    cand_idx[rows, t*k:t*k+kk] = members[idx]
+                    cand_sims[rows, t*k:t*k+kk] = sims
+        # the same neighbour found in several tables
+        order = np.argsort(cand_idx, axis=1, kind='stable')
+        sorted_idx = np.take_along_axis(cand_idx, order, axis=1)
+        dup = np.zeros(cand_idx.shape, dtype=bool)
+        dup[:, 1:] = sorted_idx[:, 1:] == sorted_idx[:, :-1]
+        np.put_along_axis(cand_sims, order, np.where(dup, -np.inf, np.take_along_axis(cand_sims, order, axis=1)), axis=1)
+        top = np.argsort(-cand_sims, axis=1, kind='stable')[:, :k]
+        indices, sims = np.take_along_axis(cand_idx, top, axis=1), np.take_along_axis(cand_sims, top, axis=1)
+        indices[np.isneginf(sims)] = -1
+        return indices, np.minimum(sims, 1.0)
+
+
+class HnswIndex(object):
+    """hnswlib inner product graph of the L2 normalised features."""
+
+    def __init__(self, feats, ef=64, M=16, ef_construction=200, num_threads=-1):
+        import hnswlib
+        feats = l2_normalize(feats)
+        self.n = len(feats)
+        self.ef = ef
+        self.num_threads = num_threads
+        self.index = hnswlib.Index(space='ip', dim=feats.shape[1])
+        self.index.init_index(max_elements=len(feats), ef_construction=ef_construction, M=M)
+        self.index.add_items(feats, np.arange(len(feats)), num_threads=num_threads)
+
+    def __len__(self):
+        return self.n
+
+    def search(self, queries, k, query_ids=None):
+        k = min(k, self.n)
+        self.index.set_ef(max(self.ef, k))
+        labels, distances = self.index.knn_query(np.asarray(queries, dtype=np.float32), k=k, num_threads=self.num_threads)
+        # ip distance is 1 - inner product
+        return labels.astype(np.int64), (1 - distances).astype(np.float32)
+
+
+class IvfIndex(object):
+    """faiss inverted lists over k-means cells of the L2 normalised features, `nprobe` cells searched per query."""
+
+    def __init__(self, feats, nprobe=8, n_lists=None):
+        import faiss
+        feats = l2_normalize(feats)
+        self.n = len(feats)
+        n_lists = n_lists or max(1, min(len(feats) // 39, int(4 * np.sqrt(len(feats)))))
+        self.quantizer = faiss.IndexFlatIP(feats.shape[1])
+        self.index = faiss.IndexIVFFlat(self.quantizer, feats.shape[1], n_lists, faiss.METRIC_INNER_PRODUCT)
+        self.index.train(feats)
+        self.index.add(feats)
+        self.index.nprobe = min(nprobe, n_lists)
+
+    def __len__(self):
+        return self.n
+
+    def search(self, queries, k, query_ids=None):
+        sims, indices = self.index.search(np.asarray(queries, dtype=np.float32), min(k, self.n))
+        return indices.astype(np.int64), sims.astype(np.float32)
+
+
+INDEXES = ('exact', 'lsh', 'hnsw', 'ivf')
+
+
+def build_index(name, feats, k, effort=8, block_bytes=BLOCK_BYTES):
+    """Search index of a bag, `effort` sets the recall of the approximate ones."""
+    if name == 'exact':
+        return ExactIndex(feats, block_bytes)
+    if name == 'lsh':
+        return LshIndex(feats, n_tables=effort, block_bytes=block_bytes)
+    if name == 'hnsw':
+        return HnswIndex(feats, ef=effort * k, num_threads=torch.get_num_threads())
+    if name == 'ivf':
+        return IvfIndex(feats, nprobe=effort)
+    raise ValueError('Unknown index {}, expected one of {}'.format(name, '|'.join(INDEXES)))
+
+
+def _self_first(indices, sims, ids):
+    """Rows with the query id first (similarity 1) and the other neighbours after it, in order."""
+    others = indices != ids[:, None]
+    order = np.argsort(~others, axis=1, kind='stable')[:, :indices.shape[1]-1]
+    indices = np.concatenate([ids[:, None], np.take_along_axis(indices, order, axis=1)], axis=1)
+    sims = np.concatenate([np.ones((len(ids), 1), dtype=np.float32), np.take_along_axis(sims, order, axis=1)], axis=1)
+    return indices, sims
+
+
+def knn(feats, k, index=None):
+    """(indices, similarities) N x k of every node of a bag, itself first then by decreasing cosine similarity."""
+    if index is None:
+        index = ExactIndex(feats)
+    ids = np.arange(len(feats))
+    queries = l2_normalize(feats)
+    indices, sims = index.search(queries, k, query_ids=ids)
+    if isinstance(index, ExactIndex):
+        return indices, sims
+    indices, sims = _self_first(indices, sims, ids)
+    missing = np.flatnonzero((indices < 0).any(axis=1))
+    if len(missing):
+        exact = _blocked_topk(torch.from_numpy(queries), torch.from_numpy(queries[missing]), indices.shape[1],
+                              missing, getattr(index, 'block_bytes', BLOCK_BYTES))
+        indices[missing], sims[missing] = exact
+    return indices, sims
+
+
+def recall_at_k(indices, feats, n_sample=1000, seed=0, block_bytes=BLOCK_BYTES):
+    """Mean recall of the neighbours `indices` (N x k, self first) against exact search, on a sample of nodes.
+    The node itself is left out of the count."""
+    k = indices.shape[1]
+    if k < 2:
+        return 1.0
+    sample = np.sort(np.random.default_rng(seed).choice(len(feats), min(n_sample, len(feats)), replace=False))
+    exact, _ = ExactIndex(feats, block_bytes).search(l2_normalize(feats[sample]), k, query_ids=sample)
+    hits = (indices[sample, 1:, None] == exact[:, None, 1:]).any(axis=2).sum(axis=1)
+    return float(hits.mean() / (k - 1))
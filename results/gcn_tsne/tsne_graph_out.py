@@ -16,15 +16,20 @@ from sklearn.metrics import roc_curve, roc_auc_score
 
 import tsne_graph_dsmil as mil
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import feature_store
+import edge_store
+
 
 def get_bag_feats_graph(csv_file_df, edges_per_node, args):
     if args.dataset == 'TCGA-lung-default':
         feats_csv_path = 'datasets/tcga-dataset/tcga_lung_data_feats/' + csv_file_df.iloc[0].split('/')[1] + '.csv'
+        edges_path = 'datasets/tcga-dataset/tcga_lung_data_edges_knn/edges_' + csv_file_df.iloc[0].split('/')[1] + edge_store.EDGES_EXT
         edges_csv_path = f'datasets/tcga-dataset/tcga_lung_data_edges_{edges_per_node}/edges_' + csv_file_df.iloc[0].split('/')[1] + '.csv'
     else:
         feats_csv_path = csv_file_df.iloc[0]
-        splt = feats_csv_path.split('/')
-        edges_csv_path = '/'.join(splt[:-2]) + f'/edges_{edges_per_node}/edges_' + splt[-1]
+        edges_path = edge_store.knn_path(feats_csv_path)
+        edges_csv_path = feature_store.edges_path(feats_csv_path, edges_per_node)
 
     # Get label for sample
     label = np.zeros(args.num_classes)
@@ -35,24 +40,21 @@ def get_bag_feats_graph(csv_file_df, edges_per_node, args):
             label[int(csv_file_df.iloc[1])] = 1
 
     # Get features in dataframe
-    node_df = pd.read_csv(feats_csv_path, index_col=0)
-    feats = node_df.to_numpy()
+    feats = feature_store.load_feats(feats_csv_path)
     
-    edge_df = pd.read_csv(edges_csv_path, index_col=0)
+    # First edges_per_node neighbours of every node, from the CSR file or a legacy CSV
+    src, dst, weight = edge_store.read_edges(edges_path, edges_per_node, edges_csv_path)
 
     # Create a DGL graph
-    src = edge_df['Src'].to_numpy()
-    dst = edge_df['Dst'].to_numpy()
     graph = dgl.graph((src, dst))
 
     # Add edge weights
-    edge_weight = torch.tensor(edge_df['Weight'].to_numpy())
+    edge_weight = torch.tensor(weight)
     graph.edata['weight'] = edge_weight
 
     # Add node features
-    for col in node_df.columns:
-        data = torch.tensor(node_df[col].to_numpy())
-        graph.ndata[col] = data
+    for col in range(feats.shape[1]):
+        graph.ndata[str(col)] = torch.tensor(feats[:, col])
 
     # Add self loops
     graph = dgl.add_self_loop(graph)
@@ -1,10 +1,13 @@
-import time
+import os, sys, time
 
 import numpy as np
 import pandas as pd
 
 from sklearn.manifold import TSNE
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import feature_store
+
 
 WEIGHTS_PATH = 'weights/04192023/13_3221.pth'
 
@@ -34,7 +37,7 @@ def tsne_plot(data, out_file):
 for num in [71, 72, 73, 77, 78, 65]:
     tumo_patch_pth = f'../../datasets/Camelyon16/1-tumor/tumor_0{num}.csv'
     tumo_tsne_output = f'./{num}.txt'
-    dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+    dat = feature_store.load_feats(tumo_patch_pth)
     f = open(tumo_tsne_output, 'w')
     tsne_plot(dat, f)
     f.close()
@@ -45,7 +48,7 @@ exit()
 # OLD
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_038.csv'
 tumo_tsne_output = './38.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -53,7 +56,7 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_039.csv'
 tumo_tsne_output = './39.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -61,7 +64,7 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_041.csv'
 tumo_tsne_output = './41.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -69,7 +72,7 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_042.csv'
 tumo_tsne_output = './42.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -77,7 +80,7 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_043.csv'
 tumo_tsne_output = './43.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -85,19 +88,19 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_049.csv'
 tumo_tsne_output = './49.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
 print('RAN TSNE FOR NORM WSI')
 
-dat = pd.read_csv(norm_patch_pth, index_col=0).values
+dat = feature_store.load_feats(norm_patch_pth)
 f = open(norm_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
 print('RAN TSNE FOR NORM WSI')
 
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
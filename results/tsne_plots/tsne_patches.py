@@ -1,10 +1,13 @@
-import time
+import os, sys, time
 
 import numpy as np
 import pandas as pd
 
 from sklearn.manifold import TSNE
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import feature_store
+
 
 norm_patch_pth = '../../datasets/Camelyon16/0-normal/normal_085.csv'
 norm_tsne_output = './norm_tsne_vals.txt'
@@ -32,7 +35,7 @@ def tsne_plot(data, out_file):
 for num in [71, 72, 73, 77, 78, 65]:
     tumo_patch_pth = f'../../datasets/Camelyon16/1-tumor/tumor_0{num}.csv'
     tumo_tsne_output = f'./{num}.txt'
-    dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+    dat = feature_store.load_feats(tumo_patch_pth)
     f = open(tumo_tsne_output, 'w')
     tsne_plot(dat, f)
     f.close()
@@ -43,7 +46,7 @@ exit()
 # OLD
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_038.csv'
 tumo_tsne_output = './38.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -51,7 +54,7 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_039.csv'
 tumo_tsne_output = './39.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -59,7 +62,7 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_041.csv'
 tumo_tsne_output = './41.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -67,7 +70,7 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_042.csv'
 tumo_tsne_output = './42.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -75,7 +78,7 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_043.csv'
 tumo_tsne_output = './43.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -83,19 +86,19 @@ print('RAN TSNE FOR NORM WSI')
 
 tumo_patch_pth = '../../datasets/Camelyon16/1-tumor/tumor_049.csv'
 tumo_tsne_output = './49.txt'
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
 print('RAN TSNE FOR NORM WSI')
 
-dat = pd.read_csv(norm_patch_pth, index_col=0).values
+dat = feature_store.load_feats(norm_patch_pth)
 f = open(norm_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
 print('RAN TSNE FOR NORM WSI')
 
-dat = pd.read_csv(tumo_patch_pth, index_col=0).values
+dat = feature_store.load_feats(tumo_patch_pth)
 f = open(tumo_tsne_output, 'w')
 tsne_plot(dat, f)
 f.close()
@@ -7,6 +7,9 @@ from torchvision import datasets
 import pandas as pd
 from PIL import Image
 from skimage import io, img_as_ubyte
+import os, sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+import tile_shard
 
 np.random.seed(0)
 
@@ -18,7 +21,10 @@ class Dataset():
         return len(self.files_list)
     def __getitem__(self, idx):
         temp_path = self.files_list.iloc[idx, 0]
-        img = Image.open(temp_path)
+        if self.files_list.shape[1] > 1: # (shard, tile index) rows
+            img = tile_shard.open_shard(temp_path).image(int(self.files_list.iloc[idx, 1]))
+        else:
+            img = Image.open(temp_path)
         img = transforms.functional.to_tensor(img)
         if self.transform:
             sample = self.transform(img)
@@ -4,17 +4,28 @@ from data_aug.dataset_wrapper import DataSetWrapper
 import os, glob
 import pandas as pd
 import argparse
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import tile_shard
+import dataset_manifest
 
 def generate_csv(args):
-    if args.level=='high' and args.multiscale==1:
-        path_temp = os.path.join('..', 'WSI', args.dataset, 'pyramid', '*', '*', '*', '*.jpeg')
-        patch_path = glob.glob(path_temp) # /class_name/bag_name/5x_name/*.jpeg
-    if args.level=='low' and args.multiscale==1:
-        path_temp = os.path.join('..', 'WSI', args.dataset, 'pyramid', '*', '*', '*.jpeg')
-        patch_path = glob.glob(path_temp) # /class_name/bag_name/*.jpeg
-    if args.multiscale==0:
-        path_temp = os.path.join('..', 'WSI', args.dataset, 'single', '*', '*', '*.jpeg')
-        patch_path = glob.glob(path_temp) # /class_name/bag_name/*.jpeg
+    layout = 'pyramid' if args.multiscale==1 else 'single'
+    manifest = dataset_manifest.load_manifest(os.path.join('..', 'WSI', args.dataset, layout))
+    level = args.level if args.multiscale==1 else 'single'
+    shard_paths = manifest.bag_paths(kinds=(dataset_manifest.SHARD,))
+    if len(shard_paths) > 0:
+        # tiles packed by `deepzoom_tiler.py --output shard`, one row per (shard, tile index)
+        rows = []
+        for shard_path in shard_paths:
+            shard = tile_shard.TileShard(shard_path)
+            rows.extend((shard_path, int(i)) for i in shard.select(shard.magnification(level)))
+        df = pd.DataFrame(rows)
+        df.to_csv('all_patches.csv', index=False)
+        return
+    # /class_name/bag_name/*.jpeg, or /class_name/bag_name/5x_name/*.jpeg for the high level
+    patch_path = [p for bag in manifest.bag_paths(kinds=(dataset_manifest.DIR,))
+                  for p in manifest.tiles(bag, level, exts=('.jpeg',))]
     df = pd.DataFrame(patch_path)
     df.to_csv('all_patches.csv', index=False)
         
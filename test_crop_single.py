@@ -9,53 +9,111 @@ from skimage import img_as_ubyte
 from os import listdir, mkdir, path, makedirs
 from os.path import join 
 import time, sys, warnings, glob
-import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
 from tqdm import tqdm
 import argparse
+import tissue_mask as tm
+import background
 warnings.simplefilter('ignore')
 
+ROW_PATCHES = 64 # longest run of patches read with one read_region
+
 def thres_saturation(img, t=15):
     # typical t = 15
-    img = rgb2hsv(img)
-    h, w, c = img.shape
-    sat_img = img[:, :, 1]
-    sat_img = img_as_ubyte(sat_img)
-    ave_sat = np.sum(sat_img) / (h * w)
-    return ave_sat >= t
+    return background.is_foreground(img[None], 'saturation', t)[0]
 
-def crop_slide(img, save_slide_path, position=(0, 0), step=(0, 0), patch_size=224): # position given as (x, y) 
-        img = img.read_region((position[0] * 4, position[1] * 4), 1, (patch_size, patch_size))
-        img = np.array(img)[..., :3]
-        if thres_saturation(img, 30):
-            patch_name = "{}_{}".format(step[0], step[1])
-            io.imsave(join(save_slide_path, patch_name + ".jpg"), img_as_ubyte(img))       
-                        
-def slide_to_patch(out_base, img_slides, step, folder='test'):
-    makedirs(out_base, exist_ok=True)
+# The patch at (row, col) is read at level 1 from the level 0 location
+# (col * step * 4, row * step * 4), as the original per-patch cropper did,
+# i.e. col * step * 4 / downsample pixels into level 1. When that is a whole
+# number of pixels (level 1 downsample 1, 2 or 4), a run of patches is sliced
+# from one read_region; otherwise every patch is read on its own.
+def row_stride(img, step_size):
+    """Level 1 pixels between two patches of a row, None if patches cannot be sliced from one read."""
+    stride = step_size * 4 / img.level_downsamples[1]
+    return int(stride) if stride == int(stride) else None
+
+def read_patches(img, row, cols, step_size, patch_size, stride):
+    y = row * step_size * 4
+    if stride is None:
+        return np.stack([np.array(img.read_region((i * step_size * 4, y), 1, (patch_size, patch_size)))[..., :3] for i in cols])
+    width = (cols[-1] - cols[0]) * stride + patch_size
+    region = np.array(img.read_region((cols[0] * step_size * 4, y), 1, (width, patch_size)))[..., :3]
+    return np.stack([region[:, (i-cols[0])*stride:(i-cols[0])*stride+patch_size] for i in cols])
+
+def crop_row(img, save_slide_path, row, cols, step_size, patch_size, executor, stride):
+    """Read a run of patches of one row and save the foreground ones."""
+    patches = read_patches(img, row, cols, step_size, patch_size, stride)
+    keep = background.is_foreground(patches, 'saturation', 30)
+    return [executor.submit(io.imsave, join(save_slide_path, "{}_{}.jpg".format(row, i)), img_as_ubyte(patch))
+            for i, patch, accepted in zip(cols, patches, keep) if accepted]
+
+def patch_runs(cols, max_run=ROW_PATCHES):
+    """Split sorted column indices into runs of adjacent columns of at most `max_run` patches."""
+    runs = np.split(cols, np.flatnonzero(np.diff(cols) != 1) + 1)
+    return [run[k:k+max_run] for run in runs if len(run) for k in range(0, len(run), max_run)]
+
+def crop_one_slide(out_base, img_slide, step, folder='test', tissue_mask=True, save_threads=4):
     patch_size = 224
     step_size = step
-    for s in range(len(img_slides)):
-        img_slide = img_slides[s]
-        img_name = img_slide.split(path.sep)[-1].split('.')[0]
-        bag_path = join(out_base, img_name)
-        makedirs(bag_path, exist_ok=True)
-        img = slide.OpenSlide(img_slide)
-        dimension = img.level_dimensions[1] # given as width, height
-        if folder=='test':
-            thumbnail = np.array(img.get_thumbnail((int(dimension[0])/7, int(dimension[1])/7)))[..., :3]
+    img_name = img_slide.split(path.sep)[-1].split('.')[0]
+    bag_path = join(out_base, img_name)
+    makedirs(bag_path, exist_ok=True)
+    img = slide.OpenSlide(img_slide)
+    dimension = img.level_dimensions[1] # given as width, height
+    if folder=='test':
+        thumbnail = np.array(img.get_thumbnail((int(dimension[0])/7, int(dimension[1])/7)))[..., :3]
+    else:
+        thumbnail = np.array(img.get_thumbnail((int(dimension[0])/28, int(dimension[1])/28)))[..., :3]
+    io.imsave(join(folder, 'thumbnails', img_name + ".png"), img_as_ubyte(thumbnail))        
+    step_y_max = int(np.floor(dimension[1]/step_size)) # rows
+    step_x_max = int(np.floor(dimension[0]/step_size)) # columns
+    tissue = np.ones((step_y_max, step_x_max), dtype=bool)
+    if tissue_mask:
+        mask_path = join(folder, 'masks', img_name + ".png")
+        if path.exists(mask_path):
+            mask = tm.load_mask(mask_path)
         else:
-            thumbnail = np.array(img.get_thumbnail((int(dimension[0])/28, int(dimension[1])/28)))[..., :3]
-        io.imsave(join(folder, 'thumbnails', img_name + ".png"), img_as_ubyte(thumbnail))        
-        step_y_max = int(np.floor(dimension[1]/step_size)) # rows
-        step_x_max = int(np.floor(dimension[0]/step_size)) # columns
+            mask = tm.tissue_mask(thumbnail)
+            tm.save_mask(mask, mask_path)
+        # level 0 footprint of the patches
+        footprint = patch_size * img.level_downsamples[1]
+        x_edges = [(i*step_size*4, i*step_size*4 + footprint) for i in range(step_x_max)]
+        y_edges = [(j*step_size*4, j*step_size*4 + footprint) for j in range(step_y_max)]
+        tissue = tm.grid_tissue(mask, img.dimensions, x_edges, y_edges)
+    stride = row_stride(img, step_size)
+    n_saved = 0
+    with ThreadPoolExecutor(max_workers=save_threads) as executor:
         for j in range(step_y_max): # rows
-            for i in range(step_x_max): # columns
-                crop_slide(img, bag_path, (i*step_size, j*step_size), step=(j, i), patch_size=patch_size)
-            sys.stdout.write('\r Cropped: {}/{} -- {}/{}'.format(s+1, len(img_slides), j+1, step_y_max))
+            futures = []
+            for cols in patch_runs(np.flatnonzero(tissue[j])):
+                futures += crop_row(img, bag_path, j, cols, step_size, patch_size, executor, stride)
+            for future in futures:
+                future.result()
+            n_saved += len(futures)
+    img.close()
+    return img_name, n_saved
+
+def slide_to_patch(out_base, img_slides, step, folder='test', tissue_mask=True, workers=1, save_threads=4):
+    """Crop all slides, `workers` slides in parallel, patches encoded by `save_threads` threads per slide."""
+    makedirs(out_base, exist_ok=True)
+    args = [(out_base, img_slide, step, folder, tissue_mask, save_threads) for img_slide in img_slides]
+    if workers > 1:
+        with Pool(workers) as pool:
+            results = pool.starmap(crop_one_slide, args, chunksize=1)
+    else:
+        results = [crop_one_slide(*a) for a in args]
+    for s, (img_name, n_saved) in enumerate(results):
+        sys.stdout.write('\r Cropped: {}/{} -- {} ({} patches)\n'.format(s+1, len(img_slides), img_name, n_saved))
                 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Generate patches from testing slides')
     parser.add_argument('--dataset', type=str, default='tcga', help='Dataset name [tcga]')
+    parser.add_argument('--tissue_mask', type=int, default=1, help='Skip background patches using a thumbnail tissue mask (0/1) [1]')
+    parser.add_argument('--workers', type=int, default=4, help='Number of slides cropped in parallel [4]')
+    parser.add_argument('--save_threads', type=int, default=4, help='Threads encoding and saving patches, per slide [4]')
+    parser.add_argument('--overlap', type=int, default=0)
+    parser.add_argument('--patch_size', type=int, default=224)
     args = parser.parse_args()
     if args.dataset == 'tcga':
         path_base = ('test/input')
@@ -68,10 +126,7 @@ if __name__ == '__main__':
         folder = ('test-c16')
         makedirs('test-c16/thumbnails', exist_ok=True)
     all_slides = glob.glob(join(path_base, '*.svs')) + glob.glob(join(path_base, '*.tif'))
-    parser.add_argument('--overlap', type=int, default=0)
-    parser.add_argument('--patch_size', type=int, default=224)
-    args = parser.parse_args()
 
     print('Cropping patches, please be patient')
     step = args.patch_size - args.overlap
-    slide_to_patch(out_base, all_slides, step, folder)
\ No newline at end of file
+    slide_to_patch(out_base, all_slides, step, folder, args.tissue_mask, args.workers, args.save_threads)
\ No newline at end of file
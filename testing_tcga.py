@@ -1,4 +1,7 @@
 import dsmil as mil
+from inference import InferenceEngine, add_inference_args
+import tile_decode
+import dataset_manifest
 
 import torch
 import torch.nn as nn
@@ -15,73 +18,38 @@ from collections import OrderedDict
 from skimage import exposure, io, img_as_ubyte, transform
 import warnings
 
-class BagDataset():
-    def __init__(self, csv_file, transform=None):
-        self.files_list = csv_file
-        self.transform = transform
-    def __len__(self):
-        return len(self.files_list)
-    def __getitem__(self, idx):
-        path = self.files_list[idx]
-        img = Image.open(path)
-        img_name = path.split(os.sep)[-1]
-        img_pos = np.asarray([int(img_name.split('.')[0].split('_')[0]), int(img_name.split('.')[0].split('_')[1])]) # row, col
-        sample = {'input': img, 'position': img_pos}
-        
-        if self.transform:
-            sample = self.transform(sample)
-        return sample 
-
-class ToTensor(object):
-    def __call__(self, sample):
-        img = sample['input']
-        img = VF.to_tensor(img)
-        sample['input'] = img
-        return sample
-    
-class Compose(object):
-    def __init__(self, transforms):
-        self.transforms = transforms
-
-    def __call__(self, img):
-        for t in self.transforms:
-            img = t(img)
-        return img
-
-def bag_dataset(args, csv_file_path):
-    transformed_dataset = BagDataset(csv_file=csv_file_path,
-                                    transform=Compose([
-                                        ToTensor()
-                                    ]))
-    dataloader = DataLoader(transformed_dataset, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, drop_last=False)
+def bag_dataset(args, csv_file_path, engine=None):
+    transformed_dataset = tile_decode.TileBatchDataset(csv_file_path, positions=tile_decode.file_positions(csv_file_path))
+    loader_kwargs = engine.loader_kwargs(args.num_workers) if engine is not None else {}
+    dataloader = tile_decode.batch_loader(transformed_dataset, args.batch_size, args.num_workers, shuffle=True, **loader_kwargs)
     return dataloader, len(transformed_dataset)
 
-def test(args, bags_list, milnet):
+def test(args, bags_list, milnet, engine, manifest):
     num_bags = len(bags_list)
     Tensor = torch.FloatTensor
     for i in range(0, num_bags):
         feats_list = []
         pos_list = []
         classes_list = []
-        csv_file_path = glob.glob(os.path.join(bags_list[i], '*.jpg'))
-        dataloader, bag_size = bag_dataset(args, csv_file_path)
-        with torch.no_grad():
+        csv_file_path = manifest.tiles(bags_list[i], exts=('.jpg',))
+        dataloader, bag_size = bag_dataset(args, csv_file_path, engine)
+        with engine.context():
             for iteration, batch in enumerate(dataloader):
-                patches = batch['input'].float().cuda()
+                patches = engine.tensor(batch['input'])
                 patch_pos = batch['position']
                 feats, classes = milnet.i_classifier(patches)
-                feats = feats.cpu().numpy()
-                classes = classes.cpu().numpy()
+                feats = feats.float().cpu().numpy()
+                classes = classes.float().cpu().numpy()
                 feats_list.extend(feats)
                 pos_list.extend(patch_pos)
                 classes_list.extend(classes)
             pos_arr = np.vstack(pos_list)
             feats_arr = np.vstack(feats_list)
             classes_arr = np.vstack(classes_list)
-            bag_feats = torch.from_numpy(feats_arr).cuda()
-            ins_classes = torch.from_numpy(classes_arr).cuda()
+            bag_feats = engine.tensor(torch.from_numpy(feats_arr))
+            ins_classes = engine.tensor(torch.from_numpy(classes_arr))
             bag_prediction, A, _ = milnet.b_classifier(bag_feats, ins_classes)
-            bag_prediction = torch.sigmoid(bag_prediction).squeeze().cpu().numpy()
+            bag_prediction = torch.sigmoid(bag_prediction).squeeze().float().cpu().numpy()
             if args.average:
                 max_prediction, _ = torch.max(ins_classes, 0) 
                 bag_prediction = (bag_prediction+max_prediction)/2
@@ -99,7 +67,7 @@ def test(args, bags_list, milnet):
             else:
                 print(bags_list[i] + ' is detected as: both LUAD and LUSC')
             color_map = np.zeros((np.amax(pos_arr, 0)[0]+1, np.amax(pos_arr, 0)[1]+1, 3))
-            attentions = attentions.cpu().numpy()
+            attentions = attentions.float().cpu().numpy()
             attentions = exposure.rescale_intensity(attentions, out_range=(0, 1))
             for k, pos in enumerate(pos_arr):
                 tile_color = np.asarray(color) * attentions[k]
@@ -117,17 +85,19 @@ if __name__ == '__main__':
     parser.add_argument('--thres_luad', type=float, default=0.7371)
     parser.add_argument('--thres_lusc', type=float, default=0.2752)
     parser.add_argument('--average', type=bool, default=True, help='Average the score of max-pooling and bag aggregating')
+    add_inference_args(parser)
     args = parser.parse_args()
+    engine = InferenceEngine.from_args(args)
     
     resnet = models.resnet18(pretrained=False, norm_layer=nn.InstanceNorm2d)
     for param in resnet.parameters():
         param.requires_grad = False
     resnet.fc = nn.Identity()
-    i_classifier = mil.IClassifier(resnet, args.feats_size, output_class=args.num_classes).cuda()
-    b_classifier = mil.BClassifier(input_size=args.feats_size, output_class=args.num_classes).cuda()
-    milnet = mil.MILNet(i_classifier, b_classifier).cuda()
+    i_classifier = mil.IClassifier(resnet, args.feats_size, output_class=args.num_classes)
+    b_classifier = mil.BClassifier(input_size=args.feats_size, output_class=args.num_classes)
+    milnet = mil.MILNet(i_classifier, b_classifier)
     
-    state_dict_weights = torch.load(os.path.join('test', 'weights', 'embedder.pth'))
+    state_dict_weights = engine.load(os.path.join('test', 'weights', 'embedder.pth'))
     new_state_dict = OrderedDict()
     for i in range(4):
         state_dict_weights.popitem()
@@ -136,11 +106,12 @@ if __name__ == '__main__':
         name = k_0
         new_state_dict[name] = v
     i_classifier.load_state_dict(new_state_dict, strict=False)
-    state_dict_weights = torch.load(os.path.join('test', 'weights', 'aggregator.pth'))
+    state_dict_weights = engine.load(os.path.join('test', 'weights', 'aggregator.pth'))
     state_dict_weights["i_classifier.fc.weight"] = state_dict_weights["i_classifier.fc.0.weight"]
     state_dict_weights["i_classifier.fc.bias"] = state_dict_weights["i_classifier.fc.0.bias"]
     milnet.load_state_dict(state_dict_weights, strict=False)
     
-    bags_list = glob.glob(os.path.join('test', 'patches', '*'))
+    manifest = dataset_manifest.load_manifest(os.path.join('test', 'patches'), class_level=False)
+    bags_list = manifest.bag_paths(kinds=(dataset_manifest.DIR,))
     os.makedirs(os.path.join('test', 'output'), exist_ok=True)
-    test(args, bags_list, milnet)
\ No newline at end of file
+    test(args, bags_list, engine.model(milnet), engine, manifest)
\ No newline at end of file
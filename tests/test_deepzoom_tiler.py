@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+pytest.importorskip('tifffile')
+import bench_tiler
+from deepzoom_tiler import TileWorker
+
+
+def block_tiles(worker, image, dz, level, block_size):
+    """Every tile of a DeepZoom level, read by blocks as the tiler does."""
+    cols, rows = dz.level_tiles[level]
+    tiles = {}
+    for row0 in range(0, rows, block_size):
+        for col0 in range(0, cols, block_size):
+            todo = np.ones((min(block_size, rows-row0), min(block_size, cols-col0)), dtype=bool)
+            tiles.update(worker._tiles(image, dz, level, (col0, row0), todo))
+    return tiles
+
+
+# 3001 px gives slide level downsamples 1, 1.9993, 3.996
+@pytest.mark.parametrize('size', [3001, 1024])
+def test_block_tiles_match_get_tile(tmp_path, size):
+    slide_path = str(tmp_path / 'slide.tiff')
+    bench_tiler.synthetic_slide(slide_path, size=size, levels=3)
+    worker = TileWorker(None, 224, 0, True, 70, 15)
+    image, dz = worker._get_dz(slide_path)
+    for level in range(dz.level_count):
+        tiles = block_tiles(worker, image, dz, level, 8)
+        cols, rows = dz.level_tiles[level]
+        assert len(tiles) == cols * rows
+        for address, tile in tiles.items():
+            np.testing.assert_array_equal(tile, np.asarray(dz.get_tile(level, address)), err_msg='level {} tile {}'.format(level, address))
@@ -0,0 +1,66 @@
+import os
+import sys
+import types
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.models as models
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dsmil as mil
+import compute_feats
+import feature_cache
+from inference import InferenceEngine
+
+
+def simclr_checkpoint():
+    torch.manual_seed(0)
+    resnet = models.resnet18(norm_layer=nn.InstanceNorm2d)
+    resnet.fc = nn.Identity()
+    state_dict = OrderedDict(('features.' + k, v) for k, v in resnet.state_dict().items())
+    # projection head, dropped when loading
+    for name, shape in (('l1.weight', (512, 512)), ('l1.bias', (512,)), ('l2.weight', (256, 512)), ('l2.bias', (256,))):
+        state_dict[name] = torch.randn(shape)
+    return state_dict
+
+
+def embedder(checkpoint):
+    resnet = models.resnet18(norm_layer=nn.InstanceNorm2d)
+    resnet.fc = nn.Identity()
+    # a fresh random fc on every run, as in compute_feats.py
+    i_classifier = mil.IClassifier(resnet, 512, output_class=2)
+    compute_feats.load_simclr_weights(i_classifier, checkpoint)
+    return i_classifier.eval()
+
+
+def test_same_weights_hit_the_cache(tmp_path):
+    rng = np.random.default_rng(0)
+    tiles = []
+    for i in range(6):
+        path = str(tmp_path / '{}_0.jpeg'.format(i))
+        Image.fromarray(rng.integers(0, 255, (64, 64, 3), dtype=np.uint8)).save(path)
+        tiles.append(path)
+    args = types.SimpleNamespace(batch_size=4, num_workers=0, input_size=0)
+    checkpoint = simclr_checkpoint()
+    engine = InferenceEngine('cpu')
+    cache = feature_cache.FeatureCache(str(tmp_path / 'cache.sqlite'))
+
+    runs = []
+    for run in range(2):
+        model = embedder(checkpoint)
+        key = feature_cache.embedder_key(model, 'resnet18', 'instance')
+        view = cache.embedder(key, 'resnet18', 'instance')
+        hits = view.get(feature_cache.tile_keys(tiles))[2]
+        with engine.context():
+            feats, _ = compute_feats.embed_patches(args, tiles, engine.model(model), engine, cache=view)
+        runs.append((key, hits, feats))
+
+    (key_a, hits_a, feats_a), (key_b, hits_b, feats_b) = runs
+    assert key_a == key_b
+    assert len(cache.embedders()) == 1
+    assert not hits_a.any() and hits_b.all()
+    np.testing.assert_array_equal(feats_a, feats_b)
+    cache.close()
@@ -0,0 +1,61 @@
+import os
+import sys
+import types
+from collections import deque
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial.distance import cosine
+from sklearn.neighbors import NearestNeighbors
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import get_edges_knn
+
+N_NEIGH_LIST = [2, 4, 8, 16, 32]
+
+
+def baseline_edges(feats_csv_path):
+    """The per-node ball_tree loop get_edges_knn.py started from."""
+    splt = feats_csv_path.split('/')
+    edges_csv_paths = [('/'.join(splt[:-2]) + f'/edges_{n}/edges_' + splt[-1]) for n in N_NEIGH_LIST]
+    df = pd.read_csv(feats_csv_path)
+    if len(df.columns) > 512:
+        df = df.set_index('Unnamed: 0', drop=True)
+    feats = df.to_numpy()
+    ids = list(df.index)
+    calc_neigh_n = min(len(ids), 32)
+    nbrs = NearestNeighbors(n_neighbors=calc_neigh_n, algorithm='ball_tree').fit(feats)
+    src = {n: deque() for n in N_NEIGH_LIST}
+    dst = {n: deque() for n in N_NEIGH_LIST}
+    weights = {n: deque() for n in N_NEIGH_LIST}
+    for id_a in ids:
+        distances, indices = nbrs.kneighbors([feats[id_a]])
+        zipped_i_d = sorted(zip(indices[0], distances[0]), key=lambda x: x[1])
+        zipped_i_d = [(i, 1 - cosine(feats[id_a], feats[i])) for i, _ in zipped_i_d]
+        for n in N_NEIGH_LIST:
+            for id_b, dist in zipped_i_d[:n]:
+                src[n].append(id_a)
+                dst[n].append(id_b)
+                weights[n].append(dist)
+    for n, f_path in zip(N_NEIGH_LIST, edges_csv_paths):
+        os.makedirs(os.path.dirname(f_path), exist_ok=True)
+        pd.DataFrame({'Src': src[n], 'Dst': dst[n], 'Weight': weights[n]}).to_csv(f_path, index=True)
+    return edges_csv_paths
+
+
+# a bag smaller than the largest k, and one with duplicated feature rows
+@pytest.mark.parametrize('n_rows, n_duplicates', [(20, 0), (120, 40)])
+def test_ball_tree_csvs_match_baseline(tmp_path, monkeypatch, n_rows, n_duplicates):
+    rng = np.random.default_rng(n_rows)
+    feats = rng.random((n_rows, 512))
+    feats[rng.choice(n_rows, n_duplicates, replace=False)] = feats[rng.choice(n_rows, n_duplicates)]
+    for root in ('new', 'baseline'):
+        os.makedirs(tmp_path / root / 'd' / 'c')
+        pd.DataFrame(feats).to_csv(tmp_path / root / 'd' / 'c' / 'bag.csv', index=False, float_format='%.4f')
+    monkeypatch.chdir(tmp_path)
+    args = types.SimpleNamespace(dataset='d', search='ball_tree', csv_edges=1)
+    get_edges_knn.get_ids_and_edges(pd.Series(['new/d/c/bag.csv']), args)
+    for path in baseline_edges('baseline/d/c/bag.csv'):
+        with open(path) as f, open(path.replace('baseline', 'new', 1)) as g:
+            assert f.read() == g.read(), path
@@ -0,0 +1,123 @@
+import os
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+
+import openslide
+from openslide import open_slide
+
+# Accepted tiles of a slide stored as coordinates only. Every row holds the
+# DeepZoom address of the tile (mag, col, row) and the arguments DeepZoom
+# passes to `read_region` (level 0 location, slide level, region size), plus
+# the DeepZoom tile size the region is scaled to. Pixels are read from the
+# slide on demand, so nothing is re-encoded and tiles stay lossless.
+COORDS_DTYPE = np.dtype([('mag', '<i2'), ('col', '<i4'), ('row', '<i4'),
+                         ('x', '<i8'), ('y', '<i8'), ('slide_level', '<i2'),
+                         ('width', '<i4'), ('height', '<i4'),
+                         ('tile_width', '<i4'), ('tile_height', '<i4')])
+COORDS_EXT = '.coords.npz'
+
+
+def coords_name(coords_path):
+    return os.path.basename(coords_path)[:-len(COORDS_EXT)]
+
+
+def tile_record(dz, mag, level, address):
+    """Coordinate record of one DeepZoom tile, see COORDS_DTYPE."""
+    (x, y), slide_level, (width, height) = dz.get_tile_coordinates(level, address)
+    tile_width, tile_height = dz.get_tile_dimensions(level, address)
+    return (mag, address[0], address[1], x, y, slide_level, width, height, tile_width, tile_height)
+
+
+def save_coords(coords_path, records, slide_path, tile_size, level_factor=None):
+    """Write the accepted tile records of a slide.
+
+    With two magnifications and `level_factor` given, high magnification tiles
+    whose low magnification parent was rejected are dropped, matching the
+    pyramid layout written by `nested_patches`.
+    """
+    coords = np.array(sorted(records), dtype=COORDS_DTYPE)
+    mags = np.unique(coords['mag'])
+    if level_factor is not None and len(mags) == 2:
+        low = coords[coords['mag'] == mags[0]]
+        parents = set(zip(low['col'].tolist(), low['row'].tolist()))
+        keep = [m == mags[0] or (c//level_factor, r//level_factor) in parents
+                for m, c, r in zip(coords['mag'], coords['col'], coords['row'])]
+        coords = coords[np.asarray(keep, dtype=bool)]
+    os.makedirs(os.path.dirname(coords_path) or '.', exist_ok=True)
+    with open(coords_path, 'wb') as f:
+        np.savez(f, coords=coords, slide_path=np.array(os.path.abspath(slide_path)), tile_size=np.array(tile_size))
+    return len(coords)
+
+
+# A few handles per process, least recently used closed first, so a process
+# walking a large cohort does not keep every slide open.
+MAX_OPEN_SLIDES = 4
+_open_slides = OrderedDict()
+
+def get_slide(slide_path):
+    """One OpenSlide handle per slide and process (DataLoader workers included)."""
+    key = (os.getpid(), slide_path)
+    slide = _open_slides.get(key)
+    if slide is None:
+        # handles inherited from the parent process are left to it
+        for k in [k for k in _open_slides if k[0] != key[0]]:
+            del _open_slides[k]
+        while len(_open_slides) >= MAX_OPEN_SLIDES:
+            _open_slides.popitem(last=False)[1].close()
+        slide = open_slide(slide_path)
+        _open_slides[key] = slide
+    else:
+        _open_slides.move_to_end(key)
+    return slide
+
+
+class TileCoords(object):
+    """Reads the tiles of a coordinate file straight from the slide."""
+
+    def __init__(self, coords_path, slide_path=None):
+        data = np.load(coords_path)
+        self.path = coords_path
+        self.coords = data['coords']
+        self.slide_path = slide_path or str(data['slide_path'])
+        self.tile_size = int(data['tile_size'])
+
+    def __len__(self):
+        return len(self.coords)
+
+    @property
+    def mags(self):
+        return sorted(np.unique(self.coords['mag']).tolist())
+
+    def magnification(self, level):
+        """Magnification of the `low` / `high` pyramid level, None for `single`."""
+        if level == 'low':
+            return self.mags[0]
+        if level == 'high':
+            return self.mags[-1]
+        return None
+
+    def select(self, mag=None):
+        if mag is None:
+            return np.arange(len(self.coords))
+        return np.flatnonzero(self.coords['mag'] == mag)
+
+    def position(self, idx):
+        entry = self.coords[idx]
+        return int(entry['col']), int(entry['row'])
+
+    def image(self, idx):
+        """Same pixels as DeepZoomGenerator.get_tile followed by the tiler resize."""
+        entry = self.coords[idx]
+        slide = get_slide(self.slide_path)
+        tile = slide.read_region((int(entry['x']), int(entry['y'])), int(entry['slide_level']),
+                                 (int(entry['width']), int(entry['height'])))
+        bg_color = '#' + slide.properties.get(openslide.PROPERTY_NAME_BACKGROUND_COLOR, 'ffffff')
+        bg = Image.new('RGB', tile.size, bg_color)
+        tile = Image.composite(tile, bg, tile)
+        tile_dim = (int(entry['tile_width']), int(entry['tile_height']))
+        if tile.size != tile_dim:
+            tile.thumbnail(tile_dim, getattr(Image, 'Resampling', Image).LANCZOS)
+        if tile.size != (self.tile_size, self.tile_size):
+            tile = tile.resize((self.tile_size, self.tile_size))
+        return tile
@@ -0,0 +1,108 @@
+import io
+import os
+import zlib
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler, RandomSampler
+from torchvision.io import decode_jpeg, ImageReadMode
+from PIL import Image
+
+# Batched tile decoding for the embedder scripts. A dataset item is a whole
+# batch: the encoded tiles are read, decoded together by libjpeg-turbo
+# (torchvision.io.decode_jpeg) into one N x 3 x H x W uint8 tensor inside the
+# DataLoader worker, and converted to float once on the batch by
+# InferenceEngine.tensor. Pixels are the same as PIL decoding.
+#
+# With `size` smaller than the tiles, JPEGs are decoded at a reduced DCT
+# scale (1/2, 1/4, 1/8, via PIL's draft mode) and resized to `size`.
+JPEG_SOI = b'\xff\xd8'
+
+
+def _resample():
+    return getattr(Image, 'Resampling', Image).BILINEAR
+
+
+def pil_to_uint8(img, size=None):
+    """3 x H x W uint8 tensor of a PIL image, resized to size x size if given."""
+    img = img.convert('RGB')
+    if size is not None and img.size != (size, size):
+        img = img.resize((size, size), _resample())
+    return torch.from_numpy(np.asarray(img).copy()).permute(2, 0, 1)
+
+
+def decode_reduced(data, size):
+    img = Image.open(io.BytesIO(data))
+    # draft picks the smallest DCT scale still >= size
+    img.draft('RGB', (size, size))
+    return pil_to_uint8(img, size)
+
+
+def decode_batch(datas, size=None):
+    """N x 3 x H x W uint8 tensor of a list of encoded tiles."""
+    if size is None and all(d[:2] == JPEG_SOI for d in datas):
+        tensors = [torch.frombuffer(bytearray(d), dtype=torch.uint8) for d in datas]
+        return torch.stack(decode_jpeg(tensors, mode=ImageReadMode.RGB))
+    if size is not None:
+        return torch.stack([decode_reduced(d, size) if d[:2] == JPEG_SOI else pil_to_uint8(Image.open(io.BytesIO(d)), size)
+                            for d in datas])
+    return torch.stack([pil_to_uint8(Image.open(io.BytesIO(d))) for d in datas])
+
+
+def pixel_crc32(batch):
+    """CRC32 of the H x W x 3 pixels of every tile of a uint8 batch, same as zlib.crc32 of the RGB image."""
+    pixels = batch.permute(0, 2, 3, 1).contiguous().numpy()
+    return torch.tensor([zlib.crc32(p.tobytes()) for p in pixels], dtype=torch.int64)
+
+
+def tile_size(tile, source=None):
+    """Longest side of a tile (file path, or index into a `source` as in TileBatchDataset), from its header."""
+    if source is not None and not hasattr(source, 'read'):
+        return source.tile_size
+    with Image.open(io.BytesIO(source.read(tile)) if source is not None else tile) as img:
+        return max(img.size)
+
+
+def file_positions(paths):
+    """N x 2 (col, row) array of tiles named `<col>_<row>.<ext>`."""
+    names = [os.path.basename(p).split('.')[0].split('_') for p in paths]
+    return np.array([(int(n[0]), int(n[1])) for n in names], dtype=np.int64).reshape(-1, 2)
+
+
+class TileBatchDataset(object):
+    """Indexed by lists of tiles, returns {'input': N x 3 x H x W uint8, 'crc32': N} (and 'position': N x 2 if given).
+
+    Tiles are file paths, or indices into a `source` with either `read(idx)`
+    (encoded bytes, TileShard) or `image(idx)` (PIL image, TileCoords).
+    """
+
+    def __init__(self, tiles, source=None, size=None, positions=None):
+        self.tiles = tiles
+        self.source = source
+        self.size = size
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.tiles)
+
+    def read(self, idx):
+        if self.source is not None:
+            return self.source.read(self.tiles[idx])
+        with open(self.tiles[idx], 'rb') as f:
+            return f.read()
+
+    def __getitem__(self, indices):
+        if self.source is not None and not hasattr(self.source, 'read'):
+            batch = torch.stack([pil_to_uint8(self.source.image(self.tiles[i]), self.size) for i in indices])
+        else:
+            batch = decode_batch([self.read(i) for i in indices], self.size)
+        sample = {'input': batch, 'crc32': pixel_crc32(batch)}
+        if self.positions is not None:
+            sample['position'] = torch.from_numpy(self.positions[indices])
+        return sample
+
+
+def batch_loader(dataset, batch_size, num_workers=0, shuffle=False, **kwargs):
+    """DataLoader handing whole batches of indices to a TileBatchDataset."""
+    indices = range(len(dataset))
+    sampler = BatchSampler(RandomSampler(indices) if shuffle else SequentialSampler(indices), batch_size, drop_last=False)
+    return DataLoader(dataset, sampler=sampler, batch_size=None, num_workers=num_workers, **kwargs)
@@ -0,0 +1,67 @@
+import os
+import json
+import time
+import shutil
+import threading
+
+MANIFEST_NAME = 'tiling_manifest.json'
+
+# One JSON file per dataset recording every finished slide output, keyed by
+# the output location (pyramid / single folder, shard or coordinate file):
+#   {output: {'slide', 'status', 'params', 'n_tiles', 'finished'}}
+# A slide is skipped when its output is recorded as done with the same
+# tiling parameters, and redone (old output removed) when they changed.
+
+
+def _normalize(params):
+    # tuples come back from JSON as lists
+    return json.loads(json.dumps(params, sort_keys=True))
+
+
+class TileManifest(object):
+    """Completion record of a tiling job, safe to update from several threads."""
+
+    def __init__(self, manifest_path):
+        self.path = manifest_path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.entries = json.load(f)
+
+    def is_done(self, output, params):
+        entry = self.entries.get(output)
+        return (entry is not None and entry['status'] == 'done'
+                and entry['params'] == _normalize(params) and os.path.exists(output))
+
+    def is_stale(self, output, params):
+        """True if `output` was written with other parameters."""
+        entry = self.entries.get(output)
+        return entry is not None and entry['params'] != _normalize(params)
+
+    def mark_done(self, output, slide, params, n_tiles):
+        with self._lock:
+            self.entries[output] = {'slide': slide, 'status': 'done', 'params': _normalize(params),
+                                    'n_tiles': int(n_tiles), 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+            self._save()
+
+    def forget(self, output):
+        with self._lock:
+            if self.entries.pop(output, None) is not None:
+                self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = self.path + '.part'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def remove_output(output, extra_paths=()):
+    """Delete a previous slide output (folder or file) before it is redone."""
+    for path in (output,) + tuple(extra_paths):
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.exists(path):
+            os.remove(path)
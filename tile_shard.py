@@ -0,0 +1,163 @@
+import io
+import os
+import glob
+import tarfile
+import numpy as np
+from PIL import Image
+
+# One uncompressed tar per slide holding the encoded tiles, plus a `.idx.npy`
+# table with the byte offset of every member so tiles can be read with a
+# single pread instead of a filesystem lookup per tile.
+INDEX_DTYPE = np.dtype([('mag', '<i2'), ('col', '<i4'), ('row', '<i4'), ('offset', '<i8'), ('size', '<i4')])
+SHARD_EXT = '.tar'
+INDEX_EXT = '.idx.npy'
+
+
+def index_path(shard_path):
+    return os.path.splitext(shard_path)[0] + INDEX_EXT
+
+
+def shard_name(shard_path):
+    return os.path.splitext(os.path.basename(shard_path))[0]
+
+
+class TileShardWriter(object):
+    """Appends encoded tiles to a slide shard and writes its index on close."""
+
+    def __init__(self, shard_path):
+        os.makedirs(os.path.dirname(shard_path) or '.', exist_ok=True)
+        self._path = shard_path
+        self._tmp_path = shard_path + '.part'
+        self._tar = tarfile.open(self._tmp_path, 'w', format=tarfile.GNU_FORMAT)
+        self._index = []
+
+    def add(self, mag, col, row, data, ext='jpeg'):
+        info = tarfile.TarInfo('%d/%d_%d.%s' % (mag, col, row, ext))
+        info.size = len(data)
+        self._tar.addfile(info, io.BytesIO(data))
+        # the member data ends on the (block padded) current tar offset
+        blocks = -(-info.size // tarfile.BLOCKSIZE)
+        offset = self._tar.offset - blocks * tarfile.BLOCKSIZE
+        self._index.append((mag, col, row, offset, info.size))
+
+    def close(self):
+        self._tar.close()
+        index = np.array(self._index, dtype=INDEX_DTYPE)
+        np.save(index_path(self._path), index)
+        os.replace(self._tmp_path, self._path)
+        return len(index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._tar.close()
+            os.remove(self._tmp_path)
+
+
+class TileShard(object):
+    """Random access reader for a slide shard.
+
+    The file descriptor is opened lazily and per process, so a TileShard can be
+    handed to DataLoader workers and each worker gets its own handle.
+    """
+
+    def __init__(self, shard_path):
+        self.path = shard_path
+        self.index = np.load(index_path(shard_path))
+        self._fd = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        state['_pid'] = None
+        return state
+
+    @property
+    def mags(self):
+        return sorted(np.unique(self.index['mag']).tolist())
+
+    def magnification(self, level):
+        """Magnification of the `low` / `high` pyramid level, None for `single`."""
+        if level == 'low':
+            return self.mags[0]
+        if level == 'high':
+            return self.mags[-1]
+        return None
+
+    def select(self, mag=None):
+        """Indices of the tiles at magnification `mag` (all tiles if None)."""
+        if mag is None:
+            return np.arange(len(self.index))
+        return np.flatnonzero(self.index['mag'] == mag)
+
+    def read(self, idx):
+        if self._fd is None or self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDONLY)
+            self._pid = os.getpid()
+        entry = self.index[idx]
+        return os.pread(self._fd, int(entry['size']), int(entry['offset']))
+
+    def image(self, idx):
+        img = Image.open(io.BytesIO(self.read(idx)))
+        img.load()
+        return img
+
+    def position(self, idx):
+        entry = self.index[idx]
+        return int(entry['col']), int(entry['row'])
+
+    def close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+_open_shards = {}
+
+def open_shard(shard_path):
+    """Cached TileShard per path, for datasets that address tiles as (shard, index)."""
+    shard = _open_shards.get(shard_path)
+    if shard is None:
+        shard = TileShard(shard_path)
+        _open_shards[shard_path] = shard
+    return shard
+
+
+def pack_patches(tile_dir, shard_path, ext='jpeg', level_factor=None):
+    """Pack a `<tile_dir>/<mag>/<col>_<row>.<ext>` tiler output into one shard.
+
+    With two magnifications and `level_factor` given, high magnification tiles
+    whose low magnification parent was filtered out are dropped, like
+    `nested_patches` does for the pyramid layout.
+    """
+    mag_dirs = sorted(glob.glob(os.path.join(tile_dir, '*')), key=lambda p: int(os.path.basename(p)))
+    tiles = []
+    for mag_dir in mag_dirs:
+        with os.scandir(mag_dir) as entries:
+            names = sorted(e.name for e in entries if e.name.endswith('.' + ext))
+        tiles.append([(mag_dir, name, *map(int, name.split('.')[0].split('_'))) for name in names])
+    if level_factor is not None and len(tiles) == 2:
+        parents = set((col, row) for _, _, col, row in tiles[0])
+        tiles[1] = [t for t in tiles[1] if (t[2]//level_factor, t[3]//level_factor) in parents]
+    n_tiles = 0
+    with TileShardWriter(shard_path) as writer:
+        for mag_tiles in tiles:
+            for mag_dir, name, col, row in mag_tiles:
+                with open(os.path.join(mag_dir, name), 'rb') as f:
+                    writer.add(int(os.path.basename(mag_dir)), col, row, f.read(), ext)
+                n_tiles += 1
+    return n_tiles
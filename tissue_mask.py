@@ -0,0 +1,108 @@
+import os
+import numpy as np
+from scipy import ndimage
+from skimage import io, filters, morphology
+from skimage.color import rgb2hsv
+from skimage.util import img_as_ubyte
+
+import openslide
+
+THUMBNAIL_SIZE = 2048 # longest side of the thumbnail used to build the mask
+MIN_SATURATION = 0.05 # lower bound of the Otsu threshold, keeps blank slides empty
+
+
+def tissue_mask(thumbnail, min_saturation=MIN_SATURATION, dilation=1):
+    """Boolean tissue mask from an RGB thumbnail (Otsu on HSV saturation)."""
+    sat = rgb2hsv(np.asarray(thumbnail)[..., :3])[..., 1]
+    if sat.max() - sat.min() < 1e-3:
+        thres = min_saturation
+    else:
+        thres = max(filters.threshold_otsu(sat), min_saturation)
+    mask = sat > thres
+    if dilation > 0:
+        mask = ndimage.binary_dilation(mask, structure=morphology.disk(dilation))
+    return mask
+
+
+def slide_tissue_mask(slide, size=THUMBNAIL_SIZE):
+    """Tissue mask of a whole slide, computed on its thumbnail (covers level 0)."""
+    thumbnail = slide.get_thumbnail((size, size))
+    return tissue_mask(np.array(thumbnail)[..., :3])
+
+
+def save_mask(mask, mask_path):
+    os.makedirs(os.path.dirname(mask_path) or '.', exist_ok=True)
+    io.imsave(mask_path, img_as_ubyte(mask), check_contrast=False)
+
+
+def load_mask(mask_path):
+    return io.imread(mask_path) > 0
+
+
+def load_or_create_mask(slide, mask_path, size=THUMBNAIL_SIZE):
+    """Reuse a saved mask if present so masks can be inspected or edited by hand."""
+    if os.path.exists(mask_path):
+        return load_mask(mask_path)
+    mask = slide_tissue_mask(slide, size)
+    save_mask(mask, mask_path)
+    return mask
+
+
+def grid_tissue(mask, slide_size, x_edges, y_edges, min_tissue=0.0):
+    """Tissue test for a rectangular grid of level 0 regions.
+
+    `x_edges` / `y_edges` are (N, 2) arrays of [start, end) level 0 pixel
+    coordinates for every column / row of the grid and `slide_size` is the
+    level 0 (width, height) covered by `mask`. Returns a (rows, cols) boolean
+    array which is True where the tissue fraction exceeds `min_tissue`.
+    """
+    mask_h, mask_w = mask.shape
+    sx = mask_w / float(slide_size[0])
+    sy = mask_h / float(slide_size[1])
+    x_edges = np.asarray(x_edges, dtype=np.float64)
+    y_edges = np.asarray(y_edges, dtype=np.float64)
+    x0 = np.clip(np.floor(x_edges[:, 0] * sx), 0, mask_w - 1).astype(np.int64)
+    x1 = np.clip(np.ceil(x_edges[:, 1] * sx), 0, mask_w).astype(np.int64)
+    y0 = np.clip(np.floor(y_edges[:, 0] * sy), 0, mask_h - 1).astype(np.int64)
+    y1 = np.clip(np.ceil(y_edges[:, 1] * sy), 0, mask_h).astype(np.int64)
+    x1 = np.maximum(x1, x0 + 1)
+    y1 = np.maximum(y1, y0 + 1)
+    # integral image, one lookup per grid cell
+    integral = np.zeros((mask_h + 1, mask_w + 1), dtype=np.int64)
+    integral[1:, 1:] = np.cumsum(np.cumsum(mask, axis=0), axis=1)
+    tissue = (integral[y1[:, None], x1[None, :]] - integral[y0[:, None], x1[None, :]]
+              - integral[y1[:, None], x0[None, :]] + integral[y0[:, None], x0[None, :]])
+    area = (y1 - y0)[:, None] * (x1 - x0)[None, :]
+    return tissue > min_tissue * area
+
+
+def deepzoom_bounds(slide, limit_bounds=True):
+    """Level 0 (offset, size) of the region a DeepZoomGenerator tiles."""
+    width, height = slide.dimensions
+    if not limit_bounds:
+        return (0, 0), (width, height)
+    props = slide.properties
+    x = int(props.get(openslide.PROPERTY_NAME_BOUNDS_X, 0))
+    y = int(props.get(openslide.PROPERTY_NAME_BOUNDS_Y, 0))
+    w = int(props.get(openslide.PROPERTY_NAME_BOUNDS_WIDTH, width))
+    h = int(props.get(openslide.PROPERTY_NAME_BOUNDS_HEIGHT, height))
+    return (x, y), (w, h)
+
+
+def deepzoom_tile_mask(mask, slide, dz, level, tile_size, overlap=0, limit_bounds=True, min_tissue=0.0):
+    """Map a slide tissue mask onto the (rows, cols) tile grid of a DeepZoom level."""
+    cols, rows = dz.level_tiles[level]
+    level_w, level_h = dz.level_dimensions[level]
+    (off_x, off_y), (l0_w, l0_h) = deepzoom_bounds(slide, limit_bounds)
+
+    def edges(n, level_size, l0_size, offset):
+        start = np.arange(n) * tile_size - overlap
+        end = np.arange(1, n + 1) * tile_size + overlap
+        start = np.clip(start, 0, level_size)
+        end = np.clip(end, 0, level_size)
+        scale = l0_size / float(level_size)
+        return np.stack([start * scale + offset, end * scale + offset], axis=1)
+
+    x_edges = edges(cols, level_w, l0_w, off_x)
+    y_edges = edges(rows, level_h, l0_h, off_y)
+    return grid_tissue(mask, slide.dimensions, x_edges, y_edges, min_tissue)
@@ -14,15 +14,17 @@ from tqdm import tqdm
 from sklearn.utils import shuffle
 from sklearn.metrics import roc_curve, roc_auc_score
 
+import feature_store
+import edge_store
+
 
 def get_bag_feats(csv_file_df, args):
     if args.dataset == 'TCGA-lung-default':
         feats_csv_path = 'datasets/tcga-dataset/tcga_lung_data_feats/' + csv_file_df.iloc[0].split('/')[1] + '.csv'
     else:
         feats_csv_path = csv_file_df.iloc[0]
-    df = pd.read_csv(feats_csv_path, index_col=0)
-    feats = shuffle(df).reset_index(drop=True)
-    feats = feats.to_numpy()
+    feats = feature_store.load_feats(feats_csv_path)
+    feats = shuffle(feats)
     label = np.zeros(args.num_classes)
     if args.num_classes==1:
         label[0] = csv_file_df.iloc[1]
@@ -35,11 +37,15 @@ def get_bag_feats(csv_file_df, args):
 def get_bag_feats_graph(csv_file_df, edges_per_node, args):
     if args.dataset == 'TCGA-lung-default':
         feats_csv_path = 'datasets/tcga-dataset/tcga_lung_data_feats/' + csv_file_df.iloc[0].split('/')[1] + '.csv'
+        edges_path = f'datasets/tcga-dataset/tcga_lung_data_edges_{args.graph}/edges_' + csv_file_df.iloc[0].split('/')[1] + edge_store.EDGES_EXT
         edges_csv_path = f'datasets/tcga-dataset/tcga_lung_data_edges_{edges_per_node}/edges_' + csv_file_df.iloc[0].split('/')[1] + '.csv'
     else:
         feats_csv_path = csv_file_df.iloc[0]
-        splt = feats_csv_path.split('/')
-        edges_csv_path = '/'.join(splt[:-2]) + f'/edges_{edges_per_node}/edges_' + splt[-1]
+        edges_path = feature_store.edges_path(feats_csv_path, args.graph, edge_store.EDGES_EXT)
+        edges_csv_path = feature_store.edges_path(feats_csv_path, edges_per_node)
+    if args.graph == 'spatial':
+        # all the grid neighbours, get_edges_spatial.py sets the neighbourhood
+        edges_per_node, edges_csv_path = None, None
 
     # Get label for sample
     label = np.zeros(args.num_classes)
@@ -50,24 +56,21 @@ def get_bag_feats_graph(csv_file_df, edges_per_node, args):
             label[int(csv_file_df.iloc[1])] = 1
 
     # Get features in dataframe
-    node_df = pd.read_csv(feats_csv_path, index_col=0)
-    feats = node_df.to_numpy()
+    feats = feature_store.load_feats(feats_csv_path)
     
-    edge_df = pd.read_csv(edges_csv_path, index_col=0)
+    # First edges_per_node neighbours of every node, from the CSR file or a legacy CSV
+    src, dst, weight = edge_store.read_edges(edges_path, edges_per_node, edges_csv_path)
 
     # Create a DGL graph
-    src = edge_df['Src'].to_numpy()
-    dst = edge_df['Dst'].to_numpy()
-    graph = dgl.graph((src, dst))
+    graph = dgl.graph((src, dst), num_nodes=len(feats))
 
     # Add edge weights
-    edge_weight = torch.tensor(edge_df['Weight'].to_numpy())
+    edge_weight = torch.tensor(weight)
     graph.edata['weight'] = edge_weight
 
     # Add node features
-    for col in node_df.columns:
-        data = torch.tensor(node_df[col].to_numpy())
-        graph.ndata[col] = data
+    for col in range(feats.shape[1]):
+        graph.ndata[str(col)] = torch.tensor(feats[:, col])
 
     # Add self loops
     graph = dgl.add_self_loop(graph)
@@ -247,6 +250,7 @@ def main():
     # Graph conv arguments
     parser.add_argument('--model', default='graph_dsmil', type=str, help='MIL model [dsmil|graph_dsmil]')
     parser.add_argument('--edges_per_node', default=4, type=int, help='Number of edges for each node found through KNN')
+    parser.add_argument('--graph', default='knn', type=str, help='Bag graph, feature space neighbours (get_edges_knn.py) or adjacent tiles (get_edges_spatial.py) [knn|spatial]')
     parser.add_argument('--gcn_layer_type', default='GraphConv', type=str, help='Type of GCN layer to use in model [GraphConv|GATConv|SAGEConv]')
     parser.add_argument('--n_gcn_layers', default=1, type=int, help='Number of GCN (or other graph type) layers to apply')
     parser.add_argument('--agg_type', default='dsmil', type=str, help='Aggregator type to use [dsmil|GlobalAttentionPooling]')
@@ -13,6 +13,8 @@ import numpy as np
 from sklearn.utils import shuffle
 from sklearn.metrics import roc_curve, roc_auc_score
 
+import feature_store
+
 
 def get_bag_feats(csv_file_df, args):
     if args.dataset == 'TCGA-lung-default':
@@ -20,8 +22,7 @@ def get_bag_feats(csv_file_df, args):
         edges_csv_path = 'datasets/tcga-dataset/tcga_lung_data_edges_partial/edges_' + csv_file_df.iloc[0].split('/')[1] + '.csv'
     else:
         feats_csv_path = csv_file_df.iloc[0]
-        splt = feats_csv_path.split('/')
-        edges_csv_path = '/'.join(splt[:-2]) + '/edges_partial/edges_' + splt[-1]
+        edges_csv_path = feature_store.edges_path(feats_csv_path, 'partial')
 
     # Get label for sample
     label = np.zeros(args.num_classes)
@@ -32,8 +33,7 @@ def get_bag_feats(csv_file_df, args):
             label[int(csv_file_df.iloc[1])] = 1
 
     # Get features in dataframe
-    node_df = pd.read_csv(feats_csv_path, index_col=0)
-    feats = node_df.to_numpy()
+    feats = feature_store.load_feats(feats_csv_path)
     
     edge_df = pd.read_csv(edges_csv_path, index_col=0)
 
@@ -47,9 +47,8 @@ def get_bag_feats(csv_file_df, args):
     graph.edata['weight'] = edge_weight
 
     # Add node features
-    for col in node_df.columns:
-        data = torch.tensor(node_df[col].to_numpy())
-        graph.ndata[col] = data
+    for col in range(feats.shape[1]):
+        graph.ndata[str(col)] = torch.tensor(feats[:, col])
 
     return label, graph, feats
 
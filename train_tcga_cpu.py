@@ -14,14 +14,15 @@ from sklearn.metrics import roc_curve, roc_auc_score, precision_recall_fscore_su
 from sklearn.datasets import load_svmlight_file
 from collections import OrderedDict
 
+import feature_store
+
 def get_bag_feats(csv_file_df, args):
     if args.dataset == 'TCGA-lung-default':
         feats_csv_path = 'datasets/tcga-dataset/tcga_lung_data_feats/' + csv_file_df.iloc[0].split('/')[1] + '.csv'
     else:
         feats_csv_path = csv_file_df.iloc[0]
-    df = pd.read_csv(feats_csv_path, index_col=0)
-    feats = shuffle(df).reset_index(drop=True)
-    feats = feats.to_numpy()
+    feats = feature_store.load_feats(feats_csv_path)
+    feats = shuffle(feats)
     label = np.zeros(args.num_classes)
     if args.num_classes==1:
         label[0] = csv_file_df.iloc[1]
@@ -0,0 +1,156 @@
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import traceback
+
+# Bags shared by several worker processes, on one host or many, through one
+# SQLite file on shared storage. Every worker adds the full bag list (bags
+# already queued are left as they are) and then claims pending bags one at
+# a time until none is left:
+#   pending -> running (worker, started) -> done (n_tiles, finished)
+#                                        -> failed
+# A bag whose worker died is claimed again once its claim is older than
+# `claim_timeout`, and a bag that raised goes back to pending; after
+# MAX_ATTEMPTS claims it is failed. The run is complete when every bag is
+# done or failed.
+MAX_ATTEMPTS = 3
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bags (bag TEXT PRIMARY KEY, status TEXT, worker TEXT, attempts INTEGER,
+                                 started REAL, finished REAL, n_tiles INTEGER);
+'''
+
+
+def worker_name():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """Bags claimed by concurrent workers from a shared SQLite file."""
+
+    def __init__(self, queue_path, worker=None, claim_timeout=6*3600):
+        os.makedirs(os.path.dirname(queue_path) or '.', exist_ok=True)
+        self.path = queue_path
+        self.worker = worker or worker_name()
+        self.claim_timeout = claim_timeout
+        # no WAL: the queue may sit on a network filesystem
+        self.db = sqlite3.connect(queue_path, timeout=300, isolation_level=None)
+        self.db.executescript(_SCHEMA)
+        # exhausted bags were left pending by older versions
+        self.db.execute("UPDATE bags SET status = 'failed' WHERE status = 'pending' AND attempts >= ?", (MAX_ATTEMPTS,))
+
+    def add(self, bags):
+        self.db.execute('BEGIN IMMEDIATE')
+        self.db.executemany("INSERT OR IGNORE INTO bags (bag, status, attempts) VALUES (?, 'pending', 0)",
+                            [(b,) for b in bags])
+        self.db.execute('COMMIT')
+
+    def claim(self):
+        """Next bag for this worker, None when the queue is empty."""
+        now = time.time()
+        self.db.execute('BEGIN IMMEDIATE')
+        # bags that killed their workers MAX_ATTEMPTS times
+        self.db.execute("UPDATE bags SET status = 'failed' WHERE status = 'running' AND started < ? AND attempts >= ?",
+                        (now - self.claim_timeout, MAX_ATTEMPTS))
+        row = self.db.execute('''SELECT bag FROM bags WHERE attempts < ? AND (status = 'pending'
+                                 OR (status = 'running' AND started < ?)) ORDER BY attempts, bag LIMIT 1''',
+                              (MAX_ATTEMPTS, now - self.claim_timeout)).fetchone()
+        if row is not None:
+            self.db.execute("UPDATE bags SET status = 'running', worker = ?, started = ?, attempts = attempts + 1 WHERE bag = ?",
+                            (self.worker, now, row[0]))
+        self.db.execute('COMMIT')
+        return row[0] if row is not None else None
+
+    def done(self, bag, n_tiles):
+        self.db.execute("UPDATE bags SET status = 'done', finished = ?, n_tiles = ? WHERE bag = ?",
+                        (time.time(), int(n_tiles), bag))
+
+    def fail(self, bag):
+        """Back to pending, or failed after MAX_ATTEMPTS."""
+        self.db.execute("UPDATE bags SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, worker = NULL WHERE bag = ?",
+                        (MAX_ATTEMPTS, bag))
+
+    def release(self, bag):
+        """Back to pending without counting the attempt, e.g. when the worker is interrupted."""
+        self.db.execute("UPDATE bags SET status = 'pending', worker = NULL, attempts = MAX(attempts - 1, 0) WHERE bag = ?", (bag,))
+
+    def complete(self):
+        """Every bag is done or failed."""
+        stats = self.stats()
+        return stats.get('done', 0) + stats.get('failed', 0) == stats['total']
+
+    def __iter__(self):
+        while True:
+            bag = self.claim()
+            if bag is None:
+                return
+            yield bag
+
+    def stats(self, worker=None):
+        """Bags per status, tiles done and tiles/sec from the first claim to the last finished bag, for all workers or one."""
+        where, params = ('WHERE worker = ?', (worker,)) if worker else ('', ())
+        counts = dict(self.db.execute('SELECT status, COUNT(*) FROM bags {} GROUP BY status'.format(where), params).fetchall())
+        if worker is None:
+            counts['total'] = sum(counts.values())
+        n_workers, n_tiles, start, end = self.db.execute(
+            "SELECT COUNT(DISTINCT worker), COALESCE(SUM(n_tiles), 0), MIN(started), MAX(finished) FROM bags WHERE status = 'done' {}".format(
+                'AND worker = ?' if worker else ''), params).fetchone()
+        elapsed = (end - start) if start is not None and end is not None else 0
+        return dict(counts, workers=n_workers, tiles=n_tiles, seconds=elapsed,
+                    tiles_per_sec=n_tiles / elapsed if elapsed > 0 else 0.0)
+
+    def report(self):
+        total, mine = self.stats(), self.stats(self.worker)
+        return ('bags {}/{} done ({} running, {} failed), {} workers: {} tiles, {:.1f} tiles/sec -- this worker {} bags, {:.1f} tiles/sec'.format(
+            total.get('done', 0), total['total'], total.get('running', 0), total.get('failed', 0), total['workers'], total['tiles'], total['tiles_per_sec'],
+            mine.get('done', 0), mine['tiles_per_sec']))
+
+    def close(self):
+        self.db.close()
+
+
+def run(bags_list, work, queue=None):
+    """Call `work(bag, progress)` on every bag, or on the bags claimed from `queue`.
+    `work` returns the number of tiles of the bag. With a queue, a bag that raises is logged and
+    retried later (see MAX_ATTEMPTS) while the worker goes on with the next one."""
+    if queue is None:
+        for i, bag in enumerate(bags_list):
+            work(bag, '{}/{}'.format(i+1, len(bags_list)))
+        return
+    queue.add(bags_list)
+    for bag in queue:
+        try:
+            n_tiles = work(bag, os.path.basename(bag))
+        except (KeyboardInterrupt, SystemExit):
+            queue.release(bag)
+            raise
+        except Exception:
+            print('\nFailed ' + bag)
+            traceback.print_exc()
+            queue.fail(bag)
+            continue
+        queue.done(bag, n_tiles)
+        print('\n' + queue.report())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Progress of a shared bag queue')
+    parser.add_argument('queue', type=str, help='Queue file, e.g. datasets/<dataset>/work_queue.sqlite')
+    parser.add_argument('--reset', default=0, type=int, help='Put running and failed bags back to pending (0/1) [0]')
+    args = parser.parse_args()
+    queue = WorkQueue(args.queue)
+    if args.reset:
+        queue.db.execute("UPDATE bags SET status = 'pending', worker = NULL, attempts = 0 WHERE status != 'done'")
+    stats = queue.stats()
+    print(', '.join('{} {}'.format(k, stats.get(k, 0)) for k in ('total', 'pending', 'running', 'done', 'failed')))
+    print('{} workers, {} tiles, {:.1f} tiles/sec'.format(stats['workers'], stats['tiles'], stats['tiles_per_sec']))
+    for worker, n_bags, n_tiles in queue.db.execute(
+            "SELECT worker, COUNT(*), SUM(n_tiles) FROM bags WHERE status = 'done' GROUP BY worker ORDER BY worker"):
+        print('  {}  {} bags  {} tiles'.format(worker, n_bags, n_tiles))
+    queue.close()
+
+
+if __name__ == '__main__':
+    main()